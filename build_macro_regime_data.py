@@ -1,69 +1,188 @@
+import argparse
+import hashlib
+import io
+import json
 import pandas as pd
 from pathlib import Path
 
 RAW = Path("Data/Raw")
 
+# Typed per-series Parquet cache + manifest (schema, watermark, byte offset)
+STORE = RAW / "macro_store"
+MANIFEST = STORE / "manifest.json"
+STORE_VERSION = 1
+
 # Accept lots of possible timestamp names
 DATE_CANDIDATES = ("date", "time", "timestamp", "unix", "unixtime", "unix_time", "epoch", "epoch_ms")
 
-def parse_datetime(series: pd.Series) -> pd.DatetimeIndex:
-    """Parse a timestamp series that might be strings or UNIX epoch (s/ms)."""
+# (raw file, output column, value column) — add new macro series here
+SERIES = (
+    ("btc_d.csv",  "btc_d",     "close"),
+    ("usdt_d.csv", "usdt_d",    "close"),
+    ("total.csv",  "total_cap", "close"),
+    ("total3.csv", "total3",    "close"),
+)
+
+def _norm_cols(cols) -> list:
+    return [str(c).lower().strip().replace(".", "_") for c in cols]
+
+def parse_datetime(series: pd.Series, unit: str | None = None) -> pd.Series:
+    """Parse a timestamp series that might be strings or UNIX epoch (s/ms).
+
+    Pass ``unit`` ("s"/"ms") to skip the median-based epoch guess, e.g. when
+    parsing an appended tail with a schema recorded in the manifest.
+    """
     s = series
-    if pd.api.types.is_numeric_dtype(s):
+    if unit is not None or pd.api.types.is_numeric_dtype(s):
         s = pd.to_numeric(s, errors="coerce")
-        unit = "ms" if s.dropna().median() > 1e11 else "s"
+        if unit is None:
+            unit = "ms" if s.dropna().median() > 1e11 else "s"
         dt = pd.to_datetime(s, unit=unit, utc=True).dt.tz_convert(None)
     else:
         dt = pd.to_datetime(s, errors="coerce", utc=True).dt.tz_convert(None)
     return dt
 
-def load_series(fname: str, out_name: str, value_col: str = "close") -> pd.DataFrame:
+def detect_schema(df: pd.DataFrame, fname: str, value_col: str = "close") -> dict:
+    """Sniff date column, epoch unit and value column from a freshly read raw frame."""
+    cols = _norm_cols(df.columns)
+    date_col = next((c for c in DATE_CANDIDATES if c in cols), None)
+    if not date_col:
+        raise ValueError(f"{fname}: no date-like column found; saw columns {cols}")
+    if value_col not in cols:
+        # fall back to “first non-date column”
+        value_col = next(c for c in cols if c != date_col)
+
+    raw_dates = df.iloc[:, cols.index(date_col)]
+    unit = None
+    if pd.api.types.is_numeric_dtype(raw_dates):
+        unit = "ms" if pd.to_numeric(raw_dates, errors="coerce").dropna().median() > 1e11 else "s"
+
+    return {"columns": cols, "date_col": date_col, "value_col": value_col, "unit": unit}
+
+def _frame_from_raw(df: pd.DataFrame, schema: dict, out_name: str) -> pd.DataFrame:
+    """Apply a recorded schema: typed (timestamp, value) rows, one per timestamp (last non-NaN value wins)."""
+    df.columns = schema["columns"]
+    dt = parse_datetime(df[schema["date_col"]], unit=schema["unit"])
+    val = pd.to_numeric(df[schema["value_col"]], errors="coerce").astype("float64")
+    out = pd.DataFrame({"date": dt.astype("datetime64[ns]"), out_name: val}).dropna(subset=["date"])
+    return out.groupby("date", as_index=False).last()
+
+def _line_end(buf: bytes) -> int:
+    """Byte offset just past the last complete line (resume point for the next run)."""
+    return buf.rfind(b"\n") + 1
+
+def ingest_series(fname: str, out_name: str, value_col: str, manifest: dict, rebuild: bool = False) -> pd.DataFrame:
     """
-    Load a CSV with an OHLCV layout, parse timestamp, roll to day, and keep one row/day.
-    value_col defaults to 'close' (works for your files).
+    Parse RAW/fname into STORE/{out_name}.parquet, reusing prior work.
+
+    Raw macro files are append-only exports, so when the header and the
+    already-ingested prefix are unchanged only the bytes past the stored offset
+    are parsed (rows at/after the watermark are kept). Anything else — shrunk
+    file, changed header, schema edit, ``rebuild`` — triggers a full reparse.
     """
-    df = pd.read_csv(RAW / fname)
-    df.columns = [str(c).lower().strip().replace(".", "_") for c in df.columns]
+    src = RAW / fname
+    pq = STORE / f"{out_name}.parquet"
+    buf = src.read_bytes()
+    header = buf.split(b"\n", 1)[0].decode("utf-8-sig").strip()
+    entry = manifest.get(out_name)
 
-    date_col = next((c for c in DATE_CANDIDATES if c in df.columns), None)
-    if not date_col:
-        raise ValueError(f"{fname}: no date-like column found; saw columns {list(df.columns)}")
+    fresh = (
+        not rebuild and entry is not None and pq.exists()
+        and entry.get("source") == fname
+        and entry.get("header") == header
+        and entry.get("requested_value_col") == value_col
+        and entry.get("source_bytes", 0) <= len(buf)
+        and entry.get("prefix_sha1") == hashlib.sha1(buf[:entry.get("source_bytes", 0)]).hexdigest()
+    )
 
-    # Parse timestamp → daily
-    dt = parse_datetime(df[date_col]).dt.floor("D")
+    if fresh and entry["source_bytes"] == len(buf):
+        return pd.read_parquet(pq)
 
-    # Choose the value column and make numeric
-    if value_col not in df.columns:
-        # fall back to “first non-date column”
-        value_col = next(c for c in df.columns if c != date_col)
-    val = pd.to_numeric(df[value_col], errors="coerce")
+    if fresh:
+        tail = buf[entry["source_bytes"]:]
+        schema = {k: entry[k] for k in ("columns", "date_col", "value_col", "unit")}
+        new = _frame_from_raw(
+            pd.read_csv(io.BytesIO(tail), header=None, names=schema["columns"]), schema, out_name
+        )
+        watermark = pd.Timestamp(entry["watermark"])
+        new = new[new["date"] >= watermark]
+        old = pd.read_parquet(pq)
+        # a trailing NaN at a stored timestamp must not replace its value
+        out = pd.concat([old, new], ignore_index=True).groupby("date", as_index=False).last()
+        print(f"{fname}: +{len(new)} rows past watermark {watermark}")
+    else:
+        df = pd.read_csv(io.BytesIO(buf))
+        schema = detect_schema(df, fname, value_col=value_col)
+        out = _frame_from_raw(df, schema, out_name).reset_index(drop=True)
+        print(f"{fname}: full parse ({len(out)} rows, date={schema['date_col']}, unit={schema['unit']})")
 
-    out = pd.DataFrame({"date": dt, out_name: val}).dropna(subset=["date"])
-    # Deduplicate within a day (take last non-null per day after sorting)
-    out = out.sort_values("date").groupby("date", as_index=False).last()
+    out.to_parquet(pq, index=False)
+    manifest[out_name] = {
+        "source": fname,
+        "header": header,
+        "requested_value_col": value_col,
+        **schema,
+        "dtypes": {c: str(t) for c, t in out.dtypes.items()},
+        "rows": int(len(out)),
+        "watermark": out["date"].max().isoformat() if len(out) else None,
+        "source_bytes": _line_end(buf),
+        "prefix_sha1": hashlib.sha1(buf[:_line_end(buf)]).hexdigest(),
+    }
     return out
 
+def load_manifest() -> dict:
+    if MANIFEST.exists():
+        m = json.loads(MANIFEST.read_text(encoding="utf-8"))
+        if m.get("version") == STORE_VERSION:
+            return m.get("series", {})
+    return {}
+
+def save_manifest(series: dict) -> None:
+    MANIFEST.write_text(json.dumps({"version": STORE_VERSION, "series": series}, indent=2), encoding="utf-8")
+
+def load_series(fname: str, out_name: str, value_col: str = "close", rebuild: bool = False,
+                freq: str = "D") -> pd.DataFrame:
+    """
+    Load a macro series from the ingestion store, roll to freq (default day), and keep one row per bucket.
+    value_col defaults to 'close' (works for your files).
+    """
+    STORE.mkdir(parents=True, exist_ok=True)
+    manifest = load_manifest()
+    out = ingest_series(fname, out_name, value_col, manifest, rebuild=rebuild)
+    save_manifest(manifest)
+    return _to_freq(out, out_name, freq)
+
+def _to_freq(df: pd.DataFrame, out_name: str, freq: str = "D") -> pd.DataFrame:
+    # Deduplicate within a bucket (take last non-null per day/hour after sorting)
+    out = df.assign(date=df["date"].dt.floor(freq))
+    return out.groupby("date", as_index=False)[out_name].last()
+
 def main():
-    btc   = load_series("btc_d.csv",   "btc_d",   value_col="close")
-    usdt  = load_series("usdt_d.csv",  "usdt_d",  value_col="close")
-    total = load_series("total.csv",   "total_cap", value_col="close")
-    t3    = load_series("total3.csv",  "total3",  value_col="close")
-
-    # Outer-join on calendar day (now unique) and forward/back fill small gaps
-    df = (btc.merge(usdt,  on="date", how="outer")
-             .merge(total, on="date", how="outer")
-             .merge(t3,    on="date", how="outer")
-             .sort_values("date"))
-
-    for c in ["btc_d", "usdt_d", "total_cap", "total3"]:
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--rebuild", action="store_true", help="ignore the macro store and reparse every raw file")
+    ap.add_argument("--freq", default="D", help="output bucket, e.g. D (default) or h for intraday macro")
+    a = ap.parse_args()
+    daily = a.freq.upper() == "D"
+
+    frames = [load_series(fname, out_name, value_col, rebuild=a.rebuild, freq=a.freq)
+              for fname, out_name, value_col in SERIES]
+
+    # Outer-join on bucket (now unique) and forward/back fill small gaps
+    df = frames[0]
+    for f in frames[1:]:
+        df = df.merge(f, on="date", how="outer")
+    df = df.sort_values("date")
+
+    cols = [out_name for _, out_name, _ in SERIES]
+    for c in cols:
         df[c] = pd.to_numeric(df[c], errors="coerce")
 
-    df[["btc_d","usdt_d","total_cap","total3"]] = df[["btc_d","usdt_d","total_cap","total3"]].ffill().bfill()
+    df[cols] = df[cols].ffill().bfill()
 
     # Pretty date for CSV
-    df["date"] = pd.to_datetime(df["date"]).dt.strftime("%Y-%m-%d")
+    df["date"] = pd.to_datetime(df["date"]).dt.strftime("%Y-%m-%d" if daily else "%Y-%m-%d %H:%M:%S")
 
-    out = RAW / "macro_regime_data.csv"
+    out = RAW / ("macro_regime_data.csv" if daily else f"macro_regime_data_{a.freq}.csv")
     df.to_csv(out, index=False)
     print(f"wrote {out} rows:{len(df)} cols:{list(df.columns)}")
 
@@ -0,0 +1,14 @@
+import argparse
+
+from modules.trade_paths import open_trade_paths
+
+def main():
+    ap = argparse.ArgumentParser(description="Pack trade_bars.csv into CSR arrays (<stem>.paths/) for the exit tools.")
+    ap.add_argument("--src", default="trade_bars.csv")
+    ap.add_argument("--rebuild", action="store_true", help="rebuild even if the cache matches the CSV")
+    a = ap.parse_args()
+    p = open_trade_paths(a.src, rebuild=a.rebuild)
+    print(f"✅ {a.src}: {p.n_trades} trades, {p.n_bars} bars, columns={list(p.arrays)}")
+
+if __name__ == "__main__":
+    main()
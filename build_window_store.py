@@ -0,0 +1,50 @@
+import argparse
+import pandas as pd
+from pathlib import Path
+
+from modules.window_store import long_to_dedup_windows, long_to_window_store, wide_to_window_store
+
+NON_FEATURES = {"symbol", "entry_date", "exit_date", "date", "bar_offset", "exit_reason", "source", "index"}
+
+def main():
+    ap = argparse.ArgumentParser(description="Write windows as a float32 (trades x offsets x features) memmap + JSON sidecar.")
+    ap.add_argument("--src", default="Data/Processed/static_breakouts_long.parquet",
+                    help="long windows (parquet/csv with bar_offset) or wide *_d{k} csv with --wide")
+    ap.add_argument("--out", default="Data/Processed/windows_221", help="output stem (<out>.npy + <out>.json)")
+    ap.add_argument("--features", nargs="*", default=None, help="feature columns / _d prefixes (default: all numeric)")
+    ap.add_argument("--wide", action="store_true", help="src is a wide {feature}_d{k} table (exit-search layout)")
+    ap.add_argument("--dedup", action="store_true",
+                    help="write <out>/ as per-symbol bars stored once + (start, length) window refs")
+    ap.add_argument("--lo", type=int, default=None)
+    ap.add_argument("--hi", type=int, default=None)
+    a = ap.parse_args()
+
+    src = Path(a.src)
+    df = pd.read_parquet(src) if src.suffix.lower() == ".parquet" else pd.read_csv(src, low_memory=False)
+
+    if a.wide:
+        prefixes = a.features or ["open", "high", "low", "close", "volume", "rsi", "macd", "macd_signal", "adx", "bbw"]
+        prefixes = [p for p in prefixes if any(str(c).startswith(f"{p}_d") for c in df.columns)]
+        store = wide_to_window_store(df, a.out, prefixes)
+    else:
+        if "entry_date" in df.columns:
+            df["entry_date"] = pd.to_datetime(df["entry_date"], errors="coerce")
+        feats = a.features
+        if a.dedup:
+            bars = feats or [c for c in ("open", "high", "low", "close", "volume") if c in df.columns]
+            d = long_to_dedup_windows(df, a.out, bars)
+            print(f"✅ Wrote {a.out}/ {len(d.refs)} windows over {len(d.bars['date'])} unique bars "
+                  f"(long source had {len(df)} rows)")
+            return
+        if not feats:
+            # per-bar numeric columns only; trade-constant metadata stays in the ledger
+            cands = [c for c in df.select_dtypes(include="number").columns if c not in NON_FEATURES]
+            varies = df.groupby(["symbol", "entry_date"])[cands].nunique(dropna=False).max() > 1
+            feats = [c for c in cands if varies[c]]
+        store = long_to_window_store(df, a.out, feats, lo=a.lo, hi=a.hi)
+
+    print(f"✅ Wrote {a.out}.npy {store.values.shape} features={list(store.features)} "
+          f"offsets={store.offsets[0]}..{store.offsets[-1]}")
+
+if __name__ == "__main__":
+    main()
@@ -1,28 +1,121 @@
 #!/usr/bin/env python
 
+import argparse
+import numpy as np
 import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
 import glob
 import os
 
-def main():
-    # — 1. find all per‐symbol window files in Data/Processed —
-    pattern = os.path.join("Data", "Processed", "static_breakouts_long_*.csv")
-    files = glob.glob(pattern)
-    print(f"Found {len(files)} files to merge…")
-    if not files:
-        raise FileNotFoundError(f"No files matched {pattern}")
-
-    # — 2. read & concat —
-    df_list = []
-    for fn in files:
-        # only parse entry_date here
-        df = pd.read_csv(fn, parse_dates=["entry_date"])
-        # if exit_date is present, convert to datetime
-        if "exit_date" in df.columns:
-            df["exit_date"] = pd.to_datetime(df["exit_date"], errors="coerce")
-        df_list.append(df)
-
-    df_long = pd.concat(df_list, ignore_index=True)
+from make_long_breakout_windows import SRC, WINDOW_BARS
+from modules.windows import extract_windows, load_symbol_bars
+
+# per-bar history columns pivoted wide, in output order
+PER_BAR = ("date", "open", "high", "low", "close", "volume")
+WIDE_OUT = "holy_grail_static_221_windows_wide.parquet"
+
+def wide_name(indicator: str, offset: int) -> str:
+    # e.g. ('rsi', -3) → 'rsi_m3'; ('mom', +2) → 'mom_p2'
+    return f"{indicator}_{'p' if offset > 0 else 'm'}{abs(int(offset))}"
+
+def wide_schema(ledger_schema: pa.Schema, offsets: np.ndarray) -> pa.Schema:
+    """Stable column order: ledger columns, then indicator-major, offset-minor."""
+    fields = list(ledger_schema)
+    for ind in PER_BAR:
+        typ = pa.timestamp("ns") if ind == "date" else pa.float64()
+        fields += [pa.field(wide_name(ind, o), typ) for o in offsets]
+    return pa.schema(fields)
+
+def symbol_wide(g: pd.DataFrame, pre: int, post: int) -> tuple[pd.DataFrame, dict]:
+    """Wide window arrays for one symbol's breakouts (rows with no exact entry bar dropped)."""
+    w = extract_windows(g, pre, post, columns=PER_BAR, match="exact")
+    return w.events, w.arrays
+
+def build_wide_streaming(pre: int = 0, post: int = WINDOW_BARS, batch_rows: int = 5000, out: str = WIDE_OUT) -> int:
+    """
+    Write the wide `{indicator}_{m|p}{k}` layout straight from per-symbol
+    windows, batch_rows trades per Parquet row group. Peak memory is one
+    symbol history plus one batch, independent of universe size.
+
+    Only the PER_BAR history columns are pivoted; ledger columns are kept
+    once per trade (--from-long repeats them for every offset).
+    """
+    offsets = np.arange(-pre, post + 1)
+    ledger = pd.read_csv(SRC, parse_dates=["entry_date"])
+    if "exit_date" in ledger.columns:
+        ledger["exit_date"] = pd.to_datetime(ledger["exit_date"], errors="coerce")
+    ledger = ledger.sort_values(["symbol", "entry_date"], kind="stable").reset_index(drop=True)
+    schema = wide_schema(pa.Schema.from_pandas(ledger.head(0), preserve_index=False), offsets)
+
+    written = 0
+    pend_meta, pend_cols = [], []
+
+    def write(writer, meta: pd.DataFrame, cols: dict):
+        arrays = [pa.Array.from_pandas(meta[f.name], type=f.type)
+                  for f in schema if f.name in ledger.columns]
+        for ind in PER_BAR:
+            typ = schema.field(wide_name(ind, offsets[0])).type
+            arrays += [pa.array(cols[ind][:, j], type=typ, from_pandas=True) for j in range(len(offsets))]
+        writer.write_table(pa.Table.from_arrays(arrays, schema=schema))
+
+    def drain(writer, final: bool = False):
+        # emit full batch_rows batches; keep the remainder pending unless final
+        nonlocal pend_meta, pend_cols, written
+        if not pend_meta:
+            return
+        meta = pd.concat(pend_meta, ignore_index=True)
+        cols = {ind: np.concatenate([c[ind] for c in pend_cols], axis=0) for ind in PER_BAR}
+        start = 0
+        while len(meta) - start >= batch_rows or (final and start < len(meta)):
+            stop = min(start + batch_rows, len(meta))
+            write(writer, meta.iloc[start:stop], {k: v[start:stop] for k, v in cols.items()})
+            written += stop - start
+            start = stop
+        pend_meta = [meta.iloc[start:]] if start < len(meta) else []
+        pend_cols = [{k: v[start:] for k, v in cols.items()}] if start < len(meta) else []
+
+    with pq.ParquetWriter(out, schema) as writer:
+        for symbol, g in ledger.groupby("symbol", sort=True):
+            hist = load_symbol_bars(symbol)
+            if hist is None or hist.empty:
+                # extract_windows returns no arrays for these, which drain() cannot stack
+                print(f"⚠️ No OHLCV {'file' if hist is None else 'history'} for {symbol}, skipping.")
+                continue
+            meta, cols = symbol_wide(g, pre, post)
+            pend_meta.append(meta)
+            pend_cols.append(cols)
+            if sum(len(m) for m in pend_meta) >= batch_rows:
+                drain(writer)
+        drain(writer, final=True)
+    return written
+
+def pivot_from_long():
+    # — 1. single long-windows file from make_long_breakout_windows.py —
+    single = os.path.join("Data", "Processed", "static_breakouts_long.parquet")
+    if os.path.exists(single):
+        df_long = pd.read_parquet(single)
+        if "exit_date" in df_long.columns:
+            df_long["exit_date"] = pd.to_datetime(df_long["exit_date"], errors="coerce")
+    else:
+        # legacy layout: one window CSV per symbol
+        pattern = os.path.join("Data", "Processed", "static_breakouts_long_*.csv")
+        files = glob.glob(pattern)
+        print(f"Found {len(files)} files to merge…")
+        if not files:
+            raise FileNotFoundError(f"Neither {single} nor files matching {pattern} exist")
+
+        # — 2. read & concat —
+        df_list = []
+        for fn in files:
+            # only parse entry_date here
+            df = pd.read_csv(fn, parse_dates=["entry_date"])
+            # if exit_date is present, convert to datetime
+            if "exit_date" in df.columns:
+                df["exit_date"] = pd.to_datetime(df["exit_date"], errors="coerce")
+            df_list.append(df)
+
+        df_long = pd.concat(df_list, ignore_index=True)
     print(f"Total rows in merged long table: {len(df_long)}")
 
     # — 3. write out the combined long‐windows file —
@@ -52,6 +145,21 @@ def main():
     df_wide.to_csv(wide_out, index=False)
     print(f"Wrote {wide_out}")
 
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--pre", type=int, default=0, help="bars before entry (m-side offsets)")
+    ap.add_argument("--post", type=int, default=WINDOW_BARS, help="bars after entry (p-side offsets)")
+    ap.add_argument("--batch-rows", type=int, default=5000, help="trades per Parquet row group")
+    ap.add_argument("--out", default=WIDE_OUT)
+    ap.add_argument("--from-long", action="store_true",
+                    help="legacy path: concat long windows in memory and unstack to CSV")
+    a = ap.parse_args()
+    if a.from_long:
+        pivot_from_long()
+        return
+    n = build_wide_streaming(pre=a.pre, post=a.post, batch_rows=a.batch_rows, out=a.out)
+    print(f"Wrote {a.out} ({n} trades, offsets -{a.pre}..+{a.post})")
+
 if __name__ == "__main__":
     main()
 
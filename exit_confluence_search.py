@@ -1,6 +1,11 @@
-﻿import re, numpy as np, pandas as pd
+﻿import argparse, numpy as np, pandas as pd
 from itertools import product
 
+from modules.exit_kernels import (
+    NO_HIT, close_return, first_hit, forward_cols, macd_hist_mask, momentum_retrace_mask, peak_drop_mask, tp_hit_day,
+)
+from modules.window_store import store_panels
+
 IN  = r"C:\Users\milla\OneDrive\Documents\GitHub\m18-model2\data\Processed\breakout_events_timed_full.csv"
 LAB = r"C:\Users\milla\OneDrive\Documents\GitHub\m18-model2\data\Processed\breakout_trades_labeled.csv"
 OUT = r"C:\Users\milla\OneDrive\Documents\GitHub\m18-model2\data\Processed\exit_confluence_grid_results.csv"
@@ -8,80 +13,26 @@ OUT = r"C:\Users\milla\OneDrive\Documents\GitHub\m18-model2\data\Processed\exit_
 TP   = {1:0.65,2:0.85,3:0.90,4:0.85,5:0.95,6:0.90,7:0.95,8:0.95,9:0.95}
 HOLD = {1:5, 2:5, 3:8, 4:6, 5:8, 6:6, 7:6, 8:7, 9:6}
 
-def day_cols(prefix, df):
-    pat = re.compile(rf"^{re.escape(prefix)}_d(\-?\d+)$")
-    out=[]
-    for c in df.columns:
-        m=pat.match(c)
-        if m:
-            t=int(m.group(1))
-            if t>=0: out.append((t,c))
-    out.sort()
-    return [c for _,c in out]
-
-def find_tp_day(highs, start, tp_pct):
-    if not np.isfinite(start) or start<=0: return None
-    for t,h in enumerate(highs):
-        if np.isfinite(h) and (h/start-1.0)>=tp_pct:
-            return t
-    return None
-
-def rsi_confluence_exit_day(rsi, macdh, adx, bbw, Y, DLT, Z, M, family, p1):
-    had_momo=False
-    rsi_peak=-np.inf
-    adx_peak=-np.inf
-    bbw_peak=-np.inf
-    for t in range(len(rsi)):
-        x=rsi[t]
-        if np.isfinite(x):
-            rsi_peak=max(rsi_peak,x)
-            if rsi_peak>=Y: had_momo=True
-        # track peaks for confirms
-        if np.isfinite(adx[t]): adx_peak=max(adx_peak, adx[t])
-        if np.isfinite(bbw[t]): bbw_peak=max(bbw_peak, bbw[t])
-
-        if t>=M and had_momo:
-            retr = (np.isfinite(x) and (rsi_peak - x) >= DLT) or (Z is not None and np.isfinite(x) and x<=Z)
-            if not retr: 
-                continue
-            # confirm families
-            ok=False
-            if family=="macd_leq":
-                ok = np.isfinite(macdh[t]) and (macdh[t] <= p1)   # p1 in {0.0, -0.02}
-            elif family=="adx_drop":
-                ok = np.isfinite(adx[t]) and np.isfinite(adx_peak) and (adx_peak - adx[t] >= p1)  # p1 in {5,10,15}
-            elif family=="bbw_contract":
-                ok = np.isfinite(bbw[t]) and np.isfinite(bbw_peak) and (bbw_peak>0) and ((bbw_peak - bbw[t]) / bbw_peak >= p1)  # p1 in {0.2,0.35,0.5}
-            if ok:
-                return t
-    return None
-
-def ret_at_idx(series, start, t):
-    if not np.isfinite(start) or start<=0 or t is None or t>=len(series): return np.nan
-    v=series[t]
-    return (v/start-1.0) if np.isfinite(v) else np.nan
-
-def ret_timed(close, start, hold):
-    t=min(hold, len(close)-1)
-    if not np.isfinite(start) or start<=0 or t<0: return np.nan
-    v=close[t]
-    return (v/start-1.0) if np.isfinite(v) else np.nan
+def ret_at(X, start, t):
+    """X[i,t]/start - 1 per trade; NaN past the panel, for NO_HIT, or on a bad start/price."""
+    return close_return(X, start, np.where(t < X.shape[1], t, NO_HIT))
+
+ap = argparse.ArgumentParser()
+ap.add_argument("--store", default=None,
+                help="window store stem (build_window_store.py --wide --src IN) to read the forward panels from")
+STORE = ap.parse_args().store
+PANELS = ("rsi", "high", "close", "macd", "macd_signal", "adx", "bbw")
 
 # load/merge
 df  = pd.read_csv(IN)
+fwd = store_panels(STORE, PANELS, df) if STORE else None
 lab = pd.read_csv(LAB)[["symbol","breakout_date","win_flag"]]
-df = df.merge(lab, on=["symbol","breakout_date"], how="left")
-
-rsi_cols   = day_cols("rsi", df)
-high_cols  = day_cols("high", df)
-close_cols = day_cols("close", df)
-macd_cols  = day_cols("macd", df)
-sig_cols   = day_cols("macd_signal", df)
-adx_cols   = day_cols("adx", df)
-bbw_cols   = day_cols("bbw", df)
+df = df.assign(_row=np.arange(len(df))).merge(lab, on=["symbol","breakout_date"], how="left")
 
-if not all([rsi_cols, high_cols, close_cols, macd_cols, sig_cols, adx_cols, bbw_cols]):
-    raise RuntimeError("Missing one or more required *_d* series (rsi/high/close/macd/macd_signal/adx/bbw).")
+if fwd is None:
+    cols = {n: forward_cols(df, n) for n in PANELS}
+    if not all(cols.values()):
+        raise RuntimeError("Missing one or more required *_d* series (rsi/high/close/macd/macd_signal/adx/bbw).")
 
 Ys   = [60, 70, 80]          # RSI threshold
 DLTs = [5, 10, 15]           # RSI retrace
@@ -94,43 +45,48 @@ families = [
     ("bbw_contract", [0.20, 0.35, 0.50]),
 ]
 
+# trades with a known level, as (N, T) forward panels
+lvl_raw = np.trunc(pd.to_numeric(df["market_level"], errors="coerce"))
+df  = df.loc[lvl_raw.isin(list(TP)).to_numpy()].reset_index(drop=True)
+lvl = lvl_raw[lvl_raw.isin(list(TP))].astype(int).to_numpy()
+start = (df["start_price"] if "start_price" in df else pd.Series(np.nan, index=df.index)).astype(float).to_numpy()
+hold  = np.array([HOLD[l] for l in lvl], dtype=int)
+win_flag = df["win_flag"].to_numpy() if "win_flag" in df else np.full(len(df), np.nan)
+P = ({n: df[c].to_numpy(dtype=float) for n, c in cols.items()} if fwd is None
+     else {n: v[df["_row"].to_numpy()] for n, v in fwd.items()})
+RSI   = P["rsi"]
+HIGH  = P["high"]
+CLOSE = P["close"]
+
+# rule-independent pieces: TP day, timed return and every confirm mask, once
+t_tp   = tp_hit_day(HIGH, start, np.array([TP[l] for l in lvl]))
+ret_tp = ret_at(HIGH, start, t_tp)
+ret_t  = ret_at(CLOSE, start, np.minimum(hold, CLOSE.shape[1] - 1))
+MACDH = P["macd"] - P["macd_signal"]
+ADX   = P["adx"]
+BBW   = P["bbw"]
+confirm = {}
+for fam, params in families:
+    for p1 in params:
+        if fam == "macd_leq":
+            confirm[(fam, p1)] = macd_hist_mask(MACDH, 0.0, p1)       # p1 in {0.0, -0.02}
+        elif fam == "adx_drop":
+            confirm[(fam, p1)] = peak_drop_mask(ADX, p1)              # p1 in {5,10,15}
+        elif fam == "bbw_contract":
+            confirm[(fam, p1)] = peak_drop_mask(BBW, p1, relative=True)  # p1 in {0.2,0.35,0.5}
+
 rows=[]
 for Y,DLT,Z,M in product(Ys,DLTs,Zs,Ms):
+    retr = momentum_retrace_mask(RSI, Y, DLT, Z, M)
     for fam, params in families:
         for p1 in params:
-            recs=[]
-            for _,row in df.iterrows():
-                lvl = int(row["market_level"]) if pd.notna(row["market_level"]) else None
-                if lvl not in TP: 
-                    continue
-                start=row.get("start_price", np.nan)
-                hold = HOLD[lvl]
-
-                rsi   = row[rsi_cols].to_numpy(float, copy=False)
-                highs = row[high_cols].to_numpy(float, copy=False)
-                close = row[close_cols].to_numpy(float, copy=False)
-                macdh = (row[macd_cols].to_numpy(float, copy=False) - row[sig_cols].to_numpy(float, copy=False))
-                adx   = row[adx_cols].to_numpy(float, copy=False)
-                bbw   = row[bbw_cols].to_numpy(float, copy=False)
-
-                t_tp = find_tp_day(highs, start, TP[lvl])
-                if t_tp is not None:
-                    t_exit = t_tp
-                    ret_exit = ret_at_idx(highs, start, t_tp)
-                else:
-                    t_re = rsi_confluence_exit_day(rsi, macdh, adx, bbw, Y, DLT, Z, M, fam, p1)
-                    if t_re is not None:
-                        t_exit = t_re
-                        ret_exit = ret_at_idx(close, start, t_re)
-                    else:
-                        t_exit = hold
-                        ret_exit = ret_timed(close, start, hold)
-
-                ret_t = ret_timed(close, start, hold)
-                winlbl = row.get("win_flag", np.nan)
-                recs.append((lvl, winlbl, t_exit, ret_exit, ret_t))
-
-            tmp = pd.DataFrame(recs, columns=["level","win_flag","t_exit","ret_exit","ret_timed"])
+            t_re = first_hit(retr & confirm[(fam, p1)])
+
+            # TP first, else confirmed RSI exit, else timed hold
+            t_exit   = np.where(t_tp != NO_HIT, t_tp, np.where(t_re != NO_HIT, t_re, hold))
+            ret_exit = np.where(t_tp != NO_HIT, ret_tp, np.where(t_re != NO_HIT, ret_at(CLOSE, start, t_re), ret_t))
+
+            tmp = pd.DataFrame({"level":lvl, "win_flag":win_flag, "t_exit":t_exit, "ret_exit":ret_exit, "ret_timed":ret_t})
             win_mask  = (tmp["win_flag"]==1)
             loss_mask = (tmp["win_flag"]==0)
 
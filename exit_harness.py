@@ -2,70 +2,64 @@
 from pathlib import Path
 import pandas as pd, numpy as np, yaml
 
-def profit_factor(s):
-    pos = s[s>0].sum()
-    neg = -s[s<0].sum()
-    if neg == 0: return float('inf') if pos>0 else np.nan
-    return float(pos/neg)
-
-def equity_metrics(rets, dates=None):
-    if dates is not None:
-        rets = pd.Series(rets.values, index=pd.to_datetime(dates)).sort_index()
-    eq = (1+rets).cumprod()
-    roll = eq.cummax()
-    dd = eq/roll - 1
-    mdd = dd.min() if len(dd) else np.nan
-    return {
-        "trades": int(len(rets)),
-        "win_rate": float((rets>0).mean()) if len(rets) else np.nan,
-        "pf": profit_factor(rets),
-        "expectancy": float(np.nanmean(rets)) if len(rets) else np.nan,
-        "median_ret": float(np.nanmedian(rets)) if len(rets) else np.nan,
-        "mdd": float(mdd) if pd.notna(mdd) else np.nan,
-    }
+from modules.bootstrap import bootstrap_trade_ci
+from modules.exit_cache import ExitCache
+from modules.exit_eval import atr_trail_exits, equity_metrics_rows, time_cap_exits
+from modules.trade_paths import open_trade_paths
 
 def main():
     ap = argparse.ArgumentParser()
     ap.add_argument("--config", required=True)
+    ap.add_argument("--bootstrap", type=int, default=0, help="trade-level resamples for percentile CIs, e.g. 1000 (default 0 = off)")
+    ap.add_argument("--alpha", type=float, default=0.05)
+    ap.add_argument("--no-cache", action="store_true", help="recompute exits instead of reading exit_out/.cache")
     a = ap.parse_args()
     cfg = yaml.safe_load(open(a.config, "r", encoding="utf-8"))
-    bars = pd.read_csv(cfg["paths"]["trade_bars_csv"], parse_dates=["date"])
+    paths = open_trade_paths(cfg["paths"]["trade_bars_csv"])
+    cache = ExitCache(enabled=not a.no_cache)
     trades = pd.read_csv(cfg["paths"]["trades_csv"], parse_dates=["date"])
     if "trade_id" not in trades.columns:
         trades = trades.reset_index().rename(columns={"index":"trade_id"})
     out_dir = Path(cfg["paths"]["out_dir"]); out_dir.mkdir(parents=True, exist_ok=True)
 
-    # Baseline = exit at last bar of each trade path
-    last_ret = (bars.sort_values(["trade_id","bar_index"])
-                  .groupby("trade_id")["ret_from_entry"].last()
-                  .reindex(trades["trade_id"]).fillna(0.0))
-    results = []
-    base = equity_metrics(last_ret, trades["date"]); base.update({"family":"baseline","param":"last_bar"}); results.append(base)
+    # Exit-index matrix: one row per (family, param), one column per trade path
+    last = paths.last_index()
+    labels = [("baseline", "last_bar")]
+    rows = [last]
 
     # Time caps
-    for n in cfg["params"]["time_caps"]:
-        rets = (bars[bars["bar_index"]<=n].sort_values(["trade_id","bar_index"])
-                  .groupby("trade_id")["ret_from_entry"].last()
-                  .reindex(trades["trade_id"]).fillna(method="ffill").fillna(0.0))
-        met = equity_metrics(rets, trades["date"]); met.update({"family":"time_cap","param":int(n)}); results.append(met)
+    caps = [int(n) for n in cfg["params"]["time_caps"]]
+    labels += [("time_cap", n) for n in caps]
+    rows += list(time_cap_exits(paths, caps)[0])
+
+    # ATR trail (chandelier-style) and ATR-or-cap hybrids
+    if {"close","atr"}.issubset(paths.arrays):
+        mults = [float(m) for m in cfg["params"]["atr_multipliers"]]
+        # (multipliers x trades) in one pass, for the multipliers not cached for these bars yet
+        rules = [{"atr_trail": {"mult": m, "exit_bar": "prior"}} for m in mults]
+        trail_idx, _ = cache.fetch_many(rules, [cfg["paths"]["trade_bars_csv"]],
+                                        lambda miss: atr_trail_exits(paths, [mults[i] for i in miss]))
+        labels += [("atr_trail", m) for m in mults]
+        rows += list(trail_idx)
+        if cfg["params"].get("hybrid", True):
+            labels += [("atr_trail_cap", f"{m}_cap{n}") for m in mults for n in caps]
+            rows += [i for t in trail_idx for i in time_cap_exits(paths, caps, t)[0]]
 
-    # ATR trail (chandelier-style)
-    if {"close","atr"}.issubset(set(c.lower() for c in bars.columns)):
-        for mult in cfg["params"]["atr_multipliers"]:
-            out = []
-            for tid, g in bars.sort_values(["trade_id","bar_index"]).groupby("trade_id"):
-                c = g["close"].values; a = g["atr"].values
-                trail = np.maximum.accumulate(c) - float(mult)*a
-                hit = np.where(c < trail)[0]
-                out.append(float(g.iloc[max(hit[0]-1,0)]["ret_from_entry"]) if len(hit) else float(g.iloc[-1]["ret_from_entry"]))
-            rets = pd.Series(out, index=bars["trade_id"].unique()).reindex(trades["trade_id"]).fillna(0.0)
-            met = equity_metrics(rets, trades["date"]); met.update({"family":"atr_trail","param":float(mult)}); results.append(met)
+    # one gather for every combination, then map paths onto the trades file (no path -> 0)
+    R = paths.gather("ret_from_entry", np.vstack(rows))
+    pos = paths.positions(trades["trade_id"])
+    R = np.nan_to_num(np.where(pos >= 0, R[:, pos], 0.0), nan=0.0)
 
-    res = pd.DataFrame(results)
+    res = equity_metrics_rows(R, trades["date"])
+    res["family"] = [f for f, _ in labels]
+    res["param"] = [p for _, p in labels]
+    if a.bootstrap > 0:
+        order = pd.Series(np.arange(len(trades)), index=pd.to_datetime(trades["date"])).sort_index().to_numpy()
+        res = pd.concat([res, bootstrap_trade_ci(R[:, order], a.bootstrap, alpha=a.alpha)], axis=1)
     res.to_csv(out_dir/"exit_bakeoff.csv", index=False)
     top = res.sort_values(["pf","expectancy"], ascending=False).head(2).to_dict(orient="records")
     (out_dir/"exit_summary.json").write_text(json.dumps(top, indent=2))
-    print("Wrote", out_dir/"exit_bakeoff.csv", "and", out_dir/"exit_summary.json")
+    print("Wrote", out_dir/"exit_bakeoff.csv", "and", out_dir/"exit_summary.json", f"({cache.stats()})")
 
 if __name__ == "__main__":
     main()
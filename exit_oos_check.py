@@ -1,72 +1,136 @@
-﻿import argparse, json
+﻿import argparse, json, os
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
 import pandas as pd, numpy as np, yaml
 
-def profit_factor(s):
-    pos=s[s>0].sum(); neg=-s[s<0].sum()
-    return float('inf') if neg==0 and pos>0 else (float(pos/neg) if neg!=0 else np.nan)
-
-def equity_metrics(rets):
-    eq=(1+rets).cumprod(); roll=eq.cummax(); dd=eq/roll-1
-    mdd=dd.min() if len(dd) else np.nan
-    return dict(trades=int(len(rets)),
-                win_rate=float((rets>0).mean()) if len(rets) else np.nan,
-                pf=profit_factor(rets),
-                expectancy=float(np.nanmean(rets)) if len(rets) else np.nan,
-                median_ret=float(np.nanmedian(rets)) if len(rets) else np.nan,
-                mdd=float(mdd) if pd.notna(mdd) else np.nan)
-
-def strat_time_cap(bars, trades, n):
-    rets=(bars[bars["bar_index"]<=n].sort_values(["trade_id","bar_index"])
-          .groupby("trade_id")["ret_from_entry"].last()
-          .reindex(trades["trade_id"]).fillna(method="ffill").fillna(0.0))
-    return rets
-
-def strat_atr_trail(bars, trades, mult):
-    out=[]
-    for tid,g in bars.sort_values(["trade_id","bar_index"]).groupby("trade_id"):
-        c=g["close"].values; a=g["atr"].values
-        trail=np.maximum.accumulate(c) - float(mult)*a
-        hit=np.where(c<trail)[0]
-        out.append(float(g.iloc[max(hit[0]-1,0)]["ret_from_entry"]) if len(hit) else float(g.iloc[-1]["ret_from_entry"]))
-    return pd.Series(out, index=bars["trade_id"].unique()).reindex(trades["trade_id"]).fillna(0.0)
+from modules.bootstrap import bootstrap_trade_ci
+from modules.exit_eval import atr_trail_exits, equity_metrics_rows, time_cap_exits
+from modules.folds import purged_kfold, walk_forward_folds
+from modules.shm_grid import SharedPanels, attach_panels
+from modules.trade_paths import TradePaths, open_trade_paths
+
+def _by_trade(paths: TradePaths, trades, rets):
+    """(params x path trades) -> (trades x params) frame in trades order; trades without a path get 0."""
+    pos = paths.positions(trades["trade_id"])
+    return pd.DataFrame(np.where(pos >= 0, rets[:, pos], np.nan).T).fillna(0.0)
+
+def strat_time_cap(paths: TradePaths, trades, caps):
+    """(trades x caps) returns at bar min(cap, last)."""
+    _, rets = time_cap_exits(paths, np.atleast_1d(caps))
+    return _by_trade(paths, trades, rets)
+
+def strat_atr_trail(paths: TradePaths, trades, mults):
+    """(trades x multipliers) trail returns in trades order; trades without a path get 0."""
+    _, rets = atr_trail_exits(paths, np.atleast_1d(mults))
+    return _by_trade(paths, trades, rets)
+
+def family_returns(paths: TradePaths, trades, params):
+    """[(family, param)] labels and the (combinations x trades) return matrix in trades order."""
+    caps=params["time_caps"]
+    labels=[("time_cap", p) for p in caps]
+    blocks=[strat_time_cap(paths, trades, caps).to_numpy().T]
+    if {"atr","close"}.issubset(paths.arrays):
+        mults=params["atr_multipliers"]
+        labels+=[("atr_trail", p) for p in mults]
+        blocks.append(strat_atr_trail(paths, trades, mults).to_numpy().T)
+    return labels, np.vstack(blocks)
+
+def fold_rows(labels, R, train_idx, test_idx, **tags):
+    m_train=equity_metrics_rows(R[:, train_idx]); m_test=equity_metrics_rows(R[:, test_idx])
+    return [dict(tags, family=f, param=p,
+                 train_pf=m_train["pf"].iat[j], train_exp=m_train["expectancy"].iat[j],
+                 test_pf=m_test["pf"].iat[j],  test_exp=m_test["expectancy"].iat[j],
+                 train_trades=len(train_idx), test_trades=len(test_idx))
+            for j, (f, p) in enumerate(labels)]
+
+# ---------- fold workers: the return matrix is computed once and attached read-only (shared memory)
+
+_W = {}
+
+def _init_worker(spec, labels):
+    panels, _W["handles"] = attach_panels(spec)
+    _W["labels"], _W["R"] = labels, panels["R"]
+
+def _run_fold(task):
+    scheme, fold, train_idx, test_idx = task
+    return fold_rows(_W["labels"], _W["R"], train_idx, test_idx, scheme=scheme, fold=fold)
+
+def make_folds(a, trades, paths):
+    if a.cv == "walk":
+        return list(walk_forward_folds(trades["date"], a.folds, mode=a.wf_mode, min_train=a.min_train))
+    pos=paths.positions(trades["trade_id"])
+    ends=paths.gather("date", paths.last_index())
+    exit_dates=np.where(pos >= 0, ends[np.maximum(pos, 0)], trades["date"].to_numpy(dtype="datetime64[ns]"))
+    return list(purged_kfold(trades["date"], exit_dates, a.folds, embargo_days=a.embargo_days))
+
+def stability(folds_df):
+    """Per (family, param) spread of out-of-sample results across folds."""
+    df=folds_df.copy()
+    df["test_rank"]=df.groupby("fold")["test_exp"].rank(ascending=False, method="min")
+    df["train_best"]=df.groupby("fold")["train_exp"].transform("max").eq(df["train_exp"])
+    fin=df["test_pf"].replace([np.inf,-np.inf], np.nan)
+    g=df.assign(test_pf_finite=fin).groupby(["family","param"], sort=False)
+    return pd.DataFrame({
+        "folds": g.size(),
+        "test_exp_mean": g["test_exp"].mean(), "test_exp_std": g["test_exp"].std(ddof=1),
+        "test_exp_pos_frac": g["test_exp"].apply(lambda s: float((s>0).mean())),
+        "test_pf_median": g["test_pf_finite"].median(),
+        "train_exp_mean": g["train_exp"].mean(),
+        "mean_test_rank": g["test_rank"].mean(),
+        "train_best_frac": g["train_best"].mean(),
+    }).reset_index().sort_values(["test_exp_mean","test_exp_std"], ascending=[False,True])
 
 def main():
     ap=argparse.ArgumentParser()
     ap.add_argument("--config", required=True)
     ap.add_argument("--split", type=float, default=0.7, help="fraction of trades for train")
+    ap.add_argument("--cv", choices=["split","walk","kfold"], default="split",
+                    help="single chronological split, walk-forward folds, or purged k-fold")
+    ap.add_argument("--folds", type=int, default=5)
+    ap.add_argument("--wf-mode", choices=["expanding","sliding"], default="expanding")
+    ap.add_argument("--min-train", type=float, default=0.3, help="walk-forward: share of trades in the first train set")
+    ap.add_argument("--embargo-days", type=float, default=0.0, help="k-fold: drop train trades entering this soon after a test block")
+    ap.add_argument("--workers", type=int, default=0, help="fold processes (0 = min(folds, cpu count))")
+    ap.add_argument("--bootstrap", type=int, default=0, help="split: resamples for test-set percentile CIs, e.g. 1000 (default 0 = off)")
     a=ap.parse_args()
 
     cfg=yaml.safe_load(open(a.config, "r", encoding="utf-8"))
-    bars=pd.read_csv(cfg["paths"]["trade_bars_csv"], parse_dates=["date"])
+    paths=open_trade_paths(cfg["paths"]["trade_bars_csv"])
     trades=pd.read_csv(cfg["paths"]["trades_csv"], parse_dates=["date"])
     if "trade_id" not in trades.columns: trades=trades.reset_index().rename(columns={"index":"trade_id"})
+    out_dir=Path(cfg["paths"]["out_dir"]); out_dir.mkdir(parents=True, exist_ok=True)
 
     # split by trade date
     trades=trades.sort_values("date").reset_index(drop=True)
+    # every exit of every family, once: (combinations x trades) in trades order
+    labels, R=family_returns(paths, trades, cfg["params"])
+
+    if a.cv != "split":
+        folds=make_folds(a, trades, paths)
+        tasks=[(a.cv, i, tr, te) for i, (tr, te) in enumerate(folds)]
+        workers=a.workers or min(len(tasks), os.cpu_count() or 1)
+        if workers > 1:
+            with SharedPanels({"R": R}) as shm, \
+                 ProcessPoolExecutor(workers, initializer=_init_worker, initargs=(shm.spec, labels)) as pool:
+                rows=[r for part in pool.map(_run_fold, tasks) for r in part]
+        else:
+            rows=[r for t in tasks for r in fold_rows(labels, R, t[2], t[3], scheme=t[0], fold=t[1])]
+        folds_df=pd.DataFrame(rows)
+        stab=stability(folds_df)
+        folds_df.to_csv(out_dir/f"exit_oos_folds_{a.cv}.csv", index=False)
+        stab.to_csv(out_dir/f"exit_oos_stability_{a.cv}.csv", index=False)
+        print("Wrote", out_dir/f"exit_oos_folds_{a.cv}.csv", f"({len(tasks)} folds) and", out_dir/f"exit_oos_stability_{a.cv}.csv")
+        return
+
     cut=int(len(trades)*a.split); cut = max(1, min(len(trades)-1, cut))
-    train_idx=trades.iloc[:cut].index
-    test_idx =trades.iloc[cut:].index
-
-    def eval_family(name, param_vals, fn):
-        rows=[]
-        for p in param_vals:
-            rets = fn(bars, trades, p)
-            tr_train = rets.iloc[train_idx]; tr_test = rets.iloc[test_idx]
-            m_train=equity_metrics(tr_train); m_test=equity_metrics(tr_test)
-            rows.append(dict(family=name, param=p,
-                             train_pf=m_train["pf"], train_exp=m_train["expectancy"],
-                             test_pf=m_test["pf"],  test_exp=m_test["expectancy"],
-                             train_trades=m_train["trades"], test_trades=m_test["trades"]))
-        return rows
-
-    out=[]
-    out+=eval_family("time_cap", cfg["params"]["time_caps"], strat_time_cap)
-    if {"atr","close"}.issubset(set(c.lower() for c in bars.columns)):
-        out+=eval_family("atr_trail", cfg["params"]["atr_multipliers"], strat_atr_trail)
-
-    out_df=pd.DataFrame(out)
-    out_dir=Path(cfg["paths"]["out_dir"]); out_dir.mkdir(parents=True, exist_ok=True)
+    train_idx=np.arange(cut)
+    test_idx =np.arange(cut, len(trades))
+
+    out_df=pd.DataFrame(fold_rows(labels, R, train_idx, test_idx))
+    if a.bootstrap > 0:
+        ci=bootstrap_trade_ci(R[:, test_idx], a.bootstrap)
+        out_df=pd.concat([out_df, ci[["pf_lo","pf_hi","expectancy_lo","expectancy_hi"]]
+                          .rename(columns=lambda c: "test_"+c.replace("expectancy","exp"))], axis=1)
     out_df.to_csv(out_dir/"exit_oos_table.csv", index=False)
     top=(out_df.sort_values(["test_pf","test_exp"], ascending=False).head(5)
          .to_dict(orient="records"))
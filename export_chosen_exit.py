@@ -2,31 +2,32 @@
 from pathlib import Path
 import pandas as pd, numpy as np
 
-def export(mult, cap):
-    bars  = pd.read_csv('trade_bars.csv', parse_dates=['date'])
-    trades= pd.read_csv('trades_clean_for_exit_tests.csv', parse_dates=['date'])
-    if 'trade_id' not in trades.columns:
-        trades = trades.reset_index().rename(columns={'index':'trade_id'})
+from modules.exit_cache import ExitCache
+from modules.exit_eval import atr_trail_exits
+from modules.exit_rules import normalize_rule
+from modules.trade_paths import open_trade_paths
 
-    rows=[]
-    for tid, g in bars.sort_values(['trade_id','bar_index']).groupby('trade_id'):
-        c = g['close'].astype(float).values
-        a = g['atr'].astype(float).values
-        trail = np.maximum.accumulate(c) - float(mult) * a
-        hit = np.where(c < trail)[0]
-        k = int(hit[0]) if len(hit) else int(len(g)-1)
-        if cap is not None:
-            k = min(k, int(cap))
-        exit_row = g.iloc[k]
-        rows.append({
-            'trade_id': int(tid),
-            'exit_bar_index': int(exit_row['bar_index']),
-            'exit_date': pd.to_datetime(exit_row['date']).isoformat(),
-            'exit_ret': float(exit_row['ret_from_entry']),
-        })
+def chosen_exits(paths, mult, cap):
+    # first breach bar (or last bar) for every trade at once, then the optional cap
+    k, _ = atr_trail_exits(paths, [mult], exit_bar='breach')
+    k = k[0] if cap is None else np.minimum(k[0], int(cap))
+    return k, paths.gather('ret_from_entry', k)
+
+def export(mult, cap, use_cache=True):
+    paths = open_trade_paths('trade_bars.csv')
+
+    # same key as exit_out/exit_rule.json for this rule, so later steps can read it back
+    rule = normalize_rule({'family': 'atr_trail', 'multiplier': mult, 'cap_bars': cap})['rule']
+    ex = ExitCache(enabled=use_cache).fetch(rule, ['trade_bars.csv'], lambda: chosen_exits(paths, mult, cap))
+    k = ex.idx
+    out = pd.DataFrame({
+        'trade_id': paths.trade_id,
+        'exit_bar_index': paths.gather('bar_index', k).astype(int),
+        'exit_date': [pd.Timestamp(d).isoformat() for d in paths.gather('date', k)],
+        'exit_ret': ex.ret.astype(float),
+    })
 
     Path('exit_out').mkdir(parents=True, exist_ok=True)
-    out = pd.DataFrame(rows).sort_values('trade_id').reset_index(drop=True)
     suffix = f"{str(mult).replace('.','p')}_nocap" if cap is None else f"{str(mult).replace('.','p')}_cap{int(cap)}"
     out_path = Path(f"exit_out/exits_atr_{suffix}.csv")
     out.to_csv(out_path, index=False)
@@ -46,6 +47,7 @@ if __name__ == "__main__":
     ap = argparse.ArgumentParser()
     ap.add_argument("--mult", type=float, required=True)
     ap.add_argument("--cap", type=str, default="none", help="integer bars or 'none'")
+    ap.add_argument("--no-cache", action="store_true", help="recompute exits instead of reading exit_out/.cache")
     a = ap.parse_args()
     cap = None if str(a.cap).lower() in ("", "none", "null") else int(a.cap)
-    export(a.mult, cap)
+    export(a.mult, cap, use_cache=not a.no_cache)
@@ -3,14 +3,33 @@ from pathlib import Path
 import pandas as pd
 import numpy as np
 
+from modules.exit_cache import ExitCache
+from modules.exit_eval import atr_trail_exits, time_cap_exits
+from modules.exit_rules import normalize_rule
+from modules.trade_paths import open_trade_paths
+
 OUT = Path('exit_out'); OUT.mkdir(exist_ok=True, parents=True)
+BARS = Path('trade_bars.csv')
 
 # 1) Chosen exit artifacts already exist from the sweep:
 exits_csv = OUT/'exits_hybrid_atr1p25_cap6.csv'
 
-# 2) Quick per-trade stats from the chosen exits (uses the 'exit_ret' column)
-ex = pd.read_csv(exits_csv)
-rets = pd.to_numeric(ex.get('exit_ret', pd.Series(dtype=float)), errors='coerce').fillna(0.0)
+def chosen_exits(paths):
+    """ATR 1.25x breach OR 6 bars for every trade path (as hybrid_sweep / export_chosen_exit)."""
+    k, _ = atr_trail_exits(paths, [1.25], exit_bar='breach')
+    k, r = time_cap_exits(paths, [6], k[0])
+    return k[0], r[0]
+
+# 2) Quick per-trade stats from the chosen exits, over every trade path: read from the
+#    exit cache (or computed from trade_bars.csv and cached) so a warm and a cold cache
+#    score the same trades. Without trade_bars.csv, fall back to the artifact's 'exit_ret'.
+if BARS.exists():
+    chosen = normalize_rule({"family": "atr_trail", "multiplier": 1.25, "cap_bars": 6})["rule"]
+    ex = ExitCache().fetch(chosen, [BARS], lambda: chosen_exits(open_trade_paths(BARS)))
+    rets = pd.Series(ex.ret).fillna(0.0)
+else:
+    ex = pd.read_csv(exits_csv)
+    rets = pd.to_numeric(ex.get('exit_ret', pd.Series(dtype=float)), errors='coerce').fillna(0.0)
 pos = rets[rets>0].sum()
 neg = -rets[rets<0].sum()
 pf  = float('inf') if neg==0 and pos>0 else (float(pos/neg) if neg!=0 else float('nan'))
@@ -19,7 +38,7 @@ metrics = {
   "family": "atr_trail",
   "param": 1.25,
   "cap_bars": 6,
-  "trades": int(len(ex)),
+  "trades": int(len(rets)),
   "win_rate": float((rets>0).mean()),
   "pf": float(pf),
   "expectancy": float(rets.mean()),
@@ -3,11 +3,14 @@ from pathlib import Path
 import pandas as pd
 import numpy as np
 
-ROOT=Path('.'); OUT=ROOT/'exit_out'; OUT.mkdir(parents=True, exist_ok=True)
-ANN=252; FEES_BPS=5; SLIP_BPS=5; COST=(FEES_BPS+SLIP_BPS)/10000.0
+from modules.bootstrap import bootstrap_portfolio_ci
+from modules.exit_cache import ExitCache
+from modules.exit_eval import atr_trail_exits, time_cap_exits
+from modules.exit_rules import normalize_rule
+from modules.trade_paths import open_trade_paths
 
-bars  = pd.read_csv('trade_bars.csv', parse_dates=['date'])
-atrx  = pd.read_csv(OUT/'exits_atr_1p25_nocap.csv', parse_dates=['exit_date'])
+ROOT=Path('.'); OUT=ROOT/'exit_out'
+ANN=252; FEES_BPS=5; SLIP_BPS=5; COST=(FEES_BPS+SLIP_BPS)/10000.0
 
 def pf(s):
     pos=s[s>0].sum(); neg=-s[s<0].sum()
@@ -21,42 +24,158 @@ def ann_stats(rets, eq):
     mdd=float((eq/eq.cummax()-1).min()); calmar=(cagr/abs(mdd)) if mdd<0 else float('inf')
     return m, sd*np.sqrt(ANN) if sd==sd else float('nan'), sh, so, cagr, mdd, calmar
 
-def run_cap(cap):
-    hyb = atrx[['trade_id','exit_bar_index']].rename(columns={'exit_bar_index':'atr_idx'}).copy()
-    hyb['hyb_idx'] = np.minimum(hyb['atr_idx'].astype(int), cap)
-
-    pick = bars[['trade_id','bar_index','date','ret_from_entry']].rename(columns={'bar_index':'hyb_idx'})
-    hyb = hyb.merge(pick, on=['trade_id','hyb_idx'], how='left', validate='one_to_one')
-    hyb.rename(columns={'date':'exit_date','ret_from_entry':'exit_ret'}, inplace=True)
-    hyb_out = hyb[['trade_id','hyb_idx','exit_date','exit_ret']].rename(columns={'hyb_idx':'exit_bar_index'})
-    hyb_out.to_csv(OUT/f'exits_hybrid_atr1p25_cap{cap}.csv', index=False)
-
-    bb = bars.merge(hyb_out[['trade_id','exit_bar_index']], on='trade_id', how='left')
-    bb = bb[bb['bar_index'] <= bb['exit_bar_index']].copy().sort_values(['trade_id','bar_index'])
-    bb['ret_from_entry']=pd.to_numeric(bb['ret_from_entry'], errors='coerce').fillna(0.0)
-    prev = bb.groupby('trade_id')['ret_from_entry'].shift().fillna(0.0)
-    bb['inc']=(1+bb['ret_from_entry'])/(1+prev)-1
-    bb.loc[bb['bar_index'].eq(bb['exit_bar_index']), 'inc'] -= COST
-    bb['inc']=bb['inc'].replace([np.inf,-np.inf], np.nan).fillna(0.0)
-
-    by_date=(bb.groupby('date')['inc'].mean().rename('ret')).to_frame().sort_index()
-    eq=(1+by_date['ret']).cumprod()
-
-    # VT10 with 60d lookback, 3x cap
-    rv = by_date['ret'].rolling(60, min_periods=30).std(ddof=1)*np.sqrt(ANN)
-    lev = (0.10/rv).clip(0,3.0).fillna(0.0)
-    vt_ret = by_date['ret']*lev
-    vt_eq=(1+vt_ret).cumprod()
-
-    m, volA, sh, so, cagr, mdd, calmar = ann_stats(vt_ret, vt_eq)
-    metrics=dict(cap=cap, pf=float(pf(vt_ret)), sharpe=float(sh), sortino=float(so),
-                 vol_annual=float(volA), cagr=float(cagr), mdd=float(mdd),
-                 calmar=float(calmar), avg_leverage=float(lev.mean()))
-    (OUT/f'portfolio_metrics_costed_hyb_cap{cap}_vt10.json').write_text(json.dumps(metrics, indent=2))
-    return metrics
-
-caps=[6,8,10,12]
-rows=[run_cap(c) for c in caps]
-df=pd.DataFrame(rows).sort_values(['calmar','sharpe'], ascending=[False,False])
-df.to_csv(OUT/'hybrid_sweep_vt10.csv', index=False)
-print(df.to_string(index=False))
+def inc_panel(paths):
+    """Per-bar incremental return (1+r_t)/(1+r_{t-1})-1 over the flat paths; r_{-1}=0 at each entry."""
+    r = np.nan_to_num(np.asarray(paths['ret_from_entry'], dtype=float), nan=0.0, posinf=np.inf, neginf=-np.inf)
+    prev = np.r_[0.0, r[:-1]]
+    prev[paths.starts()[paths.lengths() > 0]] = 0.0
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return (1+r)/(1+prev)-1
+
+def daily_matrix(paths, exit_bi, caps, inc, cost=COST):
+    """
+    (caps x dates) equal-weight daily return of the ATR-or-cap exits, one bincount per cap.
+    exit_bi: per-trade ATR exit bar_index (NaN = trade not exited -> excluded).
+    Returns (dates, ret[caps, dates], present[caps, dates]).
+    """
+    dates, day = np.unique(np.asarray(paths['date']), return_inverse=True)
+    seg = paths.segment_ids()
+    bi = np.asarray(paths['bar_index'])
+    ok = np.isfinite(inc)
+    ret = np.zeros((len(caps), len(dates))); present = np.zeros((len(caps), len(dates)), dtype=bool)
+    for k, cap in enumerate(caps):
+        x = np.minimum(exit_bi, cap)[seg]
+        live = bi <= x  # NaN exit -> False
+        w = np.where(ok, inc - cost*(bi == x), 0.0)
+        s = np.bincount(day[live], weights=w[live], minlength=len(dates))
+        n = np.bincount(day[live], minlength=len(dates))
+        present[k] = n > 0
+        ret[k, present[k]] = s[present[k]]/n[present[k]]
+    return dates, ret, present
+
+def rolling_std(x, seg, window, min_periods):
+    """Trailing rolling std (ddof=1) of a flat array that restarts at every segment."""
+    i = np.arange(len(x))
+    first = np.r_[0, np.flatnonzero(np.diff(seg)) + 1]
+    lo = np.maximum(i - window + 1, first[np.cumsum(np.r_[0, np.diff(seg) != 0])])
+    c1 = np.r_[0.0, np.cumsum(x)]; c2 = np.r_[0.0, np.cumsum(x*x)]
+    cnt = i - lo + 1
+    s1 = c1[i+1] - c1[lo]; s2 = c2[i+1] - c2[lo]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        var = np.maximum((s2 - s1*s1/cnt)/(cnt-1), 0.0)
+    return np.where(cnt >= max(min_periods, 2), np.sqrt(var), np.nan)
+
+def vol_target(ret, present, targets, lookback=60, min_periods=30, max_lev=3.0):
+    """
+    Leverage for every cap and vol target at once, on each cap's own date series
+    (dates where it holds at least one trade). Returns flat (cap id, ret, lev[targets, n]).
+    """
+    seg = np.nonzero(present)[0]
+    x = ret[present]
+    rv = rolling_std(x, seg, lookback, min_periods)*np.sqrt(ANN)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        lev = np.clip(np.asarray(targets, dtype=float)[:, None]/rv[None, :], 0, max_lev)
+    return seg, x, np.nan_to_num(lev, nan=0.0)
+
+def atr_tag(mult):
+    """File tag of an ATR multiplier: 1.25 -> 'atr1p25' (the CSV-driven sweep's names)."""
+    return 'atr' + f'{mult:g}'.replace('.', 'p')
+
+def name_suffix(mult):
+    """Summary/metrics file suffix: none for the default 1.25x sweep, '_atr2' etc. otherwise."""
+    return '' if mult is None or atr_tag(mult) == 'atr1p25' else '_' + atr_tag(mult)
+
+def atr_rule(mult, cap=None):
+    """Cache key of the ATR breach exit (optionally capped), as in exit_out/exit_rule.json."""
+    return normalize_rule({'family': 'atr_trail', 'multiplier': mult, 'cap_bars': cap})['rule']
+
+def cached_atr_exits(paths, mult, caps, cache, bars_csv):
+    """
+    Within-trade ATR breach exit per trade (what export_chosen_exit --cap none writes)
+    from the exit cache; the ATR-or-cap exits for every cap are cached alongside.
+    """
+    first = lambda kr: (kr[0][0], kr[1][0])
+    k_atr = cache.fetch(atr_rule(mult), [bars_csv], lambda: first(atr_trail_exits(paths, [mult], exit_bar='breach'))).idx
+    for cap in caps:
+        cache.fetch(atr_rule(mult, cap), [bars_csv], lambda: first(time_cap_exits(paths, [cap], k_atr)))
+    return k_atr
+
+def write_hybrid_exits(paths, exit_bi, cap, atr='atr1p25'):
+    """exits_hybrid_{atr}_cap{cap}.csv for one cap (trades with an ATR exit only)."""
+    has = ~np.isnan(exit_bi)
+    k, r = time_cap_exits(paths, [cap], np.where(has, exit_bi, 0))
+    hyb_out = pd.DataFrame({'trade_id': paths.trade_id[has], 'exit_bar_index': k[0][has],
+                            'exit_date': paths.gather('date', k[0])[has],
+                            'exit_ret': r[0][has]})
+    hyb_out.to_csv(OUT/f'exits_hybrid_{atr}_cap{cap}.csv', index=False)
+
+def sweep(caps, targets, exits_csv=OUT/'exits_atr_1p25_nocap.csv', bars_csv='trade_bars.csv',
+          lookback=60, max_lev=3.0, per_cap_files=True, bootstrap=0, block=20, mult=None, cache=None):
+    """
+    mult: take the ATR exits from the exit cache (computed from the bars if missing)
+    instead of exits_csv; the per-cap hybrid exits are then cached under the
+    ATR-or-cap rule as well, and the output files are named after mult
+    (exits_csv is taken to hold the 1.25x exits).
+    """
+    atr, sfx = atr_tag(1.25 if mult is None else mult), name_suffix(mult)
+    paths = open_trade_paths(bars_csv)
+    if mult is None:
+        atrx  = pd.read_csv(exits_csv, parse_dates=['exit_date'])
+        exit_bi = pd.Series(atrx['exit_bar_index'].astype(float).values, index=atrx['trade_id']).reindex(paths.trade_id).to_numpy()
+    else:
+        k = cached_atr_exits(paths, mult, caps, cache or ExitCache(), bars_csv)
+        exit_bi = paths.gather('bar_index', k).astype(float)
+
+    dates, ret, present = daily_matrix(paths, exit_bi, caps, inc_panel(paths))
+    seg, x, lev = vol_target(ret, present, targets, lookback=lookback, max_lev=max_lev)
+    bounds = np.searchsorted(seg, np.arange(len(caps)+1))
+
+    rows=[]
+    for k, cap in enumerate(caps):
+        a, b = bounds[k], bounds[k+1]
+        if per_cap_files:
+            write_hybrid_exits(paths, exit_bi, cap, atr)
+        for v, vt in enumerate(targets):
+            vt_ret = pd.Series(x[a:b]*lev[v, a:b], index=dates[present[k]])
+            vt_eq=(1+vt_ret).cumprod()
+            m, volA, sh, so, cagr, mdd, calmar = ann_stats(vt_ret, vt_eq)
+            metrics=dict(cap=cap, pf=float(pf(vt_ret)), sharpe=float(sh), sortino=float(so),
+                         vol_annual=float(volA), cagr=float(cagr), mdd=float(mdd),
+                         calmar=float(calmar), avg_leverage=float(lev[v, a:b].mean()))
+            tag = f'vt{int(round(vt*100))}'
+            if per_cap_files:
+                (OUT/f'portfolio_metrics_costed_hyb{sfx}_cap{cap}_{tag}.json').write_text(json.dumps(metrics, indent=2))
+            ci = bootstrap_portfolio_ci(vt_ret.to_numpy(), bootstrap, block=block, ann=ANN) if bootstrap > 0 else {}
+            rows.append(dict(metrics, vol_target=vt, **ci))
+    return pd.DataFrame(rows)
+
+def main():
+    ap = argparse.ArgumentParser(description="ATR (1.25 or --mult) OR time-cap hybrid sweep with vol-targeted equal-weight portfolio.")
+    ap.add_argument("--caps", nargs="+", type=int, default=[6,8,10,12])
+    ap.add_argument("--vol-targets", nargs="+", type=float, default=[0.10])
+    ap.add_argument("--lookback", type=int, default=60)
+    ap.add_argument("--max-lev", type=float, default=3.0)
+    ap.add_argument("--exits", default=str(OUT/'exits_atr_1p25_nocap.csv'))
+    ap.add_argument("--bars", default="trade_bars.csv")
+    ap.add_argument("--mult", type=float, default=None,
+                    help="ATR multiplier: read the ATR exits from exit_out/.cache (built from --bars if missing) instead of --exits")
+    ap.add_argument("--no-cache", action="store_true", help="with --mult, recompute instead of reading exit_out/.cache")
+    ap.add_argument("--bootstrap", type=int, default=0, help="date-block resamples for percentile CIs, e.g. 1000 (default 0 = off)")
+    ap.add_argument("--block", type=int, default=20, help="bootstrap block length in days")
+    ap.add_argument("--summary-only", action="store_true", help="skip per-cap exits/metrics files (large grids)")
+    a = ap.parse_args()
+    OUT.mkdir(parents=True, exist_ok=True)
+
+    df = sweep(a.caps, a.vol_targets, a.exits, a.bars, a.lookback, a.max_lev, per_cap_files=not a.summary_only,
+               bootstrap=a.bootstrap, block=a.block, mult=a.mult, cache=ExitCache(enabled=not a.no_cache))
+    sfx = name_suffix(a.mult)
+    if a.vol_targets == [0.10]:
+        df = df.drop(columns='vol_target').sort_values(['calmar','sharpe'], ascending=[False,False])
+        df.to_csv(OUT/f'hybrid_sweep{sfx}_vt10.csv', index=False)
+    else:
+        df = df.sort_values(['calmar','sharpe'], ascending=[False,False])
+        df.to_csv(OUT/f'hybrid_sweep{sfx}_grid.csv', index=False)
+    print(df.to_string(index=False))
+
+if __name__ == "__main__":
+    main()
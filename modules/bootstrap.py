@@ -0,0 +1,149 @@
+
+# modules/bootstrap.py
+
+from __future__ import annotations
+
+from typing import Sequence
+
+import numpy as np
+import pandas as pd
+
+__all__ = [
+    "trade_resample_index",
+    "block_resample_index",
+    "trade_metric_samples",
+    "portfolio_metric_samples",
+    "bootstrap_trade_ci",
+    "bootstrap_portfolio_ci",
+]
+
+TRADE_METRICS = ("pf", "expectancy", "mdd", "sharpe", "calmar")
+PORTFOLIO_METRICS = ("pf", "mean", "mdd", "sharpe", "calmar")
+
+
+# ---------- helpers
+
+def _pf(S: np.ndarray) -> np.ndarray:
+    pos = np.where(S > 0, S, 0.0).sum(axis=-1)
+    neg = -np.where(S < 0, S, 0.0).sum(axis=-1)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return np.where(neg == 0, np.where(pos > 0, np.inf, np.nan), pos / neg)
+
+
+def _mdd(S: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+    """(max drawdown, final equity) of the compounded rows of S."""
+    eq = np.cumprod(1 + S, axis=-1)
+    return (eq / np.maximum.accumulate(eq, axis=-1) - 1).min(axis=-1), eq[..., -1]
+
+
+def _ci(samples: dict[str, np.ndarray], alpha: float) -> dict[str, float]:
+    """
+    Percentile interval per metric. Infinite resamples (PF with no losing trade,
+    Calmar with no drawdown) stay in the ranking, so an end can be inf rather than
+    the interval shifting; undefined (NaN) resamples are left out and counted in
+    {metric}_n_nan.
+    """
+    out = {}
+    for k, v in samples.items():
+        nan = np.isnan(v)
+        v = v[~nan]
+        lo, hi = (np.quantile(v, [alpha / 2, 1 - alpha / 2], method="inverted_cdf") if len(v) else (np.nan, np.nan))
+        out[f"{k}_lo"], out[f"{k}_hi"], out[f"{k}_n_nan"] = float(lo), float(hi), int(nan.sum())
+    return out
+
+
+# ---------- resampling index matrices
+
+def trade_resample_index(n: int, B: int, rng: np.random.Generator) -> np.ndarray:
+    """(B, n) iid draws of trade positions, sorted per row so curves stay in time order."""
+    return np.sort(rng.integers(0, n, size=(B, n)), axis=1)
+
+
+def block_resample_index(n: int, B: int, block: int, rng: np.random.Generator) -> np.ndarray:
+    """(B, n) circular moving-block draws of consecutive days (keeps short-range dependence)."""
+    block = max(1, min(int(block), n))
+    k = -(-n // block)
+    starts = rng.integers(0, n, size=(B, k))
+    return ((starts[:, :, None] + np.arange(block)[None, None, :]) % n).reshape(B, -1)[:, :n]
+
+
+# ---------- metric samples
+
+def trade_metric_samples(rets: np.ndarray, idx: np.ndarray) -> dict[str, np.ndarray]:
+    """
+    PF, expectancy, MDD, per-trade Sharpe (mean/std) and Calmar (total return / |MDD|)
+    for every resample row of idx over one return vector.
+    """
+    S = np.asarray(rets, dtype=np.float64)[idx]
+    mdd, final = _mdd(S)
+    sd = S.std(axis=-1, ddof=1)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return {
+            "pf": _pf(S),
+            "expectancy": S.mean(axis=-1),
+            "mdd": mdd,
+            "sharpe": np.where(sd > 0, S.mean(axis=-1) / sd, np.nan),
+            "calmar": np.where(mdd < 0, (final - 1) / np.abs(mdd), np.inf),
+        }
+
+
+def portfolio_metric_samples(daily: np.ndarray, idx: np.ndarray, ann: int = 252) -> dict[str, np.ndarray]:
+    """Annualized Sharpe/Calmar (CAGR / |MDD|), PF, mean and MDD of resampled daily curves."""
+    S = np.asarray(daily, dtype=np.float64)[idx]
+    mdd, final = _mdd(S)
+    m, sd = S.mean(axis=-1), S.std(axis=-1, ddof=1)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        cagr = final ** (ann / S.shape[-1]) - 1.0
+        return {
+            "pf": _pf(S),
+            "mean": m,
+            "mdd": mdd,
+            "sharpe": np.where(sd > 0, m / sd * np.sqrt(ann), np.nan),
+            "calmar": np.where(mdd < 0, cagr / np.abs(mdd), np.inf),
+        }
+
+
+# ---------- main API
+
+def bootstrap_trade_ci(
+    R: np.ndarray,
+    B: int = 1000,
+    *,
+    alpha: float = 0.05,
+    seed: int = 0,
+    max_cells: int = 20_000_000,
+) -> pd.DataFrame:
+    """
+    Trade-level bootstrap CIs for every row of R (combinations x trades, time-ordered).
+    All rows share one resample index matrix, so CIs are comparable across rows;
+    resamples are processed in chunks of at most max_cells values.
+    """
+    R = np.atleast_2d(np.asarray(R, dtype=np.float64))
+    n = R.shape[-1]
+    cols = [f"{k}_{s}" for k in TRADE_METRICS for s in ("lo", "hi", "n_nan")]
+    if n < 2 or B <= 0:
+        return pd.DataFrame(np.nan, index=range(len(R)), columns=cols)
+    idx = trade_resample_index(n, B, np.random.default_rng(seed))
+    step = max(1, max_cells // n)
+    rows = []
+    for r in R:
+        parts = [trade_metric_samples(r, idx[i:i + step]) for i in range(0, B, step)]
+        rows.append(_ci({k: np.concatenate([p[k] for p in parts]) for k in TRADE_METRICS}, alpha))
+    return pd.DataFrame(rows, columns=cols)
+
+
+def bootstrap_portfolio_ci(
+    daily: Sequence[float],
+    B: int = 1000,
+    *,
+    block: int = 20,
+    alpha: float = 0.05,
+    ann: int = 252,
+    seed: int = 0,
+) -> dict[str, float]:
+    """Block-bootstrap (by date) CIs for one daily portfolio return series."""
+    daily = np.asarray(daily, dtype=np.float64)
+    if len(daily) < 2 or B <= 0:
+        return {f"{k}_{s}": np.nan for k in PORTFOLIO_METRICS for s in ("lo", "hi", "n_nan")}
+    idx = block_resample_index(len(daily), B, block, np.random.default_rng(seed))
+    return _ci(portfolio_metric_samples(daily, idx, ann), alpha)
@@ -0,0 +1,187 @@
+
+# modules/exit_cache.py
+
+from __future__ import annotations
+
+import hashlib
+import io
+import json
+import sqlite3
+from contextlib import closing
+from dataclasses import dataclass
+from datetime import datetime
+from pathlib import Path
+from typing import Any, Callable, Mapping, Sequence
+
+import numpy as np
+
+__all__ = [
+    "CACHE_DIR",
+    "CachedExits",
+    "ExitCache",
+    "rule_hash",
+    "input_fingerprint",
+]
+
+CACHE_VERSION = 1
+CACHE_DIR = Path("exit_out") / ".cache"
+
+
+# ---------- helpers
+
+def _canonical(obj: Any) -> Any:
+    """JSON-stable form: sorted keys, numbers as floats, sets sorted, numpy scalars unboxed."""
+    if isinstance(obj, np.generic):
+        obj = obj.item()
+    if isinstance(obj, Mapping):
+        return {str(k): _canonical(v) for k, v in sorted(obj.items(), key=lambda kv: str(kv[0]))}
+    if isinstance(obj, (set, frozenset)):
+        return sorted(_canonical(v) for v in obj)
+    if isinstance(obj, (list, tuple, np.ndarray)):
+        return [_canonical(v) for v in obj]
+    if isinstance(obj, bool) or obj is None or isinstance(obj, str):
+        return obj
+    if isinstance(obj, (int, float)):
+        return float(obj)
+    return str(obj)
+
+
+def _sha(obj: Any) -> str:
+    text = json.dumps(_canonical(obj), sort_keys=True, separators=(",", ":"))
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+def _stamp(p: Path) -> dict:
+    """Size + mtime of a file, or of every file under a directory (e.g. a .paths/ store)."""
+    files = sorted(f for f in p.rglob("*") if f.is_file()) if p.is_dir() else [p]
+    return {str(f.relative_to(p) if p.is_dir() else f.name): [f.stat().st_size, f.stat().st_mtime_ns] for f in files}
+
+
+def _pack(**arrays: np.ndarray) -> bytes:
+    buf = io.BytesIO()
+    np.savez(buf, **arrays)
+    return buf.getvalue()
+
+
+def _unpack(blob: bytes) -> dict[str, np.ndarray]:
+    with np.load(io.BytesIO(blob), allow_pickle=False) as z:
+        return {k: z[k] for k in z.files}
+
+
+# ---------- main API
+
+def rule_hash(rule: Mapping) -> str:
+    """Canonical hash of a rule's parameters (key order and 6 vs 6.0 do not matter)."""
+    return _sha({"version": CACHE_VERSION, "rule": rule})
+
+
+def input_fingerprint(inputs: Sequence[str | Path]) -> tuple[list[str], str]:
+    """(resolved input paths, hash of their size/mtime stamps); changes whenever an input is rewritten."""
+    paths = [Path(p).resolve() for p in inputs]
+    return [str(p) for p in paths], _sha([[str(p), _stamp(p)] for p in paths])
+
+
+@dataclass(frozen=True)
+class CachedExits:
+    """Per-trade exit index and return (plus exit label when the rule has one; None comes back as ""), in input order."""
+    idx: np.ndarray
+    ret: np.ndarray
+    kind: np.ndarray | None = None
+
+
+class ExitCache:
+    """
+    Exit evaluations persisted in <root>/exits.sqlite, keyed by rule_hash(rule)
+    and the fingerprint of the input files the exits were computed from.
+
+    A rewritten input changes the fingerprint, so stale results are never
+    returned; they are dropped the next time the same rule is stored for the
+    same input paths. enabled=False turns every lookup into a miss and every
+    store into a no-op.
+    """
+
+    def __init__(self, root: str | Path = CACHE_DIR, *, enabled: bool = True):
+        self.root = Path(root)
+        self.enabled = enabled
+        self.hits = 0
+        self.misses = 0
+        self._fp: dict[tuple, tuple[list[str], str]] = {}
+
+    def stats(self) -> str:
+        return f"{self.hits} exit rules from cache, {self.misses} computed"
+
+    def _connect(self) -> sqlite3.Connection:
+        self.root.mkdir(parents=True, exist_ok=True)
+        con = sqlite3.connect(self.root / "exits.sqlite")
+        con.execute("""CREATE TABLE IF NOT EXISTS exits (
+            rule_hash TEXT, data_hash TEXT, inputs TEXT, rule TEXT,
+            n INTEGER, created TEXT, arrays BLOB,
+            PRIMARY KEY (rule_hash, data_hash))""")
+        return con
+
+    def _fingerprint(self, inputs: Sequence[str | Path]) -> tuple[list[str], str]:
+        # stamps are taken once per input set, so a long run sees one consistent fingerprint
+        k = tuple(str(p) for p in inputs)
+        if k not in self._fp:
+            self._fp[k] = input_fingerprint(inputs)
+        return self._fp[k]
+
+    def get(self, rule: Mapping, inputs: Sequence[str | Path]) -> CachedExits | None:
+        if not self.enabled:
+            return None
+        _, data = self._fingerprint(inputs)
+        with closing(self._connect()) as con, con:
+            row = con.execute("SELECT arrays FROM exits WHERE rule_hash=? AND data_hash=?",
+                              (rule_hash(rule), data)).fetchone()
+        if row is None:
+            return None
+        self.hits += 1
+        a = _unpack(row[0])
+        return CachedExits(a["idx"], a["ret"], a["kind"].astype(object) if "kind" in a else None)
+
+    def put(self, rule: Mapping, inputs: Sequence[str | Path], idx, ret, kind=None) -> None:
+        if not self.enabled:
+            return
+        paths, data = self._fingerprint(inputs)
+        arrays = {"idx": np.asarray(idx, dtype=np.int64), "ret": np.asarray(ret, dtype=np.float64)}
+        if kind is not None:
+            arrays["kind"] = np.asarray(["" if k is None else str(k) for k in kind])
+        rh, where = rule_hash(rule), json.dumps(paths)
+        with closing(self._connect()) as con, con:
+            con.execute("DELETE FROM exits WHERE rule_hash=? AND inputs=? AND data_hash<>?", (rh, where, data))
+            con.execute("INSERT OR REPLACE INTO exits VALUES (?,?,?,?,?,?,?)",
+                        (rh, data, where, json.dumps(_canonical(rule)), len(arrays["idx"]),
+                         datetime.now().isoformat(timespec="seconds"), _pack(**arrays)))
+
+    def fetch(self, rule: Mapping, inputs: Sequence[str | Path], compute: Callable[[], tuple]) -> CachedExits:
+        """Cached exits for rule, else compute() -> (idx, ret[, kind]) stored and returned."""
+        hit = self.get(rule, inputs)
+        if hit is not None:
+            return hit
+        self.misses += 1
+        out = CachedExits(*compute())
+        self.put(rule, inputs, out.idx, out.ret, out.kind)
+        return out
+
+    def fetch_many(
+        self,
+        rules: Sequence[Mapping],
+        inputs: Sequence[str | Path],
+        compute: Callable[[list[int]], tuple[np.ndarray, np.ndarray]],
+    ) -> tuple[np.ndarray, np.ndarray]:
+        """
+        (idx, ret) as (n_rules, n_trades) for a family evaluated in one vectorized
+        pass: compute(missing) gets the positions of the uncached rules and returns
+        their rows, so only those are evaluated.
+        """
+        if not rules:
+            return np.empty((0, 0), dtype=np.int64), np.empty((0, 0))
+        got = [self.get(r, inputs) for r in rules]
+        missing = [i for i, g in enumerate(got) if g is None]
+        if missing:
+            self.misses += len(missing)
+            idx, ret = compute(missing)
+            for j, i in enumerate(missing):
+                got[i] = CachedExits(idx[j], ret[j])
+                self.put(rules[i], inputs, idx[j], ret[j])
+        return np.vstack([g.idx for g in got]), np.vstack([g.ret for g in got])
@@ -0,0 +1,147 @@
+
+# modules/exit_eval.py
+
+from __future__ import annotations
+
+from typing import Sequence
+
+import numpy as np
+import pandas as pd
+
+from .trade_paths import TradePaths
+
+__all__ = [
+    "segmented_cummax",
+    "first_true",
+    "atr_trail_exits",
+    "time_cap_exits",
+    "profit_factor_rows",
+    "equity_metrics_rows",
+]
+
+
+# ---------- helpers
+
+def _segment_ids(offsets: np.ndarray) -> np.ndarray:
+    return np.repeat(np.arange(len(offsets) - 1), np.diff(offsets))
+
+
+# ---------- main API
+
+def segmented_cummax(x: np.ndarray, offsets: np.ndarray) -> np.ndarray:
+    """
+    Running max of a flat array that restarts at every segment start.
+
+    Exact (works on integer ranks, not shifted floats) and matches
+    np.maximum.accumulate per segment, including NaN propagation.
+    """
+    x = np.asarray(x, dtype=np.float64)
+    n = len(x)
+    order = np.argsort(x, kind="stable")  # NaN sorts last -> highest rank, so it propagates
+    rank = np.empty(n, dtype=np.int64)
+    rank[order] = np.arange(n)
+    shift = _segment_ids(offsets) * n
+    run = np.maximum.accumulate(rank + shift) - shift
+    return x[order[run]]
+
+
+def first_true(mask: np.ndarray, offsets: np.ndarray) -> np.ndarray:
+    """
+    Within-segment index of the first True per segment (-1 if none).
+    mask is (n_bars,) or (k, n_bars); the result is (n_seg,) or (k, n_seg).
+    """
+    mask = np.asarray(mask, dtype=bool)
+    lengths = np.diff(offsets)
+    within = np.arange(mask.shape[-1]) - np.repeat(offsets[:-1], lengths)
+    big = np.iinfo(np.int64).max
+    cand = np.where(mask, within, big)
+    out = np.full(mask.shape[:-1] + (len(lengths),), -1, dtype=np.int64)
+    nz = lengths > 0
+    if nz.any():
+        m = np.minimum.reduceat(cand, offsets[:-1][nz], axis=-1)
+        out[..., nz] = np.where(m == big, -1, m)
+    return out
+
+
+def atr_trail_exits(
+    paths: TradePaths,
+    multipliers: Sequence[float],
+    *,
+    exit_bar: str = "prior",
+) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Chandelier trail for every (multiplier, trade) in one pass.
+
+    trail = running max(close) - mult * atr; the first bar with close < trail
+    is the breach. exit_bar="prior" exits on the bar before the breach
+    (exit_harness / exit_oos_check), "breach" on the breach bar itself
+    (export_chosen_exit). Trades that never breach exit on their last bar.
+    Returns (exit_idx, exit_ret), both (n_multipliers, n_trades).
+    """
+    if exit_bar not in ("prior", "breach"):
+        raise ValueError(f"exit_bar must be 'prior' or 'breach', got {exit_bar!r}")
+    c = np.asarray(paths["close"], dtype=np.float64)
+    a = np.asarray(paths["atr"], dtype=np.float64)
+    mult = np.asarray(multipliers, dtype=np.float64).reshape(-1, 1)
+
+    trail = segmented_cummax(c, paths.offsets)[None, :] - mult * a[None, :]
+    hit = first_true(c[None, :] < trail, paths.offsets)
+    if exit_bar == "prior":
+        idx = np.where(hit >= 0, np.maximum(hit - 1, 0), paths.last_index()[None, :])
+    else:
+        idx = np.where(hit >= 0, hit, paths.last_index()[None, :])
+    return idx, paths.gather("ret_from_entry", idx)
+
+
+def time_cap_exits(
+    paths: TradePaths,
+    caps: Sequence[int],
+    base_idx: np.ndarray | None = None,
+) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Exit at bar min(cap, base_idx, last) of every trade for every cap: one
+    fancy index at offsets[t] + min(n, len[t]-1). base_idx (per trade) turns
+    this into "base rule OR time cap". Returns (exit_idx, exit_ret), (n_caps, n_trades).
+    """
+    last = paths.last_index()
+    base = last if base_idx is None else np.minimum(np.asarray(base_idx, dtype=np.int64), last)
+    caps = np.maximum(np.asarray(caps, dtype=np.int64).reshape(-1, 1), 0)
+    idx = np.minimum(base[None, :], caps)
+    return idx, paths.gather("ret_from_entry", idx)
+
+
+# ---------- metrics over (combinations x trades) return matrices
+
+def profit_factor_rows(R: np.ndarray) -> np.ndarray:
+    """Gross win / gross loss per row (inf if no losses and some wins, NaN if flat)."""
+    R = np.atleast_2d(R)
+    pos = np.where(R > 0, R, 0.0).sum(axis=-1)
+    neg = -np.where(R < 0, R, 0.0).sum(axis=-1)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return np.where(neg == 0, np.where(pos > 0, np.inf, np.nan), pos / neg)
+
+
+def equity_metrics_rows(R: np.ndarray, dates=None) -> pd.DataFrame:
+    """
+    Trade-level metrics for every row of R at once: trades, win rate, pf
+    (profit_factor_rows), mean / median return and the max drawdown of the
+    compounded equity curve; with dates, the curve runs in date order.
+    """
+    R = np.atleast_2d(np.asarray(R, dtype=np.float64))
+    n = R.shape[-1]
+    if dates is not None:
+        R = R[:, pd.Series(np.arange(n), index=pd.to_datetime(dates)).sort_index().to_numpy()]
+    if n == 0:
+        nan = np.full(len(R), np.nan)
+        return pd.DataFrame({"trades": 0, "win_rate": nan, "pf": profit_factor_rows(R),
+                             "expectancy": nan, "median_ret": nan, "mdd": nan})
+    eq = np.cumprod(1 + R, axis=-1)
+    dd = eq / np.maximum.accumulate(eq, axis=-1) - 1
+    return pd.DataFrame({
+        "trades": n,
+        "win_rate": (R > 0).mean(axis=-1),
+        "pf": profit_factor_rows(R),
+        "expectancy": np.nanmean(R, axis=-1),
+        "median_ret": np.nanmedian(R, axis=-1),
+        "mdd": dd.min(axis=-1),
+    })
@@ -0,0 +1,159 @@
+
+# modules/exit_grid.py
+
+from __future__ import annotations
+
+from itertools import product
+from typing import Any, Callable, Hashable, Mapping, Sequence
+
+import numpy as np
+
+from .exit_kernels import (
+    NO_HIT,
+    adx_drop_day,
+    bbw_contract_day,
+    close_return,
+    first_hit,
+    macd_hist_day,
+    macd_hist_mask,
+    peak_drop_mask,
+    peak_retrace_day,
+    rsi_cross_day,
+    running_peak,
+    tp_hit_day,
+)
+
+__all__ = [
+    "ExitGrid",
+    "run_grid",
+]
+
+# ---------- main API
+
+class ExitGrid:
+    """
+    Memoized sub-results for exit parameter grids over one set of (N, T) panels.
+
+    Each intermediate is a node keyed by the parameters it actually depends on,
+    so a (Y, Delta, M, family, param) grid computes e.g. the TP day once, the
+    RSI cross once per (Y, M), the retrace once per (Y, M, Delta) and each
+    confirm once per (family, param), then combines them with cheap array ops.
+    Panels: rsi, high, close, macd, macd_signal, adx, bbw (as needed).
+    """
+
+    def __init__(
+        self,
+        panels: Mapping[str, np.ndarray],
+        start: np.ndarray | None = None,
+        cap_idx: np.ndarray | None = None,
+    ):
+        self.panels = panels
+        self.start = None if start is None else np.asarray(start, dtype=float)
+        self.cap_idx = None if cap_idx is None else np.asarray(cap_idx)
+        self._memo: dict[Hashable, Any] = {}
+        self.hits = 0
+        self.misses = 0
+
+    def node(self, key: Hashable, compute: Callable[[], Any]) -> Any:
+        """compute() once per key; later calls reuse the stored result."""
+        if key in self._memo:
+            self.hits += 1
+            return self._memo[key]
+        self.misses += 1
+        out = self._memo[key] = compute()
+        return out
+
+    def stats(self) -> str:
+        return f"{self.misses} nodes computed, {self.hits} reused"
+
+    # --- trade-only nodes
+
+    def tp_day(self, tp: np.ndarray, *, mode: str = "ratio", capped: bool = True) -> np.ndarray:
+        tp = np.asarray(tp, dtype=float)
+        cap = self.cap_idx if capped else None
+        return self.node(("tp", mode, capped, tp.tobytes()),
+                         lambda: tp_hit_day(self.panels["high"], self.start, tp, cap, mode=mode))
+
+    def ret_at(self, key: Hashable, t: np.ndarray, panel: str = "close") -> np.ndarray:
+        """panel[i, t]/start - 1 (NaN past the panel or for NO_HIT), stored under key."""
+        X = self.panels[panel]
+        return self.node(("ret_at", panel, key),
+                         lambda: close_return(X, self.start, np.where(np.asarray(t) < X.shape[1], t, NO_HIT)))
+
+    # --- RSI nodes
+
+    def rsi_peak(self) -> np.ndarray:
+        return self.node(("rsi_peak",), lambda: running_peak(self.panels["rsi"]))
+
+    def rsi_cross(self, Y: float, M: int, *, block_within_cap: bool = False) -> np.ndarray:
+        return self.node(("rsi_cross", Y, M, block_within_cap),
+                         lambda: rsi_cross_day(self.panels["rsi"], Y, M, self.cap_idx, block_within_cap=block_within_cap))
+
+    def rsi_retrace(self, Y: float, M: int, delta: float, *, block_within_cap: bool = False) -> np.ndarray:
+        """Delta off the running peak from the (Y, M) cross."""
+        return self.node(("rsi_retrace", Y, M, delta, block_within_cap), lambda: peak_retrace_day(
+            self.panels["rsi"], delta, start_idx=self.rsi_cross(Y, M, block_within_cap=block_within_cap),
+            cap_idx=self.cap_idx))
+
+    def rsi_momentum_mask(self, Y: float, delta: float, Z: float | None = None, M: int = 0) -> np.ndarray:
+        """
+        momentum_retrace_mask built from shared peak / (Y) / (delta, Z) nodes;
+        the combined (N, T) mask itself is not kept.
+        """
+        R = self.panels["rsi"]
+        armed = self.node(("rsi_armed", Y), lambda: np.isfinite(R) & (self.rsi_peak() >= Y))
+        trig = self.node(("rsi_trig", delta, Z), lambda: self._rsi_trigger(delta, Z))
+        return armed & trig & (np.arange(R.shape[1])[None, :] >= M)
+
+    def rsi_momentum_day(self, Y: float, delta: float, Z: float | None = None, M: int = 0) -> np.ndarray:
+        return self.node(("rsi_momentum_day", Y, delta, Z, M),
+                         lambda: first_hit(self.rsi_momentum_mask(Y, delta, Z, M), self.cap_idx))
+
+    def _rsi_trigger(self, delta: float, Z: float | None) -> np.ndarray:
+        R = self.panels["rsi"]
+        with np.errstate(invalid="ignore"):
+            trig = (self.rsi_peak() - R) >= delta
+            if Z is not None:
+                trig |= R <= Z
+        return trig
+
+    # --- confirm nodes
+
+    def confirm_mask(self, family: str, param: float) -> np.ndarray:
+        """Days the confirm holds (uncapped), per (family, param)."""
+        def compute():
+            P = self.panels
+            if family == "macd_leq":
+                return macd_hist_mask(P["macd"], P["macd_signal"], param)
+            if family == "adx_drop":
+                return peak_drop_mask(P["adx"], param)
+            if family == "bbw_contract":
+                return peak_drop_mask(P["bbw"], param, relative=True)
+            raise ValueError(f"unknown confirm family {family!r}")
+        return self.node(("confirm_mask", family, param), compute)
+
+    def confirm_day(self, family: str, param: float) -> np.ndarray:
+        """First confirm day within the cap, per (family, param)."""
+        def compute():
+            P = self.panels
+            if family == "macd_leq":
+                return macd_hist_day(P["macd"], P["macd_signal"], param, self.cap_idx)
+            if family == "adx_drop":
+                return adx_drop_day(P["adx"], param, self.cap_idx)
+            if family == "bbw_contract":
+                return bbw_contract_day(P["bbw"], param, self.cap_idx)
+            raise ValueError(f"unknown confirm family {family!r}")
+        return self.node(("confirm_day", family, param), compute)
+
+
+def run_grid(axes: Mapping[str, Sequence], evaluate: Callable[..., dict | None]) -> list[dict]:
+    """
+    evaluate(**combo) for every combination of the axes, in product order
+    (first axis outermost); None results are skipped.
+    """
+    rows = []
+    for combo in product(*axes.values()):
+        row = evaluate(**dict(zip(axes, combo)))
+        if row is not None:
+            rows.append(row)
+    return rows
@@ -0,0 +1,243 @@
+
+# modules/exit_kernels.py
+
+from __future__ import annotations
+
+import re
+
+import numpy as np
+import pandas as pd
+
+__all__ = [
+    "NO_HIT",
+    "forward_cols",
+    "forward_panel",
+    "within_cap",
+    "first_hit",
+    "at",
+    "running_peak",
+    "tp_hit_day",
+    "rsi_cross_day",
+    "peak_retrace_day",
+    "window_peak_retrace_day",
+    "momentum_retrace_mask",
+    "rsi_momentum_exit_day",
+    "macd_hist_mask",
+    "macd_hist_day",
+    "peak_drop",
+    "peak_drop_mask",
+    "adx_drop_day",
+    "bbw_contract_day",
+    "close_return",
+]
+
+# sentinel for "rule never fired" (the loops' None)
+NO_HIT = -1
+
+
+# ---------- forward panels
+
+def forward_cols(df: pd.DataFrame, prefix: str) -> list[str]:
+    """`{prefix}_d{k}` columns with k >= 0, ordered by k."""
+    pat = re.compile(rf"^{re.escape(prefix)}_d(-?\d+)$")
+    ks = sorted((int(m.group(1)), c) for c in df.columns if (m := pat.match(str(c))) and int(m.group(1)) >= 0)
+    return [c for _, c in ks]
+
+
+def forward_panel(df: pd.DataFrame, prefix: str) -> np.ndarray:
+    """(N, T) float matrix of the forward `{prefix}_d*` columns."""
+    return df[forward_cols(df, prefix)].to_numpy(dtype=float)
+
+
+# ---------- primitives
+
+def within_cap(shape: tuple[int, int], cap_idx: np.ndarray | None) -> np.ndarray:
+    """(N, T) mask of days t <= cap_idx[i] (all True without a cap)."""
+    n, T = shape
+    if cap_idx is None:
+        return np.ones((n, T), dtype=bool)
+    return np.arange(T)[None, :] <= np.asarray(cap_idx)[:, None]
+
+
+def first_hit(mask: np.ndarray, cap_idx: np.ndarray | None = None) -> np.ndarray:
+    """First True day per row up to cap_idx (inclusive), NO_HIT if none."""
+    mask = np.asarray(mask, dtype=bool)
+    if cap_idx is not None:
+        mask = mask & within_cap(mask.shape, cap_idx)
+    t = mask.argmax(axis=1)
+    return np.where(mask.any(axis=1), t, NO_HIT)
+
+
+def at(X: np.ndarray, t: np.ndarray, fill: float = np.nan) -> np.ndarray:
+    """X[i, t[i]] per row; fill where t is NO_HIT."""
+    t = np.asarray(t)
+    hit = t >= 0
+    return np.where(hit, X[np.arange(len(X)), np.where(hit, t, 0)], fill)
+
+
+def running_peak(X: np.ndarray, start_idx: np.ndarray | None = None) -> np.ndarray:
+    """
+    Running max over finite values (NaN before the first finite one), restarted
+    at start_idx per row; rows with start_idx == NO_HIT stay NaN.
+    """
+    X = np.asarray(X, dtype=float)
+    if start_idx is not None:
+        s = np.asarray(start_idx)
+        keep = (np.arange(X.shape[1])[None, :] >= s[:, None]) & (s[:, None] >= 0)
+        X = np.where(keep, X, np.nan)
+    with np.errstate(invalid="ignore"):
+        return np.fmax.accumulate(X, axis=1)
+
+
+# ---------- exit rules (each returns the first hit day per trade, NO_HIT if none)
+
+def tp_hit_day(
+    HIGH: np.ndarray,
+    start: np.ndarray,
+    tp: np.ndarray,
+    cap_idx: np.ndarray | None = None,
+    *,
+    mode: str = "ratio",
+) -> np.ndarray:
+    """
+    First day HIGH reaches the take-profit.
+    mode="ratio": finite, positive start and high/start - 1 >= tp (search scripts);
+    mode="threshold": high >= start * (1 + tp) (apply scripts).
+    """
+    start = np.asarray(start, dtype=float)[:, None]
+    tp = np.broadcast_to(np.asarray(tp, dtype=float), start.shape[:1])[:, None]
+    with np.errstate(invalid="ignore", divide="ignore"):
+        if mode == "ratio":
+            ok = np.isfinite(start) & (start > 0) & np.isfinite(tp)
+            mask = ok & np.isfinite(HIGH) & ((HIGH / start - 1.0) >= tp)
+        elif mode == "threshold":
+            mask = HIGH >= start * (1.0 + tp)
+        else:
+            raise ValueError(f"mode must be 'ratio' or 'threshold', got {mode!r}")
+    return first_hit(mask, cap_idx)
+
+
+def rsi_cross_day(
+    RSI: np.ndarray,
+    Y: float,
+    M: int,
+    cap_idx: np.ndarray | None = None,
+    *,
+    block_within_cap: bool = False,
+) -> np.ndarray:
+    """
+    First day t <= cap starting M consecutive finite bars with RSI >= Y.
+    block_within_cap=True also requires the block to end by the cap.
+    """
+    n, T = RSI.shape
+    with np.errstate(invalid="ignore"):
+        ok = np.isfinite(RSI) & (RSI >= Y)
+    cs = np.concatenate([np.zeros((n, 1), dtype=np.int64), np.cumsum(ok, axis=1)], axis=1)
+    mask = np.zeros((n, T), dtype=bool)
+    if 0 < M <= T:
+        mask[:, :T - M + 1] = (cs[:, M:] - cs[:, :T - M + 1]) == M
+    if block_within_cap and cap_idx is not None:
+        return first_hit(mask, np.asarray(cap_idx) - (M - 1))
+    return first_hit(mask, cap_idx)
+
+
+def peak_retrace_day(
+    X: np.ndarray,
+    delta: float,
+    start_idx: np.ndarray | None = None,
+    cap_idx: np.ndarray | None = None,
+) -> np.ndarray:
+    """From start_idx, first finite day with running peak - x >= delta."""
+    peak = running_peak(X, start_idx)
+    with np.errstate(invalid="ignore"):
+        mask = np.isfinite(X) & ((peak - X) >= delta)
+    return first_hit(mask, cap_idx)
+
+
+def window_peak_retrace_day(
+    X: np.ndarray,
+    delta: float,
+    start_idx: np.ndarray,
+    cap_idx: np.ndarray,
+) -> np.ndarray:
+    """
+    Peak over the whole [start_idx, cap_idx] window (first occurrence), then the
+    first finite day on/after it with x <= peak - delta.
+    """
+    s = np.asarray(start_idx)
+    win = within_cap(X.shape, cap_idx) & (np.arange(X.shape[1])[None, :] >= s[:, None]) & (s[:, None] >= 0)
+    Xw = np.where(win, X, np.nan)
+    with np.errstate(invalid="ignore"):
+        peak = np.fmax.reduce(Xw, axis=1)
+        t_peak = first_hit(Xw == peak[:, None])
+        mask = (np.arange(X.shape[1])[None, :] >= t_peak[:, None]) & np.isfinite(Xw) & (Xw <= (peak - delta)[:, None])
+    return np.where(t_peak >= 0, first_hit(mask), NO_HIT)
+
+
+def momentum_retrace_mask(
+    RSI: np.ndarray,
+    Y: float,
+    delta: float,
+    Z: float | None = None,
+    min_hold: int = 0,
+) -> np.ndarray:
+    """
+    (N, T) days where, once the running RSI peak has reached Y and t >= min_hold,
+    RSI is finite and has retraced delta from the peak or sits at/below floor Z.
+    """
+    peak = running_peak(RSI)
+    t = np.arange(RSI.shape[1])[None, :]
+    with np.errstate(invalid="ignore"):
+        trig = (peak - RSI) >= delta
+        if Z is not None:
+            trig |= RSI <= Z
+        return np.isfinite(RSI) & (peak >= Y) & (t >= min_hold) & trig
+
+
+def rsi_momentum_exit_day(RSI, Y, delta, Z=None, min_hold=0, cap_idx=None) -> np.ndarray:
+    return first_hit(momentum_retrace_mask(RSI, Y, delta, Z, min_hold), cap_idx)
+
+
+def macd_hist_mask(MACD: np.ndarray, MSIG: np.ndarray, thr: float) -> np.ndarray:
+    """Finite MACD histogram (macd - signal) at or below thr."""
+    mh = MACD - MSIG
+    with np.errstate(invalid="ignore"):
+        return np.isfinite(mh) & (mh <= thr)
+
+
+def macd_hist_day(MACD, MSIG, thr, cap_idx=None) -> np.ndarray:
+    return first_hit(macd_hist_mask(MACD, MSIG, thr), cap_idx)
+
+
+def peak_drop(X: np.ndarray, relative: bool = False) -> np.ndarray:
+    """
+    Drop from the running peak of finite values: peak - x, or (peak - x) / peak
+    with relative=True (positive peaks only). NaN where undefined.
+    """
+    peak = running_peak(X)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        d = peak - X
+        if relative:
+            d = np.where(peak > 0, d / peak, np.nan)
+    return np.where(np.isfinite(X) & np.isfinite(peak), d, np.nan)
+
+
+def peak_drop_mask(X: np.ndarray, drop: float, relative: bool = False) -> np.ndarray:
+    with np.errstate(invalid="ignore"):
+        return peak_drop(X, relative) >= drop
+
+
+def adx_drop_day(ADX, drop, cap_idx=None) -> np.ndarray:
+    return first_hit(peak_drop_mask(ADX, drop), cap_idx)
+
+
+def bbw_contract_day(BBW, frac, cap_idx=None) -> np.ndarray:
+    return first_hit(peak_drop_mask(BBW, frac, relative=True), cap_idx)
+
+
+def close_return(CLOSE: np.ndarray, start: np.ndarray, t: np.ndarray) -> np.ndarray:
+    """CLOSE[i, t]/start - 1; NaN for NO_HIT, non-finite close, or non-finite/non-positive start."""
+    start = np.asarray(start, dtype=float)
+    c = at(CLOSE, t)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        return np.where(np.isfinite(start) & (start > 0) & np.isfinite(c), c / start - 1.0, np.nan)
@@ -0,0 +1,402 @@
+
+# modules/exit_rules.py
+
+from __future__ import annotations
+
+import json
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Any, Callable, Mapping, Sequence
+
+import numpy as np
+import pandas as pd
+
+from .exit_kernels import (
+    NO_HIT,
+    at,
+    close_return,
+    first_hit,
+    forward_cols,
+    macd_hist_day,
+    adx_drop_day,
+    bbw_contract_day,
+    peak_drop,
+    peak_retrace_day,
+    rsi_cross_day,
+    rsi_momentum_exit_day,
+    tp_hit_day,
+)
+from .trade_paths import TradePaths
+
+__all__ = [
+    "ExitPanels",
+    "ExitResult",
+    "panels_from_frame",
+    "panels_from_paths",
+    "normalize_rule",
+    "load_rule",
+    "compile_rule",
+    "evaluate_rule",
+]
+
+# forward panel prefixes the primitives read (rsi_d*, close_d*, ...)
+PANEL_PREFIXES = ("rsi", "macd", "macd_signal", "adx", "bbw", "high", "close", "atr")
+START_COLS = ("start_price", "entry_price", "open_d0", "close_d0")
+
+# Rule spec (JSON/YAML). A document is {"name": ..., "hold": <bars>, "rule": <expr>};
+# trades where the rule never fires exit at the hold cap ("timed"), or on their last
+# bar ("last_bar") without one. Every primitive searches days 0..cap only.
+#
+# Expressions are dicts with one operator key (plus an optional "label"):
+#
+#   primitives (first day the signal fires)
+#     {"tp": 0.9}  {"tp": {"pct": {1: 0.65, ..., "default": 0.9}, "mode": "ratio"|"threshold", "fill": "close"|"high"|"target"}}
+#     {"time_cap": 6}  {"time_cap": {"bars": {1: 5, 2: 5, ...}}}
+#     {"atr_trail": 1.25}  {"atr_trail": {"mult": 1.25, "exit_bar": "prior"|"breach"}}
+#     {"rsi_retrace": {"Y": 75, "delta": 5, "M": 3, "mode": "cross"|"momentum", "Z": null}}
+#     {"macd": 0.0}  {"adx_drop": 5}  {"bbw_contract": 0.2}
+#   combinators
+#     {"first_of": [e, ...]}                    earliest child; ties go to the first listed
+#     {"both_of": [e, ...]}                     once every child has fired (latest day)
+#     {"veto": {"rule": e, "when": [c, ...]}}   drop e's exit if any condition holds on its day
+#     {"defer": {"rule": e, "bars": 1}}         exit `bars` later, never past the cap
+#     {"levels": {"rule": e, "only": [4]}}      e only fires for trades at these market levels
+#   veto conditions (state on the exit day; undefined readings never veto)
+#     {"macd_above": 0.0}  {"adx_drop_below": 5}  {"bbw_contract_below": 0.2}
+#
+# Numeric tp/time_cap/hold values may be per-level maps ({level: value, "default": value}).
+
+
+# ---------- panels
+
+@dataclass(frozen=True)
+class ExitPanels:
+    """
+    (N, T) forward panels keyed by name (close, high, rsi, ...), the entry price,
+    each trade's last valid day and its market level (0 = unknown).
+    ret_from_entry, when present, prices exits instead of close / start - 1.
+    """
+    arrays: dict[str, np.ndarray]
+    start: np.ndarray
+    last: np.ndarray
+    level: np.ndarray
+
+    @property
+    def n(self) -> int:
+        return int(len(self.start))
+
+    def __getitem__(self, name: str) -> np.ndarray:
+        if name not in self.arrays:
+            raise KeyError(f"exit rule needs a '{name}' panel; have {sorted(self.arrays)}")
+        return self.arrays[name]
+
+    def per_trade(self, value: Any, dtype=float) -> np.ndarray:
+        """Scalar or per-level map -> one value per trade (NaN / last day where unmapped)."""
+        if not isinstance(value, Mapping):
+            return np.full(self.n, value, dtype=dtype)
+        lut = {int(k): v for k, v in value.items() if str(k) != "default"}
+        default = value.get("default", np.nan)
+        out = np.array([lut.get(int(l), default) for l in self.level], dtype=float)
+        if np.issubdtype(np.dtype(dtype), np.integer):
+            return np.where(np.isfinite(out), out, self.last).astype(dtype)
+        return out.astype(dtype)
+
+    def ret(self, t: np.ndarray) -> np.ndarray:
+        if "ret_from_entry" in self.arrays:
+            return at(self.arrays["ret_from_entry"], t)
+        return close_return(self["close"], self.start, t)
+
+
+def panels_from_frame(
+    df: pd.DataFrame,
+    prefixes: Sequence[str] = PANEL_PREFIXES,
+    *,
+    level_col: str = "market_level",
+) -> ExitPanels:
+    """Wide trades frame (rsi_d0.., close_d0..) -> panels cut to the common forward width."""
+    cols = {p: forward_cols(df, p) for p in prefixes}
+    cols = {p: c for p, c in cols.items() if c}
+    if not cols:
+        raise ValueError(f"no forward columns found for any of {list(prefixes)}")
+    T = min(len(c) for c in cols.values())
+    arrays = {p: df[c[:T]].to_numpy(dtype=float) for p, c in cols.items()}
+    start_col = next((c for c in START_COLS if c in df.columns), None)
+    start = df[start_col].astype(float).to_numpy() if start_col else np.full(len(df), np.nan)
+    lvl = pd.to_numeric(df[level_col], errors="coerce") if level_col in df.columns else pd.Series(np.nan, index=df.index)
+    level = np.trunc(lvl.fillna(0)).astype(int).clip(0, 9).to_numpy()
+    return ExitPanels(arrays=arrays, start=start, last=np.full(len(df), T - 1, dtype=np.int64), level=level)
+
+
+def panels_from_paths(paths: TradePaths, columns: Sequence[str] | None = None, level: np.ndarray | None = None) -> ExitPanels:
+    """CSR trade paths -> NaN-padded (n_trades, longest path) panels."""
+    cols = [c for c in (columns or paths.arrays) if c not in ("date", "bar_index")]
+    lengths = paths.lengths()
+    seg = paths.segment_ids()
+    within = np.arange(paths.n_bars) - np.repeat(paths.starts(), lengths)
+    width = int(lengths.max()) if paths.n_trades else 0
+    arrays = {}
+    for c in cols:
+        X = np.full((paths.n_trades, width), np.nan)
+        X[seg, within] = paths[c]
+        arrays[c] = X
+    lvl = np.zeros(paths.n_trades, dtype=int) if level is None else np.asarray(level, dtype=int)
+    return ExitPanels(arrays=arrays, start=np.full(paths.n_trades, np.nan), last=lengths - 1, level=lvl)
+
+
+@dataclass(frozen=True)
+class ExitResult:
+    """Per-trade exit day, the label of the rule that fired and the realized return."""
+    day: np.ndarray
+    kind: np.ndarray
+    ret: np.ndarray
+
+    def to_frame(self) -> pd.DataFrame:
+        return pd.DataFrame({"exit_day": self.day, "exit_type": self.kind, "exit_ret": self.ret})
+
+
+# ---------- spec handling
+
+def _params(arg: Any, key: str) -> dict:
+    """Shorthand scalar -> {key: scalar}; dict passes through."""
+    return dict(arg) if isinstance(arg, Mapping) else {key: arg}
+
+
+def normalize_rule(doc: Mapping) -> dict:
+    """
+    Canonical rule document. Accepts the exported exit_out/exit_rule.json shape
+    (family/multiplier/cap_bars) as well as {"rule": ...} documents.
+    """
+    doc = dict(doc)
+    if "rule" in doc:
+        return doc
+    fam = doc.get("family")
+    if fam == "atr_trail":
+        # exits_atr_* / exits_hybrid_* stamp the breach bar, then cap it
+        rule: dict = {"atr_trail": {"mult": float(doc["multiplier"]), "exit_bar": "breach"}, "label": "atr_trail"}
+        if doc.get("cap_bars") is not None:
+            rule = {"first_of": [rule, {"time_cap": int(doc["cap_bars"]), "label": "time_cap"}]}
+    elif fam == "time_cap":
+        rule = {"time_cap": int(doc.get("cap_bars", doc.get("param"))), "label": "time_cap"}
+    else:
+        raise ValueError(f"cannot build an exit rule from family {fam!r}")
+    return {"name": doc.get("name", fam), "rule": rule}
+
+
+def load_rule(path: str | Path) -> dict:
+    """Read a rule document from .json or .yaml/.yml."""
+    path = Path(path)
+    text = path.read_text(encoding="utf-8-sig")
+    if path.suffix.lower() in (".yaml", ".yml"):
+        import yaml
+        return normalize_rule(yaml.safe_load(text))
+    return normalize_rule(json.loads(text))
+
+
+# ---------- compiler
+
+Node = Callable[[ExitPanels, np.ndarray], tuple[np.ndarray, np.ndarray]]
+Cond = Callable[[ExitPanels], np.ndarray]
+
+
+def _node(fn: Node, label: str | None, kids: Sequence[Node] = (), fill: tuple | None = None) -> Node:
+    """Tag an evaluator with its static label, children and (tp) pricing."""
+    fn.label, fn.kids, fn.fill = label, list(kids), fill
+    return fn
+
+
+def _labelled(day: np.ndarray, label) -> tuple[np.ndarray, np.ndarray]:
+    return day, np.where(day != NO_HIT, label, None).astype(object)
+
+
+def _tp(p: dict, label: str) -> Node:
+    mode, fill = p.get("mode", "ratio"), p.get("fill", "close")
+    if fill not in ("close", "high", "target"):
+        raise ValueError(f"tp fill must be 'close', 'high' or 'target', got {fill!r}")
+
+    def tp(P, cap):
+        return _labelled(tp_hit_day(P["high"], P.start, P.per_trade(p["pct"]), cap, mode=mode), label)
+    return _node(tp, label, fill=(fill, p["pct"]))
+
+
+def _time_cap(p: dict, label: str) -> Node:
+    def time_cap(P, cap):
+        return _labelled(np.minimum(P.per_trade(p["bars"], np.int64), cap), label)
+    return _node(time_cap, label)
+
+
+def _atr_trail(p: dict, label: str) -> Node:
+    mult, exit_bar = float(p["mult"]), p.get("exit_bar", "prior")
+    if exit_bar not in ("prior", "breach"):
+        raise ValueError(f"atr_trail exit_bar must be 'prior' or 'breach', got {exit_bar!r}")
+
+    def atr_trail(P, cap):
+        c = P["close"]
+        with np.errstate(invalid="ignore"):
+            hit = first_hit(c < np.maximum.accumulate(c, axis=1) - mult * P["atr"], cap)
+        day = np.where(hit >= 0, np.maximum(hit - 1, 0), NO_HIT) if exit_bar == "prior" else hit
+        return _labelled(day, label)
+    return _node(atr_trail, label)
+
+
+def _rsi_retrace(p: dict, label: str) -> Node:
+    Y, delta, M = float(p["Y"]), float(p["delta"]), int(p.get("M", 1))
+    mode, Z = p.get("mode", "cross"), p.get("Z")
+    if mode not in ("cross", "momentum"):
+        raise ValueError(f"rsi_retrace mode must be 'cross' or 'momentum', got {mode!r}")
+
+    def rsi_retrace(P, cap):
+        R = P["rsi"]
+        if mode == "cross":
+            day = peak_retrace_day(R, delta, start_idx=rsi_cross_day(R, Y, M, cap), cap_idx=cap)
+        else:
+            day = rsi_momentum_exit_day(R, Y, delta, Z, M, cap)
+        return _labelled(day, label)
+    return _node(rsi_retrace, label)
+
+
+def _confirm(op: str, v: float, label: str) -> Node:
+    def confirm(P, cap):
+        if op == "macd":
+            day = macd_hist_day(P["macd"], P["macd_signal"], v, cap)
+        elif op == "adx_drop":
+            day = adx_drop_day(P["adx"], v, cap)
+        else:
+            day = bbw_contract_day(P["bbw"], v, cap)
+        return _labelled(day, label)
+    return _node(confirm, label)
+
+
+def _cond(spec: Mapping) -> Cond:
+    """Veto condition -> (N, T) mask; NaN readings compare False."""
+    (op, v), = spec.items()
+    v = float(v)
+    if op == "macd_above":
+        val, sign = (lambda P: P["macd"] - P["macd_signal"]), 1
+    elif op == "adx_drop_below":
+        val, sign = (lambda P: peak_drop(P["adx"])), -1
+    elif op == "bbw_contract_below":
+        val, sign = (lambda P: peak_drop(P["bbw"], relative=True)), -1
+    else:
+        raise ValueError(f"unknown veto condition {op!r}")
+
+    def cond(P):
+        with np.errstate(invalid="ignore"):
+            return val(P) > v if sign > 0 else val(P) < v
+    return cond
+
+
+def _compile(spec: Mapping) -> Node:
+    if not isinstance(spec, Mapping):
+        raise ValueError(f"exit rule node must be a mapping, got {spec!r}")
+    spec = dict(spec)
+    label = spec.pop("label", None)
+    if len(spec) != 1:
+        raise ValueError(f"exit rule node needs exactly one operator, got {sorted(spec)}")
+    (op, arg), = spec.items()
+
+    if op == "tp":
+        return _tp(_params(arg, "pct"), label or "tp")
+    if op == "time_cap":
+        return _time_cap(_params(arg, "bars"), label or "time_cap")
+    if op == "atr_trail":
+        return _atr_trail(_params(arg, "mult"), label or "atr_trail")
+    if op == "rsi_retrace":
+        return _rsi_retrace(dict(arg), label or "rsi")
+    if op in ("macd", "adx_drop", "bbw_contract"):
+        key = {"macd": "thr", "adx_drop": "drop", "bbw_contract": "frac"}[op]
+        return _confirm(op, float(_params(arg, key)[key]), label or op)
+
+    if op == "first_of":
+        kids = [_compile(s) for s in arg]
+
+        def first_of(P, cap):
+            day = np.full(P.n, NO_HIT)
+            kind = np.full(P.n, None, dtype=object)
+            for k in kids:
+                d, lab = k(P, cap)
+                take = (d != NO_HIT) & ((day == NO_HIT) | (d < day))
+                day, kind = np.where(take, d, day), np.where(take, lab, kind)
+            return (day, kind) if label is None else _labelled(day, label)
+        return _node(first_of, label, kids)
+
+    if op == "both_of":
+        kids = [_compile(s) for s in arg]
+        name = label or "+".join(str(k.label) for k in kids)
+
+        def both_of(P, cap):
+            days = np.stack([k(P, cap)[0] for k in kids])
+            return _labelled(np.where((days != NO_HIT).all(axis=0), days.max(axis=0), NO_HIT), name)
+        return _node(both_of, name, kids)
+
+    if op in ("veto", "defer", "levels"):
+        arg = dict(arg)
+        inner = _compile(arg["rule"])
+        if op == "veto":
+            conds = [_cond(c) for c in arg.get("when", [])]
+
+            def step(P, cap, day):
+                vetoed = np.zeros(P.n, dtype=bool)
+                for c in conds:
+                    vetoed |= at(c(P).astype(float), day, fill=0.0) > 0
+                return np.where(vetoed, NO_HIT, day)
+        elif op == "defer":
+            bars = int(arg.get("bars", 1))
+
+            def step(P, cap, day):
+                return np.where(day != NO_HIT, np.minimum(day + bars, cap), NO_HIT)
+        else:
+            only = [int(l) for l in arg["only"]]
+
+            def step(P, cap, day):
+                return np.where(np.isin(P.level, only), day, NO_HIT)
+
+        def wrapped(P, cap):
+            day, kind = inner(P, cap)
+            day = step(P, cap, day)
+            return _labelled(day, label) if label else (day, np.where(day != NO_HIT, kind, None).astype(object))
+        wrapped.__name__ = op
+        return _node(wrapped, label or inner.label, [inner])
+
+    raise ValueError(f"unknown exit rule operator {op!r}")
+
+
+def _tp_fills(node: Node) -> list[tuple]:
+    """(fill, pct, label) of every tp primitive that does not price at the close."""
+    out = [(*node.fill, node.label)] if node.fill and node.fill[0] != "close" else []
+    for k in node.kids:
+        out += _tp_fills(k)
+    return out
+
+
+# ---------- main API
+
+def compile_rule(doc: Mapping) -> Callable[[ExitPanels], ExitResult]:
+    """
+    Validate a rule document once and return an evaluator over ExitPanels.
+    Every node evaluates all trades at once on the (N, T) panels.
+    """
+    doc = normalize_rule(doc)
+    node = _compile(doc["rule"])
+    hold = doc.get("hold")
+    fills = _tp_fills(node)
+
+    def evaluate(P: ExitPanels) -> ExitResult:
+        cap = P.last if hold is None else np.minimum(P.per_trade(hold, np.int64), P.last)
+        day, kind = node(P, cap)
+        fired = day != NO_HIT
+        day = np.where(fired, day, cap)
+        kind = np.where(fired, kind, "timed" if hold is not None else "last_bar").astype(object)
+        ret = P.ret(day)
+        for fill, pct, lab in fills:
+            hit = kind == lab
+            if fill == "target":
+                ret = np.where(hit, P.per_trade(pct), ret)
+            else:
+                ret = np.where(hit, close_return(P["high"], P.start, day), ret)
+        return ExitResult(day=day.astype(np.int64), kind=kind, ret=ret)
+
+    return evaluate
+
+
+def evaluate_rule(doc: Mapping, panels: ExitPanels) -> ExitResult:
+    return compile_rule(doc)(panels)
@@ -0,0 +1,78 @@
+
+# modules/folds.py
+
+from __future__ import annotations
+
+from typing import Iterator
+
+import numpy as np
+import pandas as pd
+
+__all__ = [
+    "walk_forward_folds",
+    "purged_kfold",
+]
+
+
+# ---------- helpers
+
+def _as_ns(dates) -> np.ndarray:
+    return pd.to_datetime(pd.Series(np.asarray(dates)), errors="coerce").to_numpy(dtype="datetime64[ns]")
+
+
+# ---------- main API
+
+def walk_forward_folds(
+    dates,
+    n_folds: int = 5,
+    *,
+    mode: str = "expanding",
+    min_train: float = 0.3,
+) -> Iterator[tuple[np.ndarray, np.ndarray]]:
+    """
+    Rolling-origin folds by trade date: the first `min_train` share of trades
+    seeds the train set, the rest is cut into n_folds consecutive test blocks.
+    mode="expanding" trains on everything before the block, "sliding" on the
+    same number of trades as the seed, immediately before it.
+    Yields (train_idx, test_idx) as positions into `dates`.
+    """
+    if mode not in ("expanding", "sliding"):
+        raise ValueError(f"mode must be 'expanding' or 'sliding', got {mode!r}")
+    order = np.argsort(_as_ns(dates), kind="stable")
+    n = len(order)
+    seed = max(1, int(n * min_train))
+    for block in np.array_split(np.arange(seed, n), n_folds):
+        if not len(block):
+            continue
+        start = int(block[0])
+        lo = 0 if mode == "expanding" else max(0, start - seed)
+        yield order[lo:start], order[block]
+
+
+def purged_kfold(
+    entry_dates,
+    exit_dates,
+    k: int = 5,
+    *,
+    embargo_days: float = 0.0,
+) -> Iterator[tuple[np.ndarray, np.ndarray]]:
+    """
+    K contiguous test blocks in entry-date order. Train drops every trade whose
+    [entry, exit] span overlaps the test block's span (purge) and every trade
+    entering within embargo_days after the block ends (embargo).
+    Yields (train_idx, test_idx) as positions into the inputs.
+    """
+    entry = _as_ns(entry_dates)
+    exit_ = _as_ns(exit_dates)
+    exit_ = np.where(np.isnat(exit_), entry, exit_)
+    order = np.argsort(entry, kind="stable")
+    embargo = np.timedelta64(int(embargo_days * 86400 * 1e9), "ns")
+    for test in np.array_split(order, k):
+        if not len(test):
+            continue
+        t0, t1 = entry[test].min(), exit_[test].max()
+        overlap = (entry <= t1) & (exit_ >= t0)
+        embargoed = (entry > t1) & (entry <= t1 + embargo)
+        keep = ~(overlap | embargoed)
+        keep[test] = False
+        yield np.flatnonzero(keep), np.sort(test)
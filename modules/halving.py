@@ -0,0 +1,149 @@
+
+# modules/halving.py
+
+from __future__ import annotations
+
+import sys
+from itertools import product
+from typing import Any, Callable, Mapping, Sequence
+
+import numpy as np
+import pandas as pd
+
+from .exit_grid import ExitGrid
+
+__all__ = [
+    "stratified_order",
+    "halving_rungs",
+    "successive_halving",
+    "halve_grid",
+]
+
+
+# ---------- helpers
+
+def _strata_codes(strata) -> np.ndarray:
+    """One integer code per row from a key vector or a frame of key columns."""
+    if isinstance(strata, pd.DataFrame):
+        return strata.astype(str).agg("|".join, axis=1).factorize()[0]
+    return pd.Series(np.asarray(strata)).astype(str).factorize()[0]
+
+
+def _sort_key(score) -> tuple:
+    """Scores may be floats or tuples; NaN/None rank last."""
+    vals = score if isinstance(score, tuple) else (score,)
+    return tuple(-np.inf if v is None or (isinstance(v, float) and np.isnan(v)) else v for v in vals)
+
+
+# ---------- main API
+
+def stratified_order(strata, seed: int = 0) -> np.ndarray:
+    """
+    Permutation of row positions whose every prefix is (close to) stratified:
+    rows are shuffled within their stratum and interleaved by within-stratum
+    quantile, so order[:n] keeps each stratum's share for any n. Rung samples
+    taken as prefixes are nested (each rung contains the previous one).
+    """
+    codes = _strata_codes(strata)
+    n = len(codes)
+    rng = np.random.default_rng(seed)
+    u = rng.random(n)
+    by_stratum = np.lexsort((u, codes))
+    sizes = np.bincount(codes)
+    rank = np.empty(n)
+    rank[by_stratum] = np.arange(n) - np.repeat(np.cumsum(sizes) - sizes, sizes)
+    q = (rank + rng.random(n)) / sizes[codes]
+    return np.argsort(q, kind="stable")
+
+
+def halving_rungs(n_rows: int, n_candidates: int, *, eta: float = 3.0, min_rows: int = 200) -> list[tuple[int, int]]:
+    """
+    (sample size, candidates evaluated) per rung: the last rung is the full set,
+    each earlier one 1/eta the rows and eta times the candidates, never below min_rows.
+    """
+    sizes = [n_rows]
+    while sizes[-1] / eta >= min_rows:
+        sizes.append(int(sizes[-1] / eta))
+    sizes = sizes[::-1]
+    keep, rungs = n_candidates, []
+    for s in sizes:
+        rungs.append((s, keep))
+        keep = max(1, int(np.ceil(keep / eta)))
+    return rungs
+
+
+def successive_halving(
+    candidates: Sequence[Any],
+    make_evaluator: Callable[[np.ndarray], Callable[[Any], Any]],
+    strata,
+    *,
+    key: Callable[[Any], Any] | None = None,
+    eta: float = 3.0,
+    min_rows: int = 200,
+    seed: int = 0,
+    progress: bool = True,
+) -> list[dict]:
+    """
+    Successive halving over row subsamples. Every candidate is evaluated on a
+    small stratified sample; the best 1/eta survive to a sample eta times larger,
+    and so on until the survivors are evaluated on all rows.
+
+    make_evaluator(idx) is called once per rung with the sample's sorted row
+    positions and returns evaluate(candidate); key(result) gives the score,
+    higher is better (floats or tuples, NaN/None last). Returns one record per
+    (candidate, rung): candidate index, rung, n_rows, final, result.
+    """
+    key = key or (lambda r: r)
+    order = stratified_order(strata, seed)
+    rungs = halving_rungs(len(order), len(candidates), eta=eta, min_rows=min_rows)
+    alive = list(range(len(candidates)))
+    hist = []
+    for r, (size, _) in enumerate(rungs):
+        evaluate = make_evaluator(np.sort(order[:size]))
+        results = [(c, evaluate(candidates[c])) for c in alive]
+        last = r == len(rungs) - 1
+        hist += [{"candidate": c, "rung": r, "n_rows": size, "final": last, "result": res} for c, res in results]
+        if progress:
+            sys.stderr.write(f"rung {r + 1}/{len(rungs)}: {len(alive)} candidates on {size} rows\n")
+        if not last:
+            ranked = sorted(results, key=lambda cr: _sort_key(None if cr[1] is None else key(cr[1])), reverse=True)
+            alive = sorted(c for c, _ in ranked[:rungs[r + 1][1]])
+    return hist
+
+
+def halve_grid(
+    axes: Mapping[str, Sequence],
+    evaluate: Callable[..., dict | None],
+    panels: Mapping[str, np.ndarray],
+    *,
+    rank_by: Sequence[str],
+    strata: Sequence[str] = ("level", "year"),
+    eta: float = 3.0,
+    min_rows: int = 200,
+    seed: int = 0,
+    progress: bool = True,
+    start_key: str = "start",
+    cap_key: str = "cap_idx",
+) -> list[dict]:
+    """
+    successive_halving over an exit grid: evaluate(grid, **combo) as in
+    run_grid_parallel, but each rung builds a fresh ExitGrid on the sampled
+    trades (rows of every per-trade array/panel in `panels`). Candidates are
+    ranked by the row's rank_by columns; samples are stratified by whichever
+    `strata` panels exist. Returns the evaluated rows of every rung with
+    rung / n_rows / final columns added.
+    """
+    combos = [dict(zip(axes, c)) for c in product(*axes.values())]
+    n = len(panels[start_key])
+    keys = [k for k in strata if k in panels]
+    groups = pd.DataFrame({k: panels[k] for k in keys}) if keys else np.zeros(n, dtype=int)
+
+    def make_evaluator(idx):
+        sub = {k: (v[idx] if isinstance(v, np.ndarray) and v.ndim and len(v) == n else v) for k, v in panels.items()}
+        grid = ExitGrid(sub, start=sub.get(start_key), cap_idx=sub.get(cap_key))
+        return lambda combo: evaluate(grid, **combo)
+
+    hist = successive_halving(combos, make_evaluator, groups, key=lambda row: tuple(row[c] for c in rank_by),
+                              eta=eta, min_rows=min_rows, seed=seed, progress=progress)
+    return [{**h["result"], "rung": h["rung"], "n_rows": h["n_rows"], "final": h["final"]}
+            for h in hist if h["result"] is not None]
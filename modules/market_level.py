@@ -3,14 +3,32 @@
 
 from __future__ import annotations
 
+from typing import Mapping, Sequence
+
 import numpy as np
 import pandas as pd
 
+__all__ = [
+    "DEFAULT_QS",
+    "asof_market_level",
+    "compute_market_level",
+    "levels_from_history",
+    "sweep_market_levels",
+    "sweep_level_metrics",
+    "rank_level_schemes",
+]
+
+# default quantile cutpoints -> 9 levels (tweak if you want different tail widths)
+DEFAULT_QS = (0.05, 0.15, 0.30, 0.45, 0.60, 0.75, 0.85, 0.95)
+
+# (macro column, invert) -- dominance series are inverted (rising dominance = risk-off)
+_COMPONENTS = (("btc_d", True), ("usdt_d", True), ("total_cap", False), ("total3", False))
+
 
 # ---------- helpers
 
-def _coerce_macro(df: pd.DataFrame) -> pd.DataFrame:
-    """Normalize column names, coerce types, and ensure one row per calendar day."""
+def _coerce_macro(df: pd.DataFrame, freq: str = "D") -> pd.DataFrame:
+    """Normalize column names, coerce types, and ensure one row per `freq` bucket (calendar day by default)."""
     if df is None or len(df) == 0:
         raise ValueError("df_macro is empty")
 
@@ -29,13 +47,13 @@ def _coerce_macro(df: pd.DataFrame) -> pd.DataFrame:
     if missing:
         raise KeyError(f"missing macro columns: {missing}, present: {list(df.columns)}")
 
-    # parse date -> midnight (no tz), keep only needed cols
+    # parse date -> bucket start (no tz), keep only needed cols
     keep = ["date", "btc_d", "usdt_d", "total_cap", "total3"]
     out = df[keep].copy()
-    out["date"] = pd.to_datetime(out["date"], errors="coerce").dt.floor("D")
+    out["date"] = pd.to_datetime(out["date"], errors="coerce").dt.floor(freq)
     out = out.dropna(subset=["date"]).sort_values("date")
 
-    # if duplicates per day, keep the last (already sorted)
+    # if duplicates per bucket, keep the last (already sorted)
     out = out.groupby("date", as_index=False).last()
 
     # numeric coercion + basic gap-fill to remove stray NaNs before scoring
@@ -70,10 +88,15 @@ def score_component(norm_series: pd.Series) -> pd.Series:
     return out.astype("Int64")
 
 
-def levels_from_history(values: pd.Series, dates: pd.Series, train_end: str = "2024-12-31") -> pd.Series:
+def levels_from_history(
+    values: pd.Series,
+    dates: pd.Series,
+    train_end: str = "2024-12-31",
+    qs: Sequence[float] = DEFAULT_QS,
+) -> pd.Series:
     """
-    Convert a continuous composite into 1..9 using fixed cutpoints
-    computed on a *training* window only (no leakage).
+    Convert a continuous composite into 1..len(qs)+1 (1..9 by default) using
+    fixed cutpoints computed on a *training* window only (no leakage).
     """
     vals = pd.to_numeric(values, errors="coerce")
     d = pd.to_datetime(dates, errors="coerce")
@@ -90,16 +113,10 @@ def levels_from_history(values: pd.Series, dates: pd.Series, train_end: str = "2
         # degenerate fallback: all neutral
         return pd.Series(pd.array([5] * len(vals), dtype="Int64"), index=values.index)
 
-    # choose cutpoints (tweak if you want different tail widths)
-    qs = [0.05, 0.15, 0.30, 0.45, 0.60, 0.75, 0.85, 0.95]
-    cuts = np.quantile(train, qs).tolist()
-    # ensure strictly increasing (guard rare flat distributions)
-    for i in range(1, len(cuts)):
-        if cuts[i] <= cuts[i - 1]:
-            cuts[i] = np.nextafter(cuts[i - 1], np.inf)
+    cuts = _cutpoints(train.to_numpy(dtype=float), qs)
 
     bins = [-np.inf, *cuts, np.inf]
-    labels = list(range(1, 10))
+    labels = list(range(1, len(cuts) + 2))
     lvl = pd.cut(vals, bins=bins, labels=labels)
 
     # return as nullable Int64 and fill early NaNs softly
@@ -109,15 +126,77 @@ def levels_from_history(values: pd.Series, dates: pd.Series, train_end: str = "2
     return lvl
 
 
+def _cutpoints(train: np.ndarray, qs: Sequence[float]) -> list:
+    """Quantile cutpoints on the training values, forced strictly increasing."""
+    cuts = np.quantile(train, list(qs)).tolist()
+    # ensure strictly increasing (guard rare flat distributions)
+    for i in range(1, len(cuts)):
+        if cuts[i] <= cuts[i - 1]:
+            cuts[i] = np.nextafter(cuts[i - 1], np.inf)
+    return cuts
+
+
+def _freq_delta(freq: str) -> np.timedelta64:
+    """Fixed bucket width for freq ("D", "h", "15min", ...)."""
+    return np.timedelta64(pd.Timedelta(pd.tseries.frequencies.to_offset(freq)).value, "ns")
+
+
+def _ffill_bfill(a: np.ndarray) -> np.ndarray:
+    """Column-wise forward fill then back fill of NaNs in a 2-D float array."""
+    n = a.shape[0]
+    idx = np.where(np.isnan(a), 0, np.arange(n)[:, None])
+    np.maximum.accumulate(idx, axis=0, out=idx)
+    out = np.take_along_axis(a, idx, axis=0)
+    idx = np.where(np.isnan(out), n - 1, np.arange(n)[:, None])
+    idx = np.minimum.accumulate(idx[::-1], axis=0)[::-1]
+    return np.take_along_axis(out, idx, axis=0)
+
+
+def _composite_smooth(df: pd.DataFrame, lookback: int) -> np.ndarray:
+    """
+    Vectorized twin of the per-component scoring in compute_market_level():
+    rolling min-max -> 1..9 sub-scores -> mean -> 2-bar smoothing.
+    """
+    vals = df[[c for c, _ in _COMPONENTS]].apply(pd.to_numeric, errors="coerce")
+    roll = vals.rolling(lookback, min_periods=1)
+    mn = roll.min().to_numpy(dtype=float)
+    mx = roll.max().to_numpy(dtype=float)
+    x = vals.to_numpy(dtype=float)
+
+    denom = mx - mn
+    denom[denom == 0] = np.nan
+    norm = (x - mn) / denom
+    inv = np.array([i for _, i in _COMPONENTS])
+    norm[:, inv] = 1 - norm[:, inv]
+    score = np.round(np.clip(norm, 0, 1) * 8) + 1
+
+    with np.errstate(invalid="ignore"):
+        cnt = np.isfinite(score).sum(axis=1)
+        avg = np.where(cnt > 0, np.nansum(score, axis=1) / np.maximum(cnt, 1), np.nan)
+    smooth = np.full_like(avg, np.nan)
+    smooth[1:] = (avg[1:] + avg[:-1]) / 2
+    return smooth
+
+
 # ---------- main API
 
-def compute_market_level(df_macro: pd.DataFrame, *, lookback: int = 14, train_end: str = "2024-12-31") -> pd.DataFrame:
+def compute_market_level(
+    df_macro: pd.DataFrame,
+    *,
+    lookback: int = 14,
+    train_end: str = "2024-12-31",
+    qs: Sequence[float] = DEFAULT_QS,
+    freq: str = "D",
+) -> pd.DataFrame:
     """
     Build a 1..9 market regime from macro inputs.
     Expects df_macro with columns: date, btc_d, usdt_d, total_cap, total3.
-    Returns: DataFrame[date(datetime64[ns]), market_level(Int64)]
+    freq sets the bucket ("D" daily, "h" hourly, ...); lookback counts buckets,
+    so an hourly run wanting a 14-day window passes lookback=14*24.
+    Returns: DataFrame[date(datetime64[ns]), market_level(Int64)], one row per
+    bucket, date = bucket start.
     """
-    df = _coerce_macro(df_macro)
+    df = _coerce_macro(df_macro, freq=freq)
 
     # per-component rolling normalization
     df["btc_norm"] = normalize_series(df["btc_d"], lookback=lookback, invert=True)
@@ -140,16 +219,178 @@ def compute_market_level(df_macro: pd.DataFrame, *, lookback: int = 14, train_en
     df["avg_smooth"] = (df["avg_raw"] + df["avg_raw"].shift(1)) / 2
 
     # fixed historical quantile mapping -> 1..9
-    df["market_level"] = levels_from_history(df["avg_smooth"], df["date"], train_end=train_end)
+    df["market_level"] = levels_from_history(df["avg_smooth"], df["date"], train_end=train_end, qs=qs)
 
     # final tidy frame
     out = df[["date", "market_level"]].copy()
 
-    # normalize date dtype to midnight (for merges) and ensure Int64 (nullable)
-    out["date"] = pd.to_datetime(out["date"], errors="coerce").dt.floor("D")
+    # normalize date dtype to bucket start (for merges) and ensure Int64 (nullable)
+    out["date"] = pd.to_datetime(out["date"], errors="coerce").dt.floor(freq)
     out["market_level"] = out["market_level"].astype("Int64")
 
     # if any residual NA (should be rare), use neutral 5
     out["market_level"] = out["market_level"].fillna(5).astype("Int64")
 
     return out
+
+
+def asof_market_level(
+    bar_times,
+    df_level: pd.DataFrame,
+    *,
+    freq: str = "D",
+    completed: bool = True,
+    fill: int = 5,
+) -> np.ndarray:
+    """
+    Map each indicator bar timestamp to the latest macro level (as-of join).
+
+    df_level is compute_market_level() output at `freq`. With completed=True a
+    level stamped t is only visible from t + freq on (its bucket has closed),
+    so an intraday bar never sees the level of the bucket it sits in.
+    bar_times may be any length/order and span all symbols (the macro regime is
+    market-wide): it is one searchsorted with no merge or sort of the bars.
+    Returns an int8 array aligned to bar_times; bars before the first visible
+    level get `fill` (neutral 5).
+    """
+    t = np.asarray(pd.to_datetime(bar_times), dtype="datetime64[ns]")
+    lv = df_level.sort_values("date")
+    avail = lv["date"].to_numpy(dtype="datetime64[ns]")
+    if completed:
+        avail = avail + _freq_delta(freq)
+    vals = lv["market_level"].fillna(fill).to_numpy(dtype=np.int8)
+
+    pos = np.searchsorted(avail, t, side="right") - 1
+    out = np.full(t.shape, fill, dtype=np.int8)
+    hit = pos >= 0
+    out[hit] = vals[pos[hit]]
+    return out
+
+
+# ---------- sensitivity sweep
+
+def sweep_market_levels(
+    df_macro: pd.DataFrame,
+    lookbacks: Sequence[int] = (14,),
+    schemes: Mapping[str, Sequence[float]] | Sequence[Sequence[float]] | None = None,
+    *,
+    train_end: str = "2024-12-31",
+    freq: str = "D",
+) -> tuple[pd.DatetimeIndex, np.ndarray, pd.DataFrame]:
+    """
+    Market levels for every (lookback, cutpoint scheme) pair in one pass.
+
+    The rolling composite is computed once per lookback and shared by all
+    schemes; each scheme is then a quantile + searchsorted on that column.
+    Column j of the result matches compute_market_level(lookback=..., qs=...)
+    for configs.iloc[j].
+
+    Returns (dates, levels[n_dates, n_configs] int8, configs) where configs has
+    columns: config, lookback, scheme, n_levels.
+    """
+    if schemes is None:
+        schemes = {"default": DEFAULT_QS}
+    if not isinstance(schemes, Mapping):
+        schemes = {f"s{i}": qs for i, qs in enumerate(schemes)}
+
+    df = _coerce_macro(df_macro, freq=freq)
+    dates = pd.DatetimeIndex(df["date"])
+    d = dates.to_numpy()
+    train_mask = d <= np.datetime64(pd.to_datetime(train_end))
+
+    cols, cfg = [], []
+    for lb in lookbacks:
+        smooth = _composite_smooth(df, int(lb))
+        train = smooth[train_mask & np.isfinite(smooth)]
+        # if training is tiny, fall back to all non-NA values
+        if train.size < 100:
+            train = smooth[np.isfinite(smooth)]
+        for name, qs in schemes.items():
+            if train.size == 0:
+                lvl = np.full(len(smooth), 5.0)
+            else:
+                cuts = np.asarray(_cutpoints(train, qs))
+                # pd.cut(right=True): (cut[i-1], cut[i]] -> level i+1
+                lvl = (np.searchsorted(cuts, smooth, side="left") + 1).astype(float)
+                lvl[~np.isfinite(smooth)] = np.nan
+            cols.append(lvl)
+            cfg.append({"config": len(cfg), "lookback": int(lb), "scheme": name, "n_levels": len(qs) + 1})
+
+    levels = _ffill_bfill(np.column_stack(cols)) if cols else np.empty((len(d), 0))
+    levels = np.nan_to_num(levels, nan=5).astype(np.int8)
+    return dates, levels, pd.DataFrame(cfg)
+
+
+def sweep_level_metrics(
+    dates: pd.DatetimeIndex,
+    levels: np.ndarray,
+    ledger: pd.DataFrame,
+    *,
+    date_col: str = "entry_date",
+    ret_col: str = "pct_return",
+    freq: str = "D",
+) -> pd.DataFrame:
+    """
+    Per-(config, level) trade metrics for a breakout ledger against a sweep.
+
+    Trades are joined to the sweep by bucket (calendar day by default) with one searchsorted;
+    all configs are reduced together with bincount.
+    Returns long DataFrame: config, level, n, mean_ret, win_rate, ret_std.
+    """
+    day = pd.to_datetime(ledger[date_col], errors="coerce").dt.floor(freq).to_numpy()
+    ret = pd.to_numeric(ledger[ret_col], errors="coerce").to_numpy(dtype=float)
+
+    d = dates.to_numpy()
+    pos = np.searchsorted(d, day)
+    pos_c = np.minimum(pos, len(d) - 1)
+    ok = (pos < len(d)) & (d[pos_c] == day) & np.isfinite(ret)
+    pos_c, ret = pos_c[ok], ret[ok]
+
+    n_cfg = levels.shape[1]
+    n_lvl = int(levels.max()) if levels.size else 9
+    lv = levels[pos_c].astype(np.int64) - 1                       # (trades, configs)
+    key = (np.arange(n_cfg)[None, :] * n_lvl + lv).ravel()
+    r = np.repeat(ret[:, None], n_cfg, axis=1).ravel()
+    size = n_cfg * n_lvl
+
+    n = np.bincount(key, minlength=size)
+    s1 = np.bincount(key, weights=r, minlength=size)
+    s2 = np.bincount(key, weights=r * r, minlength=size)
+    wins = np.bincount(key, weights=(r > 0).astype(float), minlength=size)
+
+    with np.errstate(invalid="ignore", divide="ignore"):
+        mean = s1 / n
+        var = (s2 - n * mean ** 2) / (n - 1)
+    out = pd.DataFrame({
+        "config": np.repeat(np.arange(n_cfg), n_lvl),
+        "level": np.tile(np.arange(1, n_lvl + 1), n_cfg),
+        "n": n,
+        "mean_ret": mean,
+        "win_rate": np.where(n > 0, wins / np.maximum(n, 1), np.nan),
+        "ret_std": np.sqrt(np.clip(var, 0, None)),
+    })
+    return out[out["n"] > 0].reset_index(drop=True)
+
+
+def rank_level_schemes(metrics: pd.DataFrame, configs: pd.DataFrame) -> pd.DataFrame:
+    """
+    Score how well each config separates returns across levels.
+
+    eta_sq is the between-level share of return variance (one-way ANOVA);
+    spread is best minus worst level mean. Sorted best first.
+    """
+    m = metrics.copy()
+    m["s1"] = m["n"] * m["mean_ret"]
+    m["ss_within"] = (m["n"] - 1).clip(lower=0) * m["ret_std"].fillna(0) ** 2
+    g = m.groupby("config")
+    tot = g.agg(n=("n", "sum"), s1=("s1", "sum"), ss_within=("ss_within", "sum"),
+                best=("mean_ret", "max"), worst=("mean_ret", "min"))
+    grand = tot["s1"] / tot["n"]
+    m["ss_between"] = m["n"] * (m["mean_ret"] - m["config"].map(grand)) ** 2
+    tot["ss_between"] = m.groupby("config")["ss_between"].sum()
+
+    out = configs.set_index("config").join(tot, how="inner")
+    out["eta_sq"] = out["ss_between"] / (out["ss_between"] + out["ss_within"])
+    out["spread"] = out["best"] - out["worst"]
+    out = out.drop(columns=["s1", "ss_within", "ss_between"])
+    return out.sort_values(["eta_sq", "spread"], ascending=False).reset_index()
@@ -0,0 +1,144 @@
+
+# modules/shm_grid.py
+
+from __future__ import annotations
+
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from itertools import product
+from multiprocessing import shared_memory
+from typing import Callable, Mapping, Sequence
+
+import numpy as np
+
+from .exit_grid import ExitGrid
+
+__all__ = [
+    "SharedPanels",
+    "attach_panels",
+    "run_grid_parallel",
+]
+
+
+# ---------- shared panels
+
+class SharedPanels:
+    """
+    Named arrays (forward panels and per-trade vectors) copied once into
+    multiprocessing.shared_memory blocks. Workers attach by name, so memory
+    does not grow with the worker count. Use as a context manager; the
+    blocks are unlinked on exit.
+    """
+
+    def __init__(self, arrays: Mapping[str, np.ndarray]):
+        self._blocks: list[shared_memory.SharedMemory] = []
+        self.spec: dict[str, tuple[str, tuple[int, ...], str]] = {}
+        for name, a in arrays.items():
+            a = np.ascontiguousarray(a)
+            shm = shared_memory.SharedMemory(create=True, size=max(a.nbytes, 1))
+            np.ndarray(a.shape, dtype=a.dtype, buffer=shm.buf)[...] = a
+            self._blocks.append(shm)
+            self.spec[name] = (shm.name, a.shape, a.dtype.str)
+
+    @property
+    def nbytes(self) -> int:
+        return sum(b.size for b in self._blocks)
+
+    def close(self) -> None:
+        for b in self._blocks:
+            b.close()
+            b.unlink()
+        self._blocks = []
+
+    def __enter__(self) -> "SharedPanels":
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
+
+
+def attach_panels(spec: Mapping[str, tuple]) -> tuple[dict[str, np.ndarray], list]:
+    """
+    Zero-copy, read-only views of SharedPanels.spec; keep the handles alive while
+    in use. Only the creating process unlinks the blocks.
+    """
+    arrays, handles = {}, []
+    for name, (shm_name, shape, dtype) in spec.items():
+        shm = shared_memory.SharedMemory(name=shm_name)
+        a = np.ndarray(shape, dtype=np.dtype(dtype), buffer=shm.buf)
+        a.flags.writeable = False
+        arrays[name] = a
+        handles.append(shm)
+    return arrays, handles
+
+
+# ---------- workers
+
+_W = {}
+
+def _init_worker(spec, evaluate, start_key, cap_key):
+    panels, _W["handles"] = attach_panels(spec)
+    _W["grid"] = ExitGrid(panels, start=panels.get(start_key), cap_idx=panels.get(cap_key))
+    _W["evaluate"] = evaluate
+
+def _run_chunk(chunk):
+    return [(i, _W["evaluate"](_W["grid"], **combo)) for i, combo in chunk]
+
+
+def _progress(done: int, total: int, t0: float) -> None:
+    el = time.perf_counter() - t0
+    eta = el / done * (total - done) if done else float("nan")
+    sys.stderr.write(f"\r[{done}/{total}] {el:6.1f}s elapsed, ETA {eta:6.1f}s")
+    if done == total:
+        sys.stderr.write("\n")
+    sys.stderr.flush()
+
+
+# ---------- main API
+
+def run_grid_parallel(
+    axes: Mapping[str, Sequence],
+    evaluate: Callable[..., dict | None],
+    panels: Mapping[str, np.ndarray],
+    *,
+    workers: int = 1,
+    chunksize: int | None = None,
+    progress: bool = True,
+    start_key: str = "start",
+    cap_key: str = "cap_idx",
+) -> list[dict]:
+    """
+    evaluate(grid, **combo) for every combination of the axes, where grid is an
+    ExitGrid over `panels` (start/cap_idx taken from panels[start_key]/[cap_key]).
+    With workers > 1 the panels go into shared memory once and each worker
+    evaluates contiguous slices of the grid (so its ExitGrid memo still pays
+    off). Rows come back in product order; None results are skipped.
+    evaluate must be a module-level function (it is pickled by reference).
+    """
+    combos = [dict(zip(axes, c)) for c in product(*axes.values())]
+    n = len(combos)
+    out: list = [None] * n
+    t0 = time.perf_counter()
+    if workers <= 1 or n <= 1:
+        grid = ExitGrid(panels, start=panels.get(start_key), cap_idx=panels.get(cap_key))
+        for i, combo in enumerate(combos):
+            out[i] = evaluate(grid, **combo)
+            if progress:
+                _progress(i + 1, n, t0)
+        return [r for r in out if r is not None]
+
+    chunksize = chunksize or max(1, -(-n // (workers * 4)))
+    indexed = list(enumerate(combos))
+    chunks = [indexed[i:i + chunksize] for i in range(0, n, chunksize)]
+    with SharedPanels(panels) as shm:
+        with ProcessPoolExecutor(workers, initializer=_init_worker,
+                                 initargs=(shm.spec, evaluate, start_key, cap_key)) as pool:
+            done = 0
+            for fut in as_completed([pool.submit(_run_chunk, c) for c in chunks]):
+                for i, row in fut.result():
+                    out[i] = row
+                    done += 1
+                if progress:
+                    _progress(done, n, t0)
+    return [r for r in out if r is not None]
@@ -0,0 +1,168 @@
+
+# modules/trade_paths.py
+
+from __future__ import annotations
+
+import json
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Sequence
+
+import numpy as np
+import pandas as pd
+
+__all__ = [
+    "PATH_COLS",
+    "TradePaths",
+    "build_trade_paths",
+    "write_trade_paths",
+    "load_trade_paths",
+    "open_trade_paths",
+]
+
+PATHS_VERSION = 2
+# per-bar columns every exit tool needs; date/bar_index are kept for exit stamps
+PATH_COLS = ("close", "atr", "ret_from_entry")
+
+
+# ---------- helpers
+
+def _source_stamp(src: Path) -> dict:
+    st = src.stat()
+    return {"source": str(src.name), "source_bytes": int(st.st_size), "source_mtime_ns": int(st.st_mtime_ns)}
+
+
+def _cache_dir(src: Path) -> Path:
+    """trade_bars.csv -> trade_bars.paths/"""
+    return src.with_name(src.stem + ".paths")
+
+
+# ---------- main API
+
+@dataclass(frozen=True)
+class TradePaths:
+    """
+    Trade bar paths in CSR layout: trade i owns flat rows offsets[i]:offsets[i+1]
+    of every array (sorted by bar_index), trade_id[i] is its id (ascending;
+    the CSV's labels, so string ids stay distinct).
+    Exit rules become segment operations: no sort, no groupby.
+    """
+    trade_id: np.ndarray
+    offsets: np.ndarray
+    arrays: dict[str, np.ndarray]
+
+    @property
+    def n_trades(self) -> int:
+        return int(len(self.trade_id))
+
+    @property
+    def n_bars(self) -> int:
+        return int(self.offsets[-1])
+
+    def __getitem__(self, col: str) -> np.ndarray:
+        return self.arrays[col]
+
+    def lengths(self) -> np.ndarray:
+        return np.diff(self.offsets)
+
+    def starts(self) -> np.ndarray:
+        return self.offsets[:-1]
+
+    def segment_ids(self) -> np.ndarray:
+        """Trade position of every flat row."""
+        return np.repeat(np.arange(self.n_trades), self.lengths())
+
+    def last_index(self) -> np.ndarray:
+        """Within-trade index of each trade's last bar."""
+        return self.lengths() - 1
+
+    def gather(self, col: str, idx: np.ndarray) -> np.ndarray:
+        """col at within-trade index idx (broadcast over trades on the last axis)."""
+        return self.arrays[col][self.offsets[:-1] + np.asarray(idx, dtype=np.int64)]
+
+    def positions(self, trade_ids: Sequence) -> np.ndarray:
+        """Trade positions for trade_ids, -1 where a trade has no path."""
+        ids = np.asarray(trade_ids)
+        p = np.searchsorted(self.trade_id, ids)
+        pc = np.minimum(p, max(self.n_trades - 1, 0))
+        ok = (p < self.n_trades) & (self.trade_id[pc] == ids) if self.n_trades else np.zeros(len(ids), bool)
+        return np.where(ok, pc, -1)
+
+
+def _trade_labels(ids: pd.Series) -> tuple[np.ndarray, np.ndarray]:
+    """(codes, sorted unique labels) of a trade_id column of any dtype; integral floats become int64."""
+    if ids.isna().any():
+        raise ValueError(f"trade_id is missing on {int(ids.isna().sum())} rows")
+    # object ids (strings, mixed types) are compared as text so np.save needs no pickles
+    codes, labels = pd.factorize(ids.astype(str) if ids.dtype == object else ids, sort=True)
+    labels = np.asarray(labels)
+    if labels.dtype.kind == "f" and np.all(labels == np.round(labels)):
+        labels = labels.astype(np.int64)
+    elif labels.dtype.kind == "O":
+        labels = labels.astype(str)
+    return codes.astype(np.int64), labels
+
+
+def build_trade_paths(bars: pd.DataFrame, columns: Sequence[str] | None = None) -> TradePaths:
+    """Pack a long trade_bars frame (trade_id, bar_index, ...) into CSR arrays."""
+    cols = list(columns) if columns is not None else [c for c in PATH_COLS if c in bars.columns]
+    code, ids = _trade_labels(bars["trade_id"])
+    bi = pd.to_numeric(bars["bar_index"], errors="coerce")
+    if bi.isna().any() or (bi != np.round(bi)).any():
+        raise ValueError(f"bar_index is missing or not an integer on {int((bi.isna() | (bi != np.round(bi))).sum())} rows")
+    bi = bi.to_numpy(dtype=np.int64)
+    order = np.lexsort((bi, code))
+
+    offsets = np.searchsorted(code[order], np.arange(len(ids) + 1)).astype(np.int64)
+    arrays: dict[str, np.ndarray] = {"bar_index": bi[order]}
+    if "date" in bars.columns:
+        arrays["date"] = pd.to_datetime(bars["date"], errors="coerce").to_numpy(dtype="datetime64[ns]")[order]
+    for c in cols:
+        arrays[c] = pd.to_numeric(bars[c], errors="coerce").to_numpy(dtype=np.float64)[order]
+    return TradePaths(trade_id=ids, offsets=offsets, arrays=arrays)
+
+
+def write_trade_paths(paths: TradePaths, out_dir: str | Path, stamp: dict | None = None) -> Path:
+    """<out_dir>/{trade_id,offsets,<col>}.npy + meta.json."""
+    out_dir = Path(out_dir)
+    out_dir.mkdir(parents=True, exist_ok=True)
+    np.save(out_dir / "trade_id.npy", paths.trade_id)
+    np.save(out_dir / "offsets.npy", paths.offsets)
+    for c, a in paths.arrays.items():
+        np.save(out_dir / f"{c}.npy", a)
+    meta = {"version": PATHS_VERSION, "columns": list(paths.arrays),
+            "n_trades": paths.n_trades, "n_bars": paths.n_bars, **(stamp or {})}
+    (out_dir / "meta.json").write_text(json.dumps(meta, indent=2), encoding="utf-8")
+    return out_dir
+
+
+def load_trade_paths(out_dir: str | Path) -> TradePaths:
+    """Open a CSR store; per-bar arrays are memmapped."""
+    out_dir = Path(out_dir)
+    meta = json.loads((out_dir / "meta.json").read_text(encoding="utf-8"))
+    if meta.get("version") != PATHS_VERSION:
+        raise ValueError(f"{out_dir}: unsupported trade paths version {meta.get('version')}")
+    offsets = np.load(out_dir / "offsets.npy")
+    if int(offsets[-1]) != meta["n_bars"]:
+        raise ValueError(f"{out_dir}: offsets disagree with meta.json")
+    return TradePaths(trade_id=np.load(out_dir / "trade_id.npy"), offsets=offsets,
+                      arrays={c: np.load(out_dir / f"{c}.npy", mmap_mode="r") for c in meta["columns"]})
+
+
+def open_trade_paths(src: str | Path = "trade_bars.csv", *, rebuild: bool = False) -> TradePaths:
+    """
+    Trade paths for a trade_bars CSV (or a CSR directory). The CSV is parsed
+    once into <stem>.paths/ next to it and reused until the CSV changes.
+    """
+    src = Path(src)
+    if src.is_dir():
+        return load_trade_paths(src)
+    cache = _cache_dir(src)
+    stamp = _source_stamp(src)
+    if not rebuild and (cache / "meta.json").exists():
+        meta = json.loads((cache / "meta.json").read_text(encoding="utf-8"))
+        if meta.get("version") == PATHS_VERSION and all(meta.get(k) == v for k, v in stamp.items()):
+            return load_trade_paths(cache)
+    bars = pd.read_csv(src, parse_dates=["date"])
+    write_trade_paths(build_trade_paths(bars), cache, stamp)
+    return load_trade_paths(cache)
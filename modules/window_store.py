@@ -0,0 +1,463 @@
+
+# modules/window_store.py
+
+from __future__ import annotations
+
+import json
+import re
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Sequence
+
+import numpy as np
+import pandas as pd
+
+__all__ = [
+    "DedupWindows",
+    "WindowStore",
+    "write_window_store",
+    "load_window_store",
+    "long_to_window_store",
+    "wide_to_window_store",
+    "store_panels",
+    "write_dedup_windows",
+    "long_to_dedup_windows",
+    "load_dedup_windows",
+]
+
+STORE_VERSION = 1
+KEY_COLS = ("symbol", "entry_date")
+
+
+# ---------- helpers
+
+def _paths(stem: str | Path) -> tuple[Path, Path]:
+    """<stem>.npy (float32 tensor) + <stem>.json (sidecar)."""
+    stem = Path(stem)
+    if stem.suffix in (".npy", ".json"):
+        stem = stem.with_suffix("")
+    return stem.with_suffix(".npy"), stem.with_suffix(".json")
+
+
+def _keys_to_json(keys: pd.DataFrame) -> dict:
+    out = {}
+    for c in keys.columns:
+        s = keys[c]
+        if pd.api.types.is_datetime64_any_dtype(s):
+            out[c] = {"dtype": "datetime", "values": [None if pd.isna(v) else v.isoformat() for v in s]}
+        else:
+            out[c] = {"dtype": str(s.dtype), "values": s.astype(object).where(s.notna(), None).tolist()}
+    return out
+
+
+def _keys_from_json(d: dict) -> pd.DataFrame:
+    cols = {}
+    for c, spec in d.items():
+        if spec["dtype"] == "datetime":
+            cols[c] = pd.to_datetime(pd.Series(spec["values"], dtype=object))
+        else:
+            cols[c] = pd.Series(spec["values"])
+    return pd.DataFrame(cols)
+
+
+def _allocate(stem, n_trades: int, offsets: np.ndarray, features: Sequence[str]) -> np.memmap:
+    npy, _ = _paths(stem)
+    npy.parent.mkdir(parents=True, exist_ok=True)
+    arr = np.lib.format.open_memmap(npy, mode="w+", dtype=np.float32,
+                                    shape=(n_trades, len(offsets), len(features)))
+    arr[:] = np.nan
+    return arr
+
+
+def _write_sidecar(stem, features: Sequence[str], offsets: np.ndarray, keys: pd.DataFrame) -> None:
+    _, side = _paths(stem)
+    meta = {
+        "version": STORE_VERSION,
+        "layout": ["trade", "offset", "feature"],
+        "dtype": "float32",
+        "features": list(features),
+        "offset_start": int(offsets[0]),
+        "offset_stop": int(offsets[-1]),
+        "n_trades": int(len(keys)),
+        "keys": _keys_to_json(keys.reset_index(drop=True)),
+    }
+    side.write_text(json.dumps(meta), encoding="utf-8")
+
+
+# ---------- main API
+
+@dataclass(frozen=True)
+class WindowStore:
+    """
+    Post-breakout windows as one (n_trades, n_offsets, n_features) float32 tensor.
+
+    values is a read-only memmap; panel()/panels() return zero-copy views,
+    e.g. store.panel("rsi", 0) is the (n_trades, T) forward RSI matrix the
+    exit searches used to rebuild from rsi_d* columns.
+    """
+    values: np.ndarray
+    features: tuple[str, ...]
+    offsets: np.ndarray
+    keys: pd.DataFrame
+
+    @property
+    def n_trades(self) -> int:
+        return int(self.values.shape[0])
+
+    def _oslice(self, lo: int | None, hi: int | None) -> slice:
+        o0 = int(self.offsets[0])
+        a = 0 if lo is None else max(int(lo) - o0, 0)
+        b = len(self.offsets) if hi is None else min(int(hi) - o0 + 1, len(self.offsets))
+        return slice(a, b)
+
+    def panel(self, feature: str, lo: int | None = None, hi: int | None = None) -> np.ndarray:
+        """(n_trades, offsets lo..hi inclusive) view of one feature."""
+        try:
+            j = self.features.index(feature)
+        except ValueError:
+            raise KeyError(f"feature {feature!r} not in store; have {list(self.features)}") from None
+        return self.values[:, self._oslice(lo, hi), j]
+
+    def panels(self, features: Sequence[str], lo: int | None = None, hi: int | None = None) -> dict[str, np.ndarray]:
+        return {f: self.panel(f, lo, hi) for f in features}
+
+
+def write_window_store(
+    stem: str | Path,
+    values: np.ndarray,
+    features: Sequence[str],
+    offsets: Sequence[int],
+    keys: pd.DataFrame,
+) -> Path:
+    """Persist an in-memory tensor; offsets must be a contiguous ascending range."""
+    offsets = np.asarray(offsets, dtype=np.int64)
+    if values.shape != (len(keys), len(offsets), len(features)):
+        raise ValueError(f"values shape {values.shape} != (trades, offsets, features) "
+                         f"{(len(keys), len(offsets), len(features))}")
+    if len(offsets) and not np.array_equal(offsets, np.arange(offsets[0], offsets[-1] + 1)):
+        raise ValueError("offsets must be a contiguous ascending range")
+    arr = _allocate(stem, len(keys), offsets, features)
+    arr[:] = values
+    arr.flush()
+    _write_sidecar(stem, features, offsets, keys)
+    return _paths(stem)[0]
+
+
+def load_window_store(stem: str | Path) -> WindowStore:
+    """Open a store written by write_window_store/long_to_window_store (no parsing, memmap)."""
+    npy, side = _paths(stem)
+    meta = json.loads(side.read_text(encoding="utf-8"))
+    if meta.get("version") != STORE_VERSION:
+        raise ValueError(f"{side}: unsupported window store version {meta.get('version')}")
+    values = np.load(npy, mmap_mode="r")
+    offsets = np.arange(meta["offset_start"], meta["offset_stop"] + 1)
+    if values.shape != (meta["n_trades"], len(offsets), len(meta["features"])):
+        raise ValueError(f"{npy}: shape {values.shape} disagrees with sidecar {side}")
+    return WindowStore(values=values, features=tuple(meta["features"]), offsets=offsets,
+                       keys=_keys_from_json(meta["keys"]))
+
+
+def long_to_window_store(
+    df: pd.DataFrame,
+    stem: str | Path,
+    features: Sequence[str],
+    *,
+    key_cols: Sequence[str] = KEY_COLS,
+    offset_col: str = "bar_offset",
+    lo: int | None = None,
+    hi: int | None = None,
+) -> WindowStore:
+    """
+    Scatter a long windows frame (one row per trade x bar_offset) straight
+    into the on-disk tensor. Trades are ordered by key_cols; missing bars are NaN.
+    """
+    off = pd.to_numeric(df[offset_col], errors="coerce")
+    df = df.loc[off.notna()]
+    off = off[off.notna()].astype(np.int64).to_numpy()
+    lo = int(off.min()) if lo is None else int(lo)
+    hi = int(off.max()) if hi is None else int(hi)
+    keep = (off >= lo) & (off <= hi)
+    df, off = df.loc[keep], off[keep]
+
+    keys = df[list(key_cols)].drop_duplicates().sort_values(list(key_cols)).reset_index(drop=True)
+    codes = pd.MultiIndex.from_frame(keys).get_indexer(pd.MultiIndex.from_frame(df[list(key_cols)]))
+    offsets = np.arange(lo, hi + 1)
+
+    arr = _allocate(stem, len(keys), offsets, features)
+    x = df[list(features)].apply(pd.to_numeric, errors="coerce").to_numpy(dtype=np.float32)
+    arr[codes, off - lo, :] = x
+    arr.flush()
+    _write_sidecar(stem, features, offsets, keys)
+    return load_window_store(stem)
+
+
+def wide_to_window_store(
+    df: pd.DataFrame,
+    stem: str | Path,
+    prefixes: Sequence[str],
+    *,
+    key_cols: Sequence[str] = KEY_COLS,
+) -> WindowStore:
+    """Convert a wide `{feature}_d{k}` frame (exit-search layout) into a store; row order is kept."""
+    found: dict[str, dict[int, str]] = {}
+    for p in prefixes:
+        pat = re.compile(rf"^{re.escape(p)}_d(-?\d+)$")
+        found[p] = {int(m.group(1)): c for c in df.columns if (m := pat.match(c))}
+    ks = [k for cols in found.values() for k in cols]
+    if not ks:
+        raise KeyError(f"no {{prefix}}_d{{k}} columns found for prefixes {list(prefixes)}")
+    offsets = np.arange(min(ks), max(ks) + 1)
+
+    keys = df[[c for c in key_cols if c in df.columns]].reset_index(drop=True)
+    arr = _allocate(stem, len(df), offsets, prefixes)
+    for j, p in enumerate(prefixes):
+        for k, c in found[p].items():
+            arr[:, k - offsets[0], j] = pd.to_numeric(df[c], errors="coerce").to_numpy(dtype=np.float32)
+    arr.flush()
+    _write_sidecar(stem, prefixes, offsets, keys)
+    return load_window_store(stem)
+
+
+def store_panels(
+    stem: str | Path,
+    names: Sequence[str],
+    like: pd.DataFrame | None = None,
+    *,
+    lo: int = 0,
+    symbol_col: str = "symbol",
+) -> dict[str, np.ndarray]:
+    """
+    float64 (n_trades, offsets lo..) panels for an exit script from a store written
+    by `build_window_store.py --wide --src <csv>`: what forward_cols + to_numpy
+    produce from the csv's `{name}_d{k}` columns (rounded to the store's float32),
+    without parsing them.
+
+    like is the csv as read (same rows, same order); a store with another row
+    count or other symbols is rejected rather than silently misaligned.
+    """
+    store = load_window_store(stem)
+    if like is not None and (store.n_trades != len(like) or (
+            symbol_col in store.keys and symbol_col in like
+            and not (store.keys[symbol_col].to_numpy() == like[symbol_col].to_numpy()).all())):
+        raise ValueError(f"{stem}: window store rows do not match the input csv; "
+                         f"rebuild it with build_window_store.py --wide")
+    return {n: np.asarray(store.panel(n, lo), dtype=np.float64) for n in names}
+
+
+# ---------- deduplicated windows (bars once per symbol + window references)
+
+DEDUP_VERSION = 1
+
+
+@dataclass(frozen=True)
+class DedupWindows:
+    """
+    Overlapping trade windows stored without repetition.
+
+    bars[col] is one flat array holding every symbol's covered bar range once
+    (plus the own rows of any trade whose bars disagree with it); refs has one row per trade: its metadata plus `start` (flat row of its
+    first bar), `length` and `first_offset` (bar offset of that first bar).
+    Nothing is materialized until window()/panel()/to_long() is called.
+    """
+    bars: dict[str, np.ndarray]
+    refs: pd.DataFrame
+    symbols: pd.DataFrame
+
+    def window(self, i: int) -> dict[str, np.ndarray]:
+        """Zero-copy slices of trade i's bars."""
+        a = int(self.refs["start"].iat[i])
+        b = a + int(self.refs["length"].iat[i])
+        return {c: v[a:b] for c, v in self.bars.items()}
+
+    def panel(self, col: str, lo: int, hi: int) -> np.ndarray:
+        """
+        (n_trades, hi-lo+1) materialized view of col at offsets lo..hi, filled outside
+        the window with NaT (datetimes), None (objects) or NaN; integer and bool
+        columns come back as float64 so they can hold the NaN.
+        """
+        start = self.refs["start"].to_numpy(dtype=np.int64)
+        length = self.refs["length"].to_numpy(dtype=np.int64)
+        rel = np.arange(lo, hi + 1)[None, :] - self.refs["first_offset"].to_numpy(dtype=np.int64)[:, None]
+        valid = (rel >= 0) & (rel < length[:, None])
+        src = self.bars[col]
+        out = src[np.where(valid, start[:, None] + rel, 0)]
+        kind = src.dtype.kind
+        if kind in "mM":
+            out[~valid] = np.datetime64("NaT") if kind == "M" else np.timedelta64("NaT")
+        elif kind == "O":
+            out[~valid] = None
+        else:
+            if kind in "biu":
+                out = out.astype(np.float64)
+            out[~valid] = np.nan
+        return out
+
+    def to_long(self, columns: Sequence[str] | None = None, offset_col: str = "bar_offset") -> pd.DataFrame:
+        """Long (trade x bar) frame with trade metadata, built on demand."""
+        cols = list(columns) if columns is not None else list(self.bars)
+        length = self.refs["length"].to_numpy(dtype=np.int64)
+        trade = np.repeat(np.arange(len(self.refs)), length)
+        within = np.arange(length.sum()) - np.repeat(np.cumsum(length) - length, length)
+        flat = self.refs["start"].to_numpy(dtype=np.int64)[trade] + within
+        out = pd.DataFrame({c: self.bars[c][flat] for c in cols})
+        out[offset_col] = self.refs["first_offset"].to_numpy(dtype=np.int64)[trade] + within
+        meta = self.refs.drop(columns=["start", "length", "first_offset"]).iloc[trade].reset_index(drop=True)
+        return pd.concat([out, meta[[c for c in meta.columns if c not in out.columns]]], axis=1)
+
+
+def _write_dedup(out_dir: str | Path, bars: dict[str, np.ndarray], refs: pd.DataFrame, symbols: pd.DataFrame) -> Path:
+    out_dir = Path(out_dir)
+    out_dir.mkdir(parents=True, exist_ok=True)
+    for c, a in bars.items():
+        np.save(out_dir / f"bars_{c}.npy", a)
+    refs.to_parquet(out_dir / "windows.parquet", index=False)
+    meta = {
+        "version": DEDUP_VERSION,
+        "columns": list(bars),
+        "n_bars": int(len(next(iter(bars.values())))) if bars else 0,
+        "symbols": symbols.to_dict(orient="records"),
+    }
+    (out_dir / "meta.json").write_text(json.dumps(meta, indent=2), encoding="utf-8")
+    return out_dir
+
+
+def load_dedup_windows(out_dir: str | Path) -> DedupWindows:
+    """Open a deduplicated windows directory; bar columns are memmapped."""
+    out_dir = Path(out_dir)
+    meta = json.loads((out_dir / "meta.json").read_text(encoding="utf-8"))
+    if meta.get("version") != DEDUP_VERSION:
+        raise ValueError(f"{out_dir}: unsupported dedup windows version {meta.get('version')}")
+    bars = {c: np.load(out_dir / f"bars_{c}.npy", mmap_mode="r") for c in meta["columns"]}
+    return DedupWindows(bars=bars, refs=pd.read_parquet(out_dir / "windows.parquet"),
+                        symbols=pd.DataFrame(meta["symbols"]))
+
+
+def _concat_spans(spans: list[tuple[str, dict[str, np.ndarray]]], columns: Sequence[str]):
+    starts, n = [], 0
+    for sym, cols in spans:
+        k = len(cols[columns[0]]) if columns else 0
+        starts.append({"symbol": sym, "start": n, "length": k})
+        n += k
+    bars = {c: (np.concatenate([cols[c] for _, cols in spans]) if spans else np.empty(0)) for c in columns}
+    return bars, pd.DataFrame(starts, columns=["symbol", "start", "length"])
+
+
+def write_dedup_windows(
+    out_dir: str | Path,
+    events: pd.DataFrame,
+    pre: int,
+    post: int,
+    columns: Sequence[str] | None = None,
+    *,
+    symbol_col: str = "symbol",
+    anchor_col: str = "entry_date",
+    match: str = "exact",
+    loader=None,
+) -> DedupWindows:
+    """
+    Build deduplicated windows straight from the bar panels: per symbol only
+    the union span of its trades' [anchor-pre, anchor+post] ranges is stored.
+    """
+    from .windows import load_symbol_bars, window_index
+
+    loader = loader or load_symbol_bars
+    spans, refs = [], []
+    n = 0
+    cols = None
+    for symbol, g in events.groupby(symbol_col, sort=True):
+        hist = loader(symbol)
+        if hist is None or hist.empty:
+            continue
+        if cols is None:
+            cols = list(columns) if columns is not None else (
+                ["date"] + [c for c in hist.columns if c != "date" and pd.api.types.is_numeric_dtype(hist[c])])
+        dates = hist["date"].to_numpy(dtype="datetime64[ns]")
+        anchors = pd.to_datetime(g[anchor_col], errors="coerce").to_numpy(dtype="datetime64[ns]")
+        found, pos, _, _ = window_index(dates, anchors, pre, post, match=match)
+        if not found.any():
+            continue
+        first = np.maximum(pos - pre, 0)
+        last = np.minimum(pos + post, len(dates) - 1)
+        lo, hi = int(first.min()), int(last.max())
+        spans.append((symbol, {c: hist[c].to_numpy()[lo:hi + 1] if c in hist.columns
+                               else np.full(hi - lo + 1, np.nan) for c in cols}))
+        r = g.loc[found].copy()
+        r["start"] = n + (first - lo)
+        r["length"] = last - first + 1
+        r["first_offset"] = first - pos
+        refs.append(r)
+        n += hi - lo + 1
+
+    bars, symbols = _concat_spans(spans, cols or [])
+    refs = pd.concat(refs, ignore_index=True) if refs else pd.DataFrame(columns=["start", "length", "first_offset"])
+    _write_dedup(out_dir, bars, refs, symbols)
+    return load_dedup_windows(out_dir)
+
+
+def _same(a: np.ndarray, b: np.ndarray) -> np.ndarray:
+    """Elementwise equality that treats two missing values as equal."""
+    return (a == b) | (pd.isna(a) & pd.isna(b))
+
+
+def long_to_dedup_windows(
+    df: pd.DataFrame,
+    out_dir: str | Path,
+    bar_columns: Sequence[str],
+    *,
+    key_cols: Sequence[str] = KEY_COLS,
+    offset_col: str = "bar_offset",
+) -> DedupWindows:
+    """
+    Convert an existing long windows frame: bars are deduplicated on
+    (symbol, date); every other non-bar column is kept once per trade.
+
+    A trade is served from the shared bars only if its rows are exactly a run
+    of the symbol's unique dates with the same bar values; any other trade
+    (skipped dates, its own prices for a date) keeps its rows appended to the
+    symbol's span. Offsets must be consecutive within each trade.
+    """
+    spans, refs = [], []
+    n = 0
+    keys = list(key_cols)
+    meta_cols = [c for c in df.columns if c not in bar_columns and c not in (offset_col, "date")]
+    for symbol, g in df.groupby("symbol", sort=True):
+        g = g.sort_values([*keys, offset_col], kind="stable")
+        trade = g.groupby(keys, sort=False).ngroup().to_numpy()
+        within = g.groupby(keys, sort=False).cumcount().to_numpy()
+        head = within == 0
+        off = g[offset_col].to_numpy(dtype=np.int64)
+        first_off = off[head][trade]
+        if (off != first_off + within).any():
+            bad = g.loc[off != first_off + within, keys].drop_duplicates().head(3).to_dict("records")
+            raise ValueError(f"{symbol}: trades with non-consecutive {offset_col} cannot be stored as windows, e.g. {bad}")
+
+        uniq = g.drop_duplicates("date").sort_values("date")
+        dates = uniq["date"].to_numpy(dtype="datetime64[ns]")
+        gd = g["date"].to_numpy(dtype="datetime64[ns]")
+        pos = np.searchsorted(dates, gd)
+        start = pos[head][trade]
+        ok = (pos == start + within)
+        for c in bar_columns:
+            ok &= _same(g[c].to_numpy(), uniq[c].to_numpy()[pos])
+        fits = np.ones(trade.max() + 1 if len(trade) else 0, dtype=bool)
+        np.logical_and.at(fits, trade, ok)
+
+        # trades that do not match the shared bars keep their own rows after them
+        own = ~fits[trade]
+        span = {"date": np.concatenate([dates, gd[own]]),
+                **{c: np.concatenate([uniq[c].to_numpy(), g[c].to_numpy()[own]]) for c in bar_columns}}
+        spans.append((symbol, span))
+
+        length = np.bincount(trade, minlength=len(fits))
+        own_start = len(dates) + np.cumsum(np.where(fits, 0, length)) - np.where(fits, 0, length)
+        r = g.loc[head, meta_cols].reset_index(drop=True)
+        r["start"] = n + np.where(fits, start[head], own_start)
+        r["length"] = length
+        r["first_offset"] = off[head]
+        refs.append(r)
+        n += len(span["date"])
+
+    bars, symbols = _concat_spans(spans, ["date", *bar_columns])
+    refs = pd.concat(refs, ignore_index=True)
+    _write_dedup(out_dir, bars, refs, symbols)
+    return load_dedup_windows(out_dir)
@@ -0,0 +1,196 @@
+
+# modules/windows.py
+
+from __future__ import annotations
+
+from dataclasses import dataclass, field
+from functools import lru_cache
+from pathlib import Path
+from typing import Callable, Sequence
+
+import numpy as np
+import pandas as pd
+
+__all__ = [
+    "OHLCV_DIR",
+    "Windows",
+    "extract_windows",
+    "load_symbol_bars",
+    "window_index",
+]
+
+OHLCV_DIR = Path("Data") / "Filtered_OHLCV"
+PRICE_COLS = ("open", "high", "low", "close", "volume")
+
+
+# ---------- per-symbol panel cache
+
+@lru_cache(maxsize=128)
+def _read_symbol_csv(symbol: str, folder: str) -> pd.DataFrame | None:
+    f = Path(folder) / f"{symbol}.csv"
+    if not f.exists():
+        for alt in (symbol.replace("/", "-"), symbol.replace(":", "-"), symbol.replace("_", "-")):
+            g = Path(folder) / f"{alt}.csv"
+            if g.exists():
+                f = g
+                break
+        else:
+            return None
+    d = pd.read_csv(f)
+    d.columns = [str(c).strip().lower() for c in d.columns]
+    if "date" not in d.columns:
+        for alt in ("time", "timestamp", "datetime"):
+            if alt in d.columns:
+                d = d.rename(columns={alt: "date"})
+                break
+    d["date"] = pd.to_datetime(d["date"], errors="coerce")
+    for c in PRICE_COLS:
+        if c in d.columns:
+            d[c] = pd.to_numeric(d[c], errors="coerce")
+    # drop junk header rows (e.g. ",ETH-USD,ETH-USD,..." under the header)
+    return d.dropna(subset=["date"]).sort_values("date", kind="stable").reset_index(drop=True)
+
+
+def load_symbol_bars(symbol: str, folder: str | Path = OHLCV_DIR) -> pd.DataFrame | None:
+    """
+    One symbol's bar panel (date-sorted, typed), parsed once per process.
+
+    The frame is shared by every caller through an LRU cache: treat it as
+    read-only and .copy() before adding columns.
+    """
+    return _read_symbol_csv(str(symbol), str(folder))
+
+
+# ---------- window extraction
+
+def window_index(
+    dates: np.ndarray,
+    anchors: np.ndarray,
+    pre: int,
+    post: int,
+    match: str = "exact",
+) -> tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Bar indices for [anchor-pre, anchor+post] windows over a sorted date array.
+
+    match="exact": anchor must equal exactly one bar date.
+    match="snap":  anchor snaps to the first bar at/after it (searchsorted left).
+    Returns (found[n_anchors], pos[n_found], idx[n_found, n_off], valid[n_found, n_off]);
+    idx is clipped into range, valid marks bars that really exist.
+    """
+    n = len(dates)
+    pos = np.searchsorted(dates, anchors, side="left")
+    if n == 0:
+        found = np.zeros(len(anchors), dtype=bool)
+    elif match == "exact":
+        pc = np.minimum(pos, n - 1)
+        nx = np.minimum(pc + 1, n - 1)
+        found = (pos < n) & (dates[pc] == anchors) & ~((pc + 1 < n) & (dates[nx] == anchors))
+    elif match == "snap":
+        found = pos < n
+    else:
+        raise ValueError(f"match must be 'exact' or 'snap', got {match!r}")
+    pos = pos[found]
+
+    raw = pos[:, None] + np.arange(-pre, post + 1)[None, :]
+    valid = (raw >= 0) & (raw < n)
+    idx = np.clip(raw, 0, max(n - 1, 0))
+    return found, pos, idx, valid
+
+
+@dataclass
+class Windows:
+    """
+    Aligned (events x offsets) arrays for a batch of (symbol, anchor) events.
+
+    events holds the matched input rows (input order, original index);
+    arrays[col][i, j] is col at offset offsets[j] of event i, NaN/NaT where
+    valid[i, j] is False (before the first / after the last bar).
+    """
+    offsets: np.ndarray
+    events: pd.DataFrame
+    pos: np.ndarray
+    valid: np.ndarray
+    arrays: dict[str, np.ndarray]
+    missing_symbols: list[str] = field(default_factory=list)
+
+    def __len__(self) -> int:
+        return len(self.events)
+
+    def __getitem__(self, col: str) -> np.ndarray:
+        return self.arrays[col]
+
+    def to_long(self, offset_col: str = "bar_offset") -> pd.DataFrame:
+        """One row per existing bar (event-major, offset-minor), plus offset_col."""
+        ii, jj = np.nonzero(self.valid)
+        out = pd.DataFrame({c: a[ii, jj] for c, a in self.arrays.items()})
+        out[offset_col] = self.offsets[jj]
+        return out
+
+    def lengths(self) -> np.ndarray:
+        return self.valid.sum(axis=1)
+
+
+def extract_windows(
+    events: pd.DataFrame,
+    pre: int = 0,
+    post: int = 0,
+    columns: Sequence[str] | None = None,
+    *,
+    symbol_col: str = "symbol",
+    anchor_col: str = "entry_date",
+    match: str = "exact",
+    loader: Callable[[str], pd.DataFrame | None] = load_symbol_bars,
+) -> Windows:
+    """
+    Pull [anchor-pre, anchor+post] bar windows for (symbol, anchor) events.
+
+    Each symbol's panel comes from `loader` (default: cached Filtered_OHLCV
+    CSVs; pass any callable returning a date-sorted frame to serve indicator
+    panels), anchors are located with one searchsorted per symbol and every
+    column is gathered with one fancy index. columns defaults to date + all
+    numeric panel columns. Events whose anchor is not matched are dropped.
+    """
+    offsets = np.arange(-pre, post + 1)
+    n_off = len(offsets)
+    anchors_all = pd.to_datetime(events[anchor_col], errors="coerce").to_numpy(dtype="datetime64[ns]")
+
+    found = np.zeros(len(events), dtype=bool)
+    pos = np.zeros(len(events), dtype=np.int64)
+    valid = np.zeros((len(events), n_off), dtype=bool)
+    arrays: dict[str, np.ndarray] = {}
+    missing: list[str] = []
+
+    groups = events.groupby(symbol_col, sort=False).indices if len(events) else {}
+    for symbol, rows in groups.items():
+        hist = loader(symbol)
+        if hist is None or hist.empty:
+            missing.append(symbol)
+            continue
+        cols = list(columns) if columns is not None else (
+            ["date"] + [c for c in hist.columns if c != "date" and pd.api.types.is_numeric_dtype(hist[c])])
+
+        dates = hist["date"].to_numpy(dtype="datetime64[ns]")
+        f, p, idx, v = window_index(dates, anchors_all[rows], pre, post, match=match)
+        hit = rows[f]
+        found[hit], pos[hit], valid[hit] = True, p, v
+
+        for c in cols:
+            if c not in arrays:
+                is_dt = c == "date" or (c in hist.columns and pd.api.types.is_datetime64_any_dtype(hist[c]))
+                arrays[c] = (np.full((len(events), n_off), np.datetime64("NaT"), dtype="datetime64[ns]") if is_dt
+                             else np.full((len(events), n_off), np.nan))
+            if c not in hist.columns:
+                continue
+            src = hist[c].to_numpy(dtype=arrays[c].dtype)
+            fill = np.datetime64("NaT") if arrays[c].dtype.kind == "M" else np.nan
+            arrays[c][hit] = np.where(v, src[idx], fill)
+
+    return Windows(
+        offsets=offsets,
+        events=events.iloc[np.nonzero(found)[0]],
+        pos=pos[found],
+        valid=valid[found],
+        arrays={c: a[found] for c, a in arrays.items()},
+        missing_symbols=missing,
+    )
@@ -3,7 +3,12 @@
 Label each rolling window with its exit time/price/reason, plus binary flags.
 """
 
-import math
+import argparse
+import contextlib
+import os
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
 import numpy as np
 import pandas as pd
 import pyarrow as pa
@@ -18,82 +23,125 @@ OUT_PARQUET = Path("labeled_holy_grail_static_221_windows_long.parquet")
 _TP_PCT = {1: .45, 2: .44, 3: .42, 4: .40, 5: .38, 6: .36, 7: .35, 8: .34, 9: .33}
 _MAXBAR = {1: 11,  2: 10,  3:  9,  4:  8,  5:  7,  6:  7,  7:  6,  8:  6,  9:  5}
 
-def _safe_level(val) -> int:
+# vector lookups indexed by level (slot 0 unused)
+_TP_ARR = np.array([np.nan] + [_TP_PCT[l] for l in range(1, 10)])
+_MAXBAR_ARR = np.array([0] + [_MAXBAR[l] for l in range(1, 10)])
+_NBARS = max(_MAXBAR.values()) + 1
+
+def _safe_levels(s: pd.Series) -> np.ndarray:
     """Convert market_level to integer 1–9, default=5 on failure."""
-    try:
-        lvl = int(round(float(val)))
-        return max(1, min(9, lvl))
-    except Exception:
-        return 5
-
-def compute_exit(row: pd.Series):
-    """Compute (exit_time, exit_price, exit_reason) per M18 logic."""
-    sym = row.get("symbol", "")
-    if not isinstance(sym, str) or not sym:
-        return pd.NaT, np.nan, "MISSING"
-
-    # parse entry_date
-    ent_dt = row.get("entry_date", pd.NaT)
-    if not pd.api.types.is_datetime64_any_dtype(type(ent_dt)) and pd.isna(ent_dt):
-        return pd.NaT, np.nan, "MISSING"
-
-    # coerce entry_price → float
-    try:
-        ent_px = float(row.get("entry_price"))
-    except Exception:
-        return pd.NaT, np.nan, "MISSING"
-
-    lvl = _safe_level(row.get("market_level", 5))
-    tp_pct = _TP_PCT[lvl]
-    max_b = _MAXBAR[lvl]
-    tp_target = ent_px * (1 + tp_pct)
-
-    # gather the next bars' close-prices
-    closes = []
-    for i in range(max_b + 1):
-        key = sym if i == 0 else f"{sym}.{i}"
-        val = row.get(key, np.nan)
-        try:
-            closes.append(float(val))
-        except Exception:
-            closes.append(np.nan)
-
-    # 1) TP exit
-    for i, px in enumerate(closes[1:], start=1):
-        if not np.isnan(px) and px >= tp_target:
-            return ent_dt + pd.Timedelta(hours=i), px, "TP"
+    v = pd.to_numeric(s, errors="coerce").to_numpy(dtype=float)
+    lvl = np.where(np.isfinite(v), np.clip(np.round(v), 1, 9), 5)
+    return lvl.astype(np.int64)
+
+def _close_matrix(df: pd.DataFrame, sym: pd.Series) -> np.ndarray:
+    """(rows × _NBARS) closes: bar i of a row lives in column `{sym}` (i=0) or `{sym}.{i}`."""
+    C = np.full((len(df), _NBARS), np.nan)
+    for s, rows in sym.groupby(sym, sort=False).indices.items():
+        for i in range(_NBARS):
+            key = s if i == 0 else f"{s}.{i}"
+            if key in df.columns:
+                C[rows, i] = pd.to_numeric(df[key].iloc[rows], errors="coerce").to_numpy(dtype=float)
+    return C
+
+def compute_exits(df: pd.DataFrame) -> pd.DataFrame:
+    """
+    Vectorized (exit_time, exit_price, exit_reason) per M18 logic for a whole frame:
+    TP on the first bar 1..max_b whose close ≥ entry·(1+tp), else TIME at the last
+    valid bar ≤ max_b (entry price if none).
+    """
+    n = len(df)
+    sym = df["symbol"] if "symbol" in df.columns else pd.Series([None] * n, index=df.index)
+    sym_ok = sym.map(lambda x: isinstance(x, str) and bool(x)).to_numpy(dtype=bool)
+
+    ent_dt = (pd.to_datetime(df["entry_date"], errors="coerce") if "entry_date" in df.columns
+              else pd.Series(pd.NaT, index=df.index))
+    if "entry_price" in df.columns:
+        raw_px = df["entry_price"]
+        ent_px = pd.to_numeric(raw_px, errors="coerce").to_numpy(dtype=float)
+        # float(None)/float("abc") failed in the row loop; float(nan) did not
+        px_ok = (np.ones(n, dtype=bool) if pd.api.types.is_numeric_dtype(raw_px)
+                 else (~np.isnan(ent_px) | raw_px.map(lambda x: isinstance(x, float)).to_numpy(dtype=bool)))
+    else:
+        ent_px = np.full(n, np.nan)
+        px_ok = np.zeros(n, dtype=bool)
+    ok = sym_ok & ent_dt.notna().to_numpy() & px_ok
+
+    lvl = _safe_levels(df["market_level"] if "market_level" in df.columns else pd.Series(5, index=df.index))
+    max_b = _MAXBAR_ARR[lvl]
+    tp_target = ent_px * (1 + _TP_ARR[lvl])
+
+    C = _close_matrix(df, sym.where(sym_ok, ""))
+    bars = np.arange(_NBARS)[None, :]
+    in_rng = (bars >= 1) & (bars <= max_b[:, None])
+
+    # 1) TP exit: first bar hitting the target (NaN never hits)
+    with np.errstate(invalid="ignore"):
+        hit = in_rng & (C >= tp_target[:, None])
+    is_tp = hit.any(axis=1)
+    tp_i = hit.argmax(axis=1)
 
     # 2) TIME exit at last valid bar ≤ max_b
-    valid = [i for i, px in enumerate(closes[1:], start=1) if not np.isnan(px)]
-    last_i = valid[-1] if valid else 0
-    idx = min(last_i, max_b)
-    exit_px = closes[idx] if idx and not np.isnan(closes[idx]) else ent_px
-    return ent_dt + pd.Timedelta(hours=idx), exit_px, "TIME"
+    valid = in_rng & ~np.isnan(C)
+    last_i = np.where(valid.any(axis=1), _NBARS - 1 - valid[:, ::-1].argmax(axis=1), 0)
+
+    rows = np.arange(n)
+    idx = np.where(is_tp, tp_i, last_i)
+    px = C[rows, idx]
+    px = np.where(is_tp | (idx > 0), px, ent_px)
+
+    reason = np.where(is_tp, "TP", "TIME").astype(object)
+    reason[~ok] = "MISSING"
+    px[~ok] = np.nan
+    exit_time = ent_dt + pd.to_timedelta(idx, unit="h")
+    exit_time[~ok] = pd.NaT
+
+    return pd.DataFrame({"exit_time": exit_time.to_numpy(), "exit_price": px, "exit_reason": reason},
+                        index=df.index)
+
+def label_row_group(src: str, rg: int) -> pa.Table:
+    """Read one row group, label it, return it as an Arrow table (runs in a worker)."""
+    df = pq.ParquetFile(src).read_row_group(rg).to_pandas()
+    df = pd.concat([df, compute_exits(df)], axis=1)
+
+    df["exit_label"]  = (df["exit_reason"] == "TP").astype("int8")
+    df["success_bin"] = df["exit_label"]
+    return pa.Table.from_pandas(df, preserve_index=False)
+
+def _ordered_tables(pool, src: str, n_rg: int, ahead: int):
+    """Labelled row groups in original order, at most `ahead` in flight."""
+    pending = deque()
+    for rg in range(n_rg):
+        pending.append(pool.submit(label_row_group, src, rg))
+        if len(pending) >= ahead:
+            yield pending.popleft().result()
+    while pending:
+        yield pending.popleft().result()
 
 def main():
-    print(f"Reading {SRC_PARQUET} …")
-    pf = pq.ParquetFile(SRC_PARQUET)
-
-    writer = None
-    for rg in tqdm(range(pf.num_row_groups), desc="Row-groups"):
-        df = pf.read_row_group(rg).to_pandas()
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--workers", type=int, default=os.cpu_count() or 1,
+                    help="processes labelling row groups in parallel (1 = in-process)")
+    a = ap.parse_args()
 
-        exits = df.apply(compute_exit, axis=1, result_type="expand")
-        exits.columns = ["exit_time", "exit_price", "exit_reason"]
-        df = pd.concat([df, exits], axis=1)
+    print(f"Reading {SRC_PARQUET} …")
+    n_rg = pq.ParquetFile(SRC_PARQUET).num_row_groups
 
-        df["exit_label"]  = (df["exit_reason"] == "TP").astype("int8")
-        df["success_bin"] = df["exit_label"]
+    with contextlib.ExitStack() as stack:
+        if a.workers > 1 and n_rg > 1:
+            pool = stack.enter_context(ProcessPoolExecutor(max_workers=a.workers))
+            tables = _ordered_tables(pool, str(SRC_PARQUET), n_rg, ahead=2 * a.workers)
+        else:
+            tables = (label_row_group(str(SRC_PARQUET), rg) for rg in range(n_rg))
 
-        tbl = pa.Table.from_pandas(df, preserve_index=False)
-        if writer is None:
-            writer = pq.ParquetWriter(OUT_PARQUET, tbl.schema)
-        writer.write_table(tbl)
+        writer = None
+        for tbl in tqdm(tables, total=n_rg, desc="Row-groups"):
+            if writer is None:
+                writer = pq.ParquetWriter(OUT_PARQUET, tbl.schema)
+            writer.write_table(tbl)
 
     writer.close()
     print(f"✅  Wrote {OUT_PARQUET}")
 
 if __name__ == "__main__":
     main()
-
-
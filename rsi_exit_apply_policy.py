@@ -1,8 +1,12 @@
 ﻿# rsi_exit_apply_policy.py
-import os, re, sys
+import argparse, os, sys
 import numpy as np
 import pandas as pd
 
+from modules.exit_cache import ExitCache
+from modules.exit_kernels import NO_HIT, at, forward_cols, peak_retrace_day, rsi_cross_day, tp_hit_day
+from modules.window_store import store_panels
+
 # ---- INPUT / OUTPUT (edit if you keep files elsewhere) ----
 IN  = r"C:\Users\milla\OneDrive\Documents\GitHub\m18-model2\data\Processed\breakout_trades_labeled_v2.csv"
 OUT = r"C:\Users\milla\OneDrive\Documents\GitHub\m18-model2\data\Processed\rsi_exit_applied_y75_d5_m3_tp_policy.csv"
@@ -11,6 +15,12 @@ OUT = r"C:\Users\milla\OneDrive\Documents\GitHub\m18-model2\data\Processed\rsi_e
 Y, DELTA, M = 75, 5, 3
 ALLOW_RSI_LEVELS = {4}       # enable RSI exits only where uplift was positive
 DEFER_1_BAR = True         # set True to defer the RSI exit by 1 bar
+USE_CACHE = True           # reuse exits from exit_out/.cache while IN and these knobs are unchanged
+
+ap = argparse.ArgumentParser()
+ap.add_argument("--store", default=None,
+                help="window store stem (build_window_store.py --wide --src IN) to read the forward panels from")
+STORE = ap.parse_args().store
 
 if not os.path.exists(IN):
     print("Input not found:", IN)
@@ -18,20 +28,9 @@ if not os.path.exists(IN):
 
 df = pd.read_csv(IN)
 
-def day_cols(prefix: str):
-    ks = []
-    for c in df.columns:
-        m = re.fullmatch(rf"{re.escape(prefix)}_d-?\d+", c)
-        if m:
-            k = int(c.split("d")[-1])
-            ks.append((k, c))
-    ks = [(k, c) for (k, c) in ks if k >= 0]
-    ks.sort()
-    return [c for _, c in ks]
-
-RSI   = df[day_cols("rsi")].to_numpy(float)
-HIGH  = df[day_cols("high")].to_numpy(float)
-CLOSE = df[day_cols("close")].to_numpy(float)
+fwd = (store_panels(STORE, ("rsi", "high", "close"), df) if STORE
+       else {n: df[forward_cols(df, n)].to_numpy(float) for n in ("rsi", "high", "close")})
+RSI, HIGH, CLOSE = fwd["rsi"], fwd["high"], fwd["close"]
 
 if "start_price" in df.columns:
     START = df["start_price"].astype(float).to_numpy()
@@ -52,76 +51,45 @@ HOLD = np.array([hold_by.get(int(x), 6)  for x in LVL])
 T = min(RSI.shape[1], HIGH.shape[1], CLOSE.shape[1]) - 1
 cap = np.minimum(HOLD, T)
 
-def find_tp(i: int):
-    th = START[i] * (1.0 + TP[i])
-    upto = int(cap[i])
-    for t in range(upto + 1):
-        if HIGH[i, t] >= th:
-            return t
-    return None
-
-def rsi_cross_idx(i: int):
-    r = RSI[i]; upto = int(cap[i])
-    for t in range(upto + 1):
-        seg = r[t:t+M]
-        if len(seg) == M and np.all(np.isfinite(seg)) and np.all(seg >= Y):
-            return t
-    return None
-
-def rsi_exit_idx(i: int, t_cross: int | None):
-    if t_cross is None:
-        return None
-    r = RSI[i]; upto = int(cap[i])
-    peak = -np.inf
-    for t in range(t_cross, upto + 1):
-        x = r[t]
-        if np.isfinite(x) and x > peak:
-            peak = x
-        if np.isfinite(peak) and np.isfinite(x) and (peak - x) >= DELTA:
-            return t
-    return None
-
-def close_at_timed(i: int):
-    h = int(HOLD[i])
-    # direct hit if available
-    if 0 <= h <= 9:
-        col = f"close_d{h}"
-        if col in df.columns and np.isfinite(df.iloc[i][col]):
-            return float(df.iloc[i][col])
-    # walk back to the latest available close
-    for k in range(min(h, 9), -1, -1):
-        col = f"close_d{k}"
-        if col in df.columns and np.isfinite(df.iloc[i][col]):
-            return float(df.iloc[i][col])
-    return np.nan
-
-exit_day, exit_type, exit_ret, timed_ret = [], [], [], []
-
-for i in range(len(df)):
-    t_tp    = find_tp(i)
-    t_timed = int(cap[i])
-    t_ex, ety = t_timed, "timed"
-
-    if int(LVL[i]) in ALLOW_RSI_LEVELS:
-        t_cross = rsi_cross_idx(i)
-        t_rsi   = rsi_exit_idx(i, t_cross)
-        if t_rsi is not None:
-            if DEFER_1_BAR:
-                t_rsi = min(t_rsi + 1, t_timed)
-            t_ex, ety = t_rsi, "rsi"
-
-    if t_tp is not None and (t_ex is None or t_tp <= t_ex):
-        t_ex, ety = t_tp, "tp"
-
-    if t_ex is not None and np.isfinite(CLOSE[i, t_ex]):
-        ret = CLOSE[i, t_ex] / START[i] - 1.0
-    else:
-        ret = np.nan
-
-    tc = close_at_timed(i)
-    tret = (tc / START[i] - 1.0) if np.isfinite(tc) else np.nan
-
-    exit_day.append(t_ex); exit_type.append(ety); exit_ret.append(ret); timed_ret.append(tret)
+def close_at_timed():
+    # close_d{HOLD} if available, else walk back to the latest available close (d0..d9)
+    C = np.column_stack([df[f"close_d{k}"].astype(float) if f"close_d{k}" in df.columns else np.full(len(df), np.nan)
+                         for k in range(10)])
+    ok = np.isfinite(C) & (np.arange(10)[None, :] <= np.minimum(HOLD, 9)[:, None])
+    last = np.where(ok.any(axis=1), 9 - ok[:, ::-1].argmax(axis=1), NO_HIT)
+    return at(C, last)
+
+# exits are cached per (policy knobs, IN file); they are recomputed whenever either changes
+POLICY = {"policy": "rsi_exit_apply_policy", "Y": Y, "delta": DELTA, "M": M, "rsi_levels": ALLOW_RSI_LEVELS,
+          "defer_1_bar": DEFER_1_BAR, "tp_by": tp_by, "hold_by": hold_by}
+
+def policy_exits():
+    t_tp = tp_hit_day(HIGH, START, TP, cap, mode="threshold")
+    t_ex = cap.astype(int)
+    exit_type = np.full(len(df), "timed", dtype=object)
+
+    t_cross = rsi_cross_day(RSI, Y, M, cap)
+    t_rsi   = peak_retrace_day(RSI, DELTA, start_idx=t_cross, cap_idx=cap)
+    if DEFER_1_BAR:
+        t_rsi = np.where(t_rsi != NO_HIT, np.minimum(t_rsi + 1, cap), NO_HIT)
+    use_rsi = np.isin(LVL, list(ALLOW_RSI_LEVELS)) & (t_rsi != NO_HIT)
+    t_ex[use_rsi] = t_rsi[use_rsi]
+    exit_type[use_rsi] = "rsi"
+
+    use_tp = (t_tp != NO_HIT) & (t_tp <= t_ex)
+    t_ex[use_tp] = t_tp[use_tp]
+    exit_type[use_tp] = "tp"
+
+    c = at(CLOSE, t_ex)
+    exit_day = t_ex
+    exit_ret = np.where(np.isfinite(c), c / START - 1.0, np.nan)
+    return exit_day, exit_ret, exit_type
+
+ex = ExitCache(enabled=USE_CACHE).fetch(POLICY, [IN], policy_exits)
+exit_day, exit_ret, exit_type = ex.idx, ex.ret, ex.kind
+
+tc = close_at_timed()
+timed_ret = np.where(np.isfinite(tc), tc / START - 1.0, np.nan)
 
 out = df.assign(exit_day=exit_day, exit_type=exit_type, exit_ret=exit_ret, timed_ret=timed_ret)
 out.to_csv(OUT, index=False)
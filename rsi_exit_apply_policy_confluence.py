@@ -1,4 +1,8 @@
-﻿import os, re, numpy as np, pandas as pd
+﻿import argparse, os, numpy as np, pandas as pd
+
+from modules.exit_cache import ExitCache
+from modules.exit_kernels import NO_HIT, at, forward_cols, peak_drop, peak_retrace_day, rsi_cross_day, tp_hit_day
+from modules.window_store import store_panels
 
 # --- INPUT/OUTPUT: hardcoded so PS vars aren't needed ---
 IN  = r"C:\Users\milla\OneDrive\Documents\GitHub\m18-model2\data\Processed\breakout_trades_labeled_v2.csv"
@@ -8,6 +12,7 @@ OUT = r"C:\Users\milla\OneDrive\Documents\GitHub\m18-model2\data\Processed\rsi_e
 Y, DELTA, M = 75, 5, 3           # threshold, retrace, consecutive bars
 DEFER_1_BAR = True               # defer exit one bar to reduce whipsaws
 ALLOWED_LVLS = {4}               # only allow RSI exits at level 4
+USE_CACHE = True                 # reuse exits from exit_out/.cache while IN and these knobs are unchanged
 
 # --- Confluence veto thresholds ---
 ADX_KEEP      = 5.0              # if ADX drop from peak < 5  -> veto RSI exit
@@ -18,25 +23,19 @@ MACD_KEEP_POS = 0.0              # if MACD histogram > 0      -> veto RSI exit
 tp_by   = {1:0.65,2:0.85,3:0.90,4:0.85,5:0.95,6:0.90,7:0.95,8:0.95,9:0.95}
 hold_by = {1:5,   2:5,   3:8,   4:6,   5:8,   6:6,   7:6,   8:7,   9:6}
 
-df = pd.read_csv(IN)
+ap = argparse.ArgumentParser()
+ap.add_argument("--store", default=None,
+                help="window store stem (build_window_store.py --wide --src IN) to read the forward panels from")
+STORE = ap.parse_args().store
 
-def cols(prefix:str):
-    ks=[]
-    for c in df.columns:
-        if re.fullmatch(rf"{re.escape(prefix)}_d-?\d+", c):
-            k=int(c.split("d")[-1])
-            if k>=0: ks.append((k,c))
-    ks.sort()
-    return [c for _,c in ks]
+df = pd.read_csv(IN)
 
 # arrays
-RSI  = df[cols("rsi")].to_numpy(float)
-MACD = df[cols("macd")].to_numpy(float)
-MSIG = df[cols("macd_signal")].to_numpy(float)
-ADX  = df[cols("adx")].to_numpy(float)
-BBW  = df[cols("bbw")].to_numpy(float)
-HIGH = df[cols("high")].to_numpy(float)
-CLOSE= df[cols("close")].to_numpy(float)
+PANELS = ("rsi", "macd", "macd_signal", "adx", "bbw", "high", "close")
+fwd = (store_panels(STORE, PANELS, df) if STORE
+       else {n: df[forward_cols(df, n)].to_numpy(float) for n in PANELS})
+RSI, MACD, MSIG, ADX, BBW = fwd["rsi"], fwd["macd"], fwd["macd_signal"], fwd["adx"], fwd["bbw"]
+HIGH, CLOSE = fwd["high"], fwd["close"]
 
 # start price fallback
 if "start_price" in df:
@@ -55,90 +54,48 @@ hold = np.array([hold_by.get(int(x),6)  for x in lvl], dtype=int)
 T   = min(RSI.shape[1], MACD.shape[1], MSIG.shape[1], ADX.shape[1], BBW.shape[1], HIGH.shape[1], CLOSE.shape[1]) - 1
 cap = np.minimum(hold, T)
 
-def find_tp(i):
-    thresh = start[i]*(1.0+tp[i])
-    upto   = int(cap[i])
-    for t in range(upto+1):
-        if HIGH[i,t] >= thresh:
-            return t
-    return None
-
-def rsi_cross_idx(i):
-    r = RSI[i]; upto = int(cap[i])
-    for t in range(upto+1):
-        seg = r[t:t+M]
-        if len(seg)==M and np.all(np.isfinite(seg)) and np.all(seg>=Y):
-            return t
-    return None
-
-def rsi_exit_idx(i, t_cross):
-    if t_cross is None: return None
-    r = RSI[i]; upto = int(cap[i])
-    peak = -np.inf
-    for t in range(t_cross, upto+1):
-        x = r[t]
-        if np.isfinite(x) and x>peak: peak = x
-        if np.isfinite(peak) and np.isfinite(x) and (peak - x) >= DELTA:
-            return t
-    return None
-
-def adx_drop_now(i, t):
-    a = ADX[i,:t+1]
-    if np.any(np.isfinite(a)):
-        m = np.nanmax(a)
-        x = ADX[i,t]
-        if np.isfinite(m) and np.isfinite(x):
-            return (m - x)
-    return np.inf
-
-def bbw_contract_now(i, t):
-    b = BBW[i,:t+1]
-    if np.any(np.isfinite(b)):
-        m = np.nanmax(b)
-        x = BBW[i,t]
-        if np.isfinite(m) and m>0 and np.isfinite(x):
-            return (m - x)/m
-    return np.inf
-
-def macd_hist_now(i, t):
-    x = MACD[i,t]; s = MSIG[i,t]
-    return (x - s) if (np.isfinite(x) and np.isfinite(s)) else -np.inf
-
-exit_day=[]; exit_type=[]; exit_ret=[]; timed_ret=[]
-
-for i in range(len(df)):
-    t_tp    = find_tp(i)
-    t_timed = int(cap[i])
-
-    # default: timed
-    t_ex, ety = t_timed, "timed"
+# exits are cached per (policy knobs, IN file); they are recomputed whenever either changes
+POLICY = {"policy": "rsi_exit_apply_policy_confluence", "Y": Y, "delta": DELTA, "M": M, "rsi_levels": ALLOWED_LVLS,
+          "defer_1_bar": DEFER_1_BAR, "adx_keep": ADX_KEEP, "bbw_keep": BBW_KEEP, "macd_keep_pos": MACD_KEEP_POS,
+          "tp_by": tp_by, "hold_by": hold_by}
+
+def policy_exits():
+    t_tp  = tp_hit_day(HIGH, start, tp, cap, mode="threshold")
+    t_ex  = cap.astype(int)
+    exit_type = np.full(len(df), "timed", dtype=object)
 
     # RSI candidate only if level allowed
-    if int(lvl[i]) in ALLOWED_LVLS:
-        tcross = rsi_cross_idx(i)
-        t_rsi  = rsi_exit_idx(i, tcross)
-        if t_rsi is not None and DEFER_1_BAR:
-            t_rsi = min(t_rsi+1, t_timed)
-        if t_rsi is not None:
-            veto = False
-            ad_drop = adx_drop_now(i, t_rsi)
-            bbw_ctr = bbw_contract_now(i, t_rsi)
-            mh      = macd_hist_now(i, t_rsi)
-            if np.isfinite(ad_drop) and ad_drop < ADX_KEEP:   veto = True
-            if np.isfinite(bbw_ctr) and bbw_ctr < BBW_KEEP:   veto = True
-            if np.isfinite(mh) and mh > MACD_KEEP_POS:        veto = True
-            if not veto:
-                t_ex, ety = t_rsi, "rsi"
+    t_cross = rsi_cross_day(RSI, Y, M, cap)
+    t_rsi   = peak_retrace_day(RSI, DELTA, start_idx=t_cross, cap_idx=cap)
+    if DEFER_1_BAR:
+        t_rsi = np.where(t_rsi != NO_HIT, np.minimum(t_rsi + 1, cap), NO_HIT)
+
+    # confluence veto at the RSI exit bar (undefined readings never veto)
+    ad_drop = at(peak_drop(ADX), t_rsi)
+    bbw_ctr = at(peak_drop(BBW, relative=True), t_rsi)
+    mh      = at(MACD - MSIG, t_rsi)
+    with np.errstate(invalid="ignore"):
+        veto = (ad_drop < ADX_KEEP) | (bbw_ctr < BBW_KEEP) | (mh > MACD_KEEP_POS)
+
+    use_rsi = np.isin(lvl, list(ALLOWED_LVLS)) & (t_rsi != NO_HIT) & ~veto
+    t_ex[use_rsi] = t_rsi[use_rsi]
+    exit_type[use_rsi] = "rsi"
 
     # TP pre-emption
-    if t_tp is not None and (t_ex is None or t_tp <= t_ex):
-        t_ex, ety = t_tp, "tp"
+    use_tp = (t_tp != NO_HIT) & (t_tp <= t_ex)
+    t_ex[use_tp] = t_tp[use_tp]
+    exit_type[use_tp] = "tp"
+
+    c_ex = at(CLOSE, t_ex)
+    exit_day  = t_ex
+    exit_ret  = np.where(np.isfinite(c_ex), c_ex / start - 1.0, np.where(exit_type == "tp", tp, 0.0))
+    return exit_day, exit_ret, exit_type
 
-    sp = start[i]
-    ret_actual = (CLOSE[i,t_ex]/sp - 1.0) if np.isfinite(CLOSE[i,t_ex]) else (tp[i] if ety=="tp" else 0.0)
-    ret_timed  = (CLOSE[i,int(cap[i])]/sp - 1.0) if np.isfinite(CLOSE[i,int(cap[i])]) else 0.0
+ex = ExitCache(enabled=USE_CACHE).fetch(POLICY, [IN], policy_exits)
+exit_day, exit_ret, exit_type = ex.idx, ex.ret, ex.kind
 
-    exit_day.append(t_ex); exit_type.append(ety); exit_ret.append(ret_actual); timed_ret.append(ret_timed)
+c_timed = at(CLOSE, cap)
+timed_ret = np.where(np.isfinite(c_timed), c_timed / start - 1.0, 0.0)
 
 d = df.assign(exit_day=exit_day, exit_type=exit_type, exit_ret=exit_ret, timed_ret=timed_ret)
 
@@ -1,4 +1,7 @@
-﻿import re, numpy as np, pandas as pd
+﻿import argparse, numpy as np, pandas as pd
+
+from modules.exit_kernels import at, forward_cols, rsi_cross_day, window_peak_retrace_day
+from modules.window_store import store_panels
 
 # ---- params (hard-set) ----
 Y = 75          # threshold to first reach
@@ -11,14 +14,21 @@ OUT = r"C:\Users\milla\OneDrive\Documents\GitHub\m18-model2\data\Processed\rsi_e
 # If you want level-specific timed exits, set them here; otherwise default=5
 HOLD_BY_LEVEL = {lvl: 5 for lvl in range(1, 10)}
 
-df = pd.read_csv(IN)
+ap = argparse.ArgumentParser()
+ap.add_argument("--store", default=None,
+                help="window store stem (build_window_store.py --wide --src IN) to read the forward panels from")
+STORE = ap.parse_args().store
 
-# locate RSI and Close columns like rsi_d0..rsi_d9, close_d0..close_d9
-rsi_cols   = sorted([c for c in df.columns if re.fullmatch(r"rsi_d\d+", c)], key=lambda x: int(x.split("d")[-1]))
-close_cols = sorted([c for c in df.columns if re.fullmatch(r"close_d\d+", c)], key=lambda x: int(x.split("d")[-1]))
+df = pd.read_csv(IN)
 
-if not rsi_cols or not close_cols:
-    raise ValueError("Could not find forward RSI/close columns like rsi_d0.. or close_d0.. in the file.")
+# forward RSI and Close panels (rsi_d0..rsi_d9, close_d0..close_d9), from the store when given
+if STORE:
+    fwd = store_panels(STORE, ("rsi", "close"), df)
+else:
+    rsi_cols, close_cols = forward_cols(df, "rsi"), forward_cols(df, "close")
+    if not rsi_cols or not close_cols:
+        raise ValueError("Could not find forward RSI/close columns like rsi_d0.. or close_d0.. in the file.")
+    fwd = {"rsi": df[rsi_cols].to_numpy(dtype=float), "close": df[close_cols].to_numpy(dtype=float)}
 
 # choose entry price column
 if "start_price" in df.columns:
@@ -30,49 +40,31 @@ elif "open_d0" in df.columns:
 else:
     raise ValueError("No entry price column found (looked for start_price, entry_price, open_d0).")
 
-def apply_exit(row):
-    level = int(row.get("market_level", 5)) if pd.notna(row.get("market_level", np.nan)) else 5
-    hold_n = int(HOLD_BY_LEVEL.get(level, 5))
+def apply_exit(df):
+    lvl_raw = pd.to_numeric(df["market_level"], errors="coerce") if "market_level" in df.columns else pd.Series(np.nan, index=df.index)
+    level  = lvl_raw.fillna(5).astype(int)
+    hold_n = level.map(lambda l: int(HOLD_BY_LEVEL.get(l, 5))).to_numpy()
 
-    rsi_seq   = row[rsi_cols].to_numpy(dtype=float)
-    close_seq = row[close_cols].to_numpy(dtype=float)
+    RSI, CLOSE = fwd["rsi"], fwd["close"]
 
     # limit by available forward days
-    max_idx = min(hold_n, len(rsi_seq) - 1, len(close_seq) - 1)
-
-    # find first cross >= Y with M-bar persistence
-    t_cross = None
-    for t in range(0, max_idx + 1):
-        window = rsi_seq[t: t + M]
-        if len(window) == M and np.all(np.isfinite(window)) and np.all(window >= Y):
-            t_cross = t
-            break
-
-    exit_day = max_idx
-    exit_type = "timed"
-
-    if t_cross is not None:
-        # find rsi peak AFTER the cross
-        seg = rsi_seq[t_cross: max_idx + 1]
-        if np.any(np.isfinite(seg)):
-            t_peak_rel = int(np.nanargmax(seg))
-            t_peak = t_cross + t_peak_rel
-            rsi_peak = rsi_seq[t_peak]
-            thresh = rsi_peak - DELTA
-            # first bar on/after the peak where RSI <= peak - DELTA
-            for t in range(t_peak, max_idx + 1):
-                if np.isfinite(rsi_seq[t]) and rsi_seq[t] <= thresh:
-                    exit_day = t
-                    exit_type = "rsi"
-                    break
-
-    entry = float(row[entry_col])
-    px = float(close_seq[exit_day])
-    exit_ret = (px / entry) - 1.0
-
-    return pd.Series({"exit_day": exit_day, "exit_type": exit_type, "exit_ret": exit_ret})
-
-out = df.join(df.apply(apply_exit, axis=1))
+    max_idx = np.minimum(hold_n, min(RSI.shape[1], CLOSE.shape[1]) - 1)
+
+    # first cross >= Y with M-bar persistence, then the RSI peak AFTER the cross;
+    # exit on the first bar on/after the peak where RSI <= peak - DELTA
+    t_cross = rsi_cross_day(RSI, Y, M, max_idx)
+    t_rsi   = window_peak_retrace_day(RSI, DELTA, t_cross, max_idx)
+
+    hit = t_rsi >= 0
+    exit_day = np.where(hit, t_rsi, max_idx)
+    entry = df[entry_col].astype(float).to_numpy()
+    return pd.DataFrame({
+        "exit_day": exit_day,
+        "exit_type": np.where(hit, "rsi", "timed"),
+        "exit_ret": at(CLOSE, exit_day) / entry - 1.0,
+    }, index=df.index)
+
+out = df.join(apply_exit(df))
 
 # quick prints
 n = len(out)
@@ -2,11 +2,14 @@
 # Apply exits with TP pre-emption first, else RSI drawdown exit, else timed hold.
 # Params: Y=75, DELTA=5, M=3   (toggle DEFER_1_BAR below if desired)
 
-import re
+import argparse
 import numpy as np
 import pandas as pd
 from pathlib import Path
 
+from modules.exit_kernels import NO_HIT, at, forward_cols, peak_retrace_day, rsi_cross_day, tp_hit_day
+from modules.window_store import store_panels
+
 # ---- I/O ----
 IN  = r"C:\Users\milla\OneDrive\Documents\GitHub\m18-model2\data\Processed\breakout_trades_labeled_v2.csv"
 OUT = r"C:\Users\milla\OneDrive\Documents\GitHub\m18-model2\data\Processed\rsi_exit_applied_y75_d5_m3_tp.csv"
@@ -23,29 +26,18 @@ HOLD_DAYS = 5
 # Take-profit % by market level (same mapping we’ve been using)
 tp_by = {1:0.65, 2:0.85, 3:0.90, 4:0.85, 5:0.95, 6:0.90, 7:0.95, 8:0.95, 9:0.95}
 
-# ---- Helpers to grab forward series ----
-def cols(df, prefix):
-    # matches rsi_d0.., rsi_d1.. ; ignores negative day columns
-    ks = []
-    pat = re.compile(rf"{re.escape(prefix)}_d-?\d+$")
-    for c in df.columns:
-        if pat.fullmatch(c):
-            try:
-                k = int(c.split("d")[-1])
-            except Exception:
-                continue
-            if k >= 0:
-                ks.append((k, c))
-    ks.sort()
-    return [c for _, c in ks]
+ap = argparse.ArgumentParser()
+ap.add_argument("--store", default=None,
+                help="window store stem (build_window_store.py --wide --src IN) to read the forward panels from")
+STORE = ap.parse_args().store
 
 # ---- Load ----
 df = pd.read_csv(IN)
 
 # forward arrays
-RSI   = df[cols(df, "rsi")  ].to_numpy(float)
-HIGH  = df[cols(df, "high") ].to_numpy(float)
-CLOSE = df[cols(df, "close")].to_numpy(float)
+fwd = (store_panels(STORE, ("rsi", "high", "close"), df) if STORE
+       else {n: df[forward_cols(df, n)].to_numpy(float) for n in ("rsi", "high", "close")})
+RSI, HIGH, CLOSE = fwd["rsi"], fwd["high"], fwd["close"]
 
 # start price (fallbacks)
 if "start_price" in df:
@@ -65,75 +57,30 @@ hold_by = {1:5,2:5,3:8,4:6,5:8,6:6,7:6,8:7,9:6}
 cap = np.array([min(hold_by.get(int(x),5), T-1) for x in lvl], dtype=int)
 
 
-def find_tp(i):
-    """first bar where HIGH >= start*(1+tp) within cap"""
-    th = start[i] * (1.0 + tp[i])
-    upto = int(cap[i])
-    for t in range(upto + 1):
-        if np.isfinite(HIGH[i, t]) and HIGH[i, t] >= th:
-            return t
-    return None
-
-def rsi_cross_idx(i):
-    """first index t where the next M bars of RSI are all >= Y"""
-    r = RSI[i]
-    upto = int(cap[i])
-    for t in range(upto + 1):
-        seg = r[t:t+M]
-        if len(seg) == M and np.all(np.isfinite(seg)) and np.all(seg >= Y):
-            return t
-    return None
-
-def rsi_drawdown_exit(i, t_cross):
-    """after cross, exit when RSI has fallen DELTA from its running peak"""
-    if t_cross is None:
-        return None
-    r = RSI[i]
-    upto = int(cap[i])
-    peak = -np.inf
-    for t in range(t_cross, upto + 1):
-        x = r[t]
-        if np.isfinite(x) and x > peak:
-            peak = x
-        if np.isfinite(peak) and np.isfinite(x) and (peak - x) >= DELTA:
-            return t
-    return None
-
-# ---- Walk trades ----
-exit_day = []
-exit_type = []
-exit_ret = []
-pct_tp = 0
-
-for i in range(len(df)):
-    t_tp    = find_tp(i)
-    t_cross = rsi_cross_idx(i)
-    t_rsi   = rsi_drawdown_exit(i, t_cross)
-
-    # default to timed
-    t_ex, ety = int(cap[i]), "timed"
-
-    # use RSI if it fired
-    if t_rsi is not None:
-        t_ex, ety = t_rsi, "rsi"
-        if DEFER_1_BAR:
-            t_ex = min(t_ex + 1, int(cap[i]))
-
-    # TP pre-empts everything if it occurs earlier or equal
-    if t_tp is not None and t_tp <= t_ex:
-        t_ex, ety = t_tp, "tp"
-        pct_tp += 1
-
-    # realized return
-    if np.isfinite(CLOSE[i, t_ex]):
-        ret = CLOSE[i, t_ex] / start[i] - 1.0
-    else:
-        # rare: if CLOSE NaN at TP bar, fall back to TP%
-        ret = tp[i] if ety == "tp" else np.nan
-
-    exit_day.append(t_ex)
-    exit_type.append(ety)
-    exit_ret.append(ret)
+# ---- Exit days for all trades ----
+t_tp    = tp_hit_day(HIGH, start, tp, cap, mode="threshold")   # first bar where HIGH >= start*(1+tp) within cap
+t_cross = rsi_cross_day(RSI, Y, M, cap)                        # first t where the next M bars of RSI are all >= Y
+t_rsi   = peak_retrace_day(RSI, DELTA, start_idx=t_cross, cap_idx=cap)  # then DELTA off the running peak
+
+# default to timed
+t_ex = cap.copy()
+exit_type = np.full(len(df), "timed", dtype=object)
+
+# use RSI if it fired
+rsi_hit = t_rsi != NO_HIT
+t_ex[rsi_hit] = np.minimum(t_rsi[rsi_hit] + 1, cap[rsi_hit]) if DEFER_1_BAR else t_rsi[rsi_hit]
+exit_type[rsi_hit] = "rsi"
+
+# TP pre-empts everything if it occurs earlier or equal
+use_tp = (t_tp != NO_HIT) & (t_tp <= t_ex)
+t_ex[use_tp] = t_tp[use_tp]
+exit_type[use_tp] = "tp"
+pct_tp = int(use_tp.sum())
+
+# realized return; rare: if CLOSE NaN at TP bar, fall back to TP%
+c = at(CLOSE, t_ex)
+exit_day = t_ex
+exit_ret = np.where(np.isfinite(c), c / start - 1.0, np.where(exit_type == "tp", tp, np.nan))
 
 out = df.assign(exit_day=exit_day, exit_type=exit_type, exit_ret=exit_ret)
 
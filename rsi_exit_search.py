@@ -1,5 +1,9 @@
-﻿import re, numpy as np, pandas as pd
-from itertools import product
+﻿import argparse, numpy as np, pandas as pd
+
+from modules.exit_kernels import NO_HIT, forward_cols
+from modules.halving import halve_grid
+from modules.shm_grid import run_grid_parallel
+from modules.window_store import store_panels
 
 IN  = r"C:\Users\milla\OneDrive\Documents\GitHub\m18-model2\data\Processed\breakout_events_timed_full.csv"
 LAB = r"C:\Users\milla\OneDrive\Documents\GitHub\m18-model2\data\Processed\breakout_trades_labeled.csv"
@@ -8,104 +12,62 @@ OUT = r"C:\Users\milla\OneDrive\Documents\GitHub\m18-model2\data\Processed\rsi_e
 TP   = {1:0.65,2:0.85,3:0.90,4:0.85,5:0.95,6:0.90,7:0.95,8:0.95,9:0.95}
 HOLD = {1:5, 2:5, 3:8, 4:6, 5:8, 6:6, 7:6, 8:7, 9:6}
 
-def day_cols(prefix, df):
-    pat = re.compile(rf"^{re.escape(prefix)}_d(\-?\d+)$")
-    out = []
-    for c in df.columns:
-        m = pat.match(c)
-        if m:
-            t = int(m.group(1))
-            if t >= 0:
-                out.append((t, c))
-    out.sort()
-    return [c for _,c in out]
-
-def find_tp_day(highs, start, tp_pct):
-    if not np.isfinite(start) or start <= 0: return None
-    for t, h in enumerate(highs):
-        if np.isfinite(h) and (h/start - 1.0) >= tp_pct:
-            return t
-    return None
-
-def rsi_exit_day(rsi, Y, dlt, Z, min_hold):
-    had_momo = False
-    peak = -np.inf
-    for t, x in enumerate(rsi):
-        if not np.isfinite(x): 
-            continue
-        peak = max(peak, x)
-        if peak >= Y:
-            had_momo = True
-        if t >= min_hold and had_momo:
-            retr = (peak - x) >= dlt
-            floor = (Z is not None) and (x <= Z)
-            if retr or floor:
-                return t
-    return None
-
-def ret_at_close(closes, start, t):
-    if not np.isfinite(start) or start <= 0: return np.nan
-    if t is None or t >= len(closes): return np.nan
-    c = closes[t]
-    return (c/start - 1.0) if np.isfinite(c) else np.nan
-
-def ret_timed(closes, start, hold):
-    t = min(hold, len(closes)-1)
-    if not np.isfinite(start) or start <= 0 or t < 0: return np.nan
-    c = closes[t]
-    return (c/start - 1.0) if np.isfinite(c) else np.nan
-
-# --- load data
-df  = pd.read_csv(IN)
-lab = pd.read_csv(LAB)[["symbol","breakout_date","win_flag"]]
-df = df.merge(lab, on=["symbol","breakout_date"], how="left")
-
-rsi_cols   = day_cols("rsi",   df)
-high_cols  = day_cols("high",  df)
-close_cols = day_cols("close", df)
-
-if not rsi_cols or not high_cols or not close_cols:
-    raise RuntimeError("Expected rsi_d*, high_d*, close_d* columns were not found.")
-
 # --- parameter grid
 Ys   = [60, 65, 70, 75, 80]
 DLTs = [5, 7, 10, 12, 15]
 Zs   = [None, 55, 50, 45]
 Ms   = [1, 2, 3]
 
-rows_out = []
-for Y, DLT, Z, M in product(Ys, DLTs, Zs, Ms):
-    recs = []
-    for _, row in df.iterrows():
-        lvl = int(row["market_level"]) if pd.notna(row["market_level"]) else None
-        if lvl not in TP: 
-            continue
-        start = row.get("start_price", np.nan)
-        hold  = HOLD[lvl]
-        rsi   = row[rsi_cols].to_numpy(dtype=float, copy=False)
-        highs = row[high_cols].to_numpy(dtype=float, copy=False)
-        close = row[close_cols].to_numpy(dtype=float, copy=False)
-
-        t_tp  = find_tp_day(highs, start, TP[lvl])
-        t_re  = rsi_exit_day(rsi, Y, DLT, Z, M)
-
-        if t_tp is not None:
-            t_exit = t_tp
-            ret_exit = (highs[t_tp]/start - 1.0) if (np.isfinite(highs[t_tp]) and np.isfinite(start) and start>0) else np.nan
-        elif t_re is not None:
-            t_exit = t_re
-            ret_exit = ret_at_close(close, start, t_exit)
-        else:
-            t_exit = hold
-            ret_exit = ret_timed(close, start, hold)
-
-        ret_t = ret_timed(close, start, hold)
-        winlbl = row.get("win_flag", np.nan)
-        recs.append((lvl, winlbl, t_exit, ret_exit, ret_t))
-
-    if not recs:
-        continue
-    tmp = pd.DataFrame(recs, columns=["level","win_flag","t_exit","ret_exit","ret_timed"])
+def load_panels(store=None):
+    """Trades with a known level as (N, T) forward panels plus per-trade vectors."""
+    df  = pd.read_csv(IN)
+    fwd = store_panels(store, ("rsi","high","close"), df) if store else None
+    lab = pd.read_csv(LAB)[["symbol","breakout_date","win_flag"]]
+    df = df.assign(_row=np.arange(len(df))).merge(lab, on=["symbol","breakout_date"], how="left")
+
+    if fwd is None:
+        cols = {n: forward_cols(df, n) for n in ("rsi","high","close")}
+        if not all(cols.values()):
+            raise RuntimeError("Expected rsi_d*, high_d*, close_d* columns were not found.")
+
+    lvl_raw = np.trunc(pd.to_numeric(df["market_level"], errors="coerce"))
+    df  = df.loc[lvl_raw.isin(list(TP)).to_numpy()].reset_index(drop=True)
+    lvl = lvl_raw[lvl_raw.isin(list(TP))].astype(int).to_numpy()
+    if fwd is None:
+        fwd = {n: df[c].to_numpy(dtype=float) for n, c in cols.items()}
+    else:
+        fwd = {n: v[df["_row"].to_numpy()] for n, v in fwd.items()}
+    return {
+        "rsi":   fwd["rsi"],
+        "high":  fwd["high"],
+        "close": fwd["close"],
+        "start": (df["start_price"] if "start_price" in df else pd.Series(np.nan, index=df.index)).astype(float).to_numpy(),
+        "level": lvl,
+        "year":  pd.to_datetime(df["breakout_date"], errors="coerce").dt.year.fillna(-1).astype(int).to_numpy(),
+        "tp":    np.array([TP[l] for l in lvl], dtype=float),
+        "hold":  np.array([HOLD[l] for l in lvl], dtype=int),
+        "win_flag": (df["win_flag"] if "win_flag" in df else pd.Series(np.nan, index=df.index)).astype(float).to_numpy(),
+    }
+
+def evaluate(G, Y, DLT, Z, M):
+    """
+    One grid cell over the memoized sub-results in G: TP day and timed return per
+    trade, RSI peak once, momentum arming per Y, retrace/floor trigger per (Delta, Z).
+    """
+    P = G.panels
+    if not len(P["level"]):
+        return None
+    lvl, hold, win_flag = P["level"], P["hold"], P["win_flag"]
+    t_tp   = G.tp_day(P["tp"])
+    ret_tp = G.ret_at("tp", t_tp, "high")
+    ret_t  = G.ret_at("timed", np.minimum(hold, P["close"].shape[1] - 1))
+    t_re   = G.rsi_momentum_day(Y, DLT, Z, M)
+
+    # TP first, else RSI exit, else timed hold
+    t_exit   = np.where(t_tp != NO_HIT, t_tp, np.where(t_re != NO_HIT, t_re, hold))
+    ret_exit = np.where(t_tp != NO_HIT, ret_tp, np.where(t_re != NO_HIT, G.ret_at(("rsi", Y, DLT, Z, M), t_re), ret_t))
+
+    tmp = pd.DataFrame({"level":lvl, "win_flag":win_flag, "t_exit":t_exit, "ret_exit":ret_exit, "ret_timed":ret_t})
     win_mask  = (tmp["win_flag"] == 1)
     loss_mask = (tmp["win_flag"] == 0)
 
@@ -116,19 +78,44 @@ for Y, DLT, Z, M in product(Ys, DLTs, Zs, Ms):
     win_med_ret   = tmp.loc[win_mask, "ret_exit"].median() if win_mask.any() else np.nan
     overall_mean  = tmp["ret_exit"].mean()
 
-    rows_out.append({
+    return {
         "Y":Y, "Delta":DLT, "Z":("None" if Z is None else Z), "M":M,
         "overall_win_retention": None if pd.isna(win_retention) else round(win_retention,3),
         "overall_median_days": round(med_days,2),
         "loser_improvement_mean": None if pd.isna(loser_improve) else round(loser_improve,4),
         "winner_median_return": None if pd.isna(win_med_ret) else round(win_med_ret,4),
         "overall_mean_return": round(overall_mean,4)
-    })
-
-res = pd.DataFrame(rows_out).sort_values(
-    by=["overall_win_retention","overall_mean_return","loser_improvement_mean"],
-    ascending=[False,False,False], na_position="last"
-)
-res.to_csv(OUT, index=False)
-print("Saved grid ->", OUT)
-print(res.head(12).to_string(index=False))
+    }
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--workers", type=int, default=1, help="processes; panels are shared, not copied")
+    ap.add_argument("--no-progress", action="store_true")
+    ap.add_argument("--halving", action="store_true",
+                    help="successive halving on level x year stratified samples instead of the full grid")
+    ap.add_argument("--eta", type=float, default=3.0, help="halving: keep 1/eta per rung, grow sample eta x")
+    ap.add_argument("--min-rows", type=int, default=200, help="halving: smallest sample")
+    ap.add_argument("--seed", type=int, default=0)
+    ap.add_argument("--store", default=None,
+                    help="window store stem (build_window_store.py --wide --src IN) to read the forward panels from")
+    a = ap.parse_args()
+
+    axes, rank_by = {"Y":Ys, "DLT":DLTs, "Z":Zs, "M":Ms}, ["overall_win_retention","overall_mean_return","loser_improvement_mean"]
+    if a.halving:
+        hist = pd.DataFrame(halve_grid(axes, evaluate, load_panels(a.store), rank_by=rank_by, eta=a.eta,
+                                       min_rows=a.min_rows, seed=a.seed, progress=not a.no_progress))
+        hist.to_csv(OUT.replace(".csv", "_halving.csv"), index=False)
+        rows_out = hist[hist["final"]].drop(columns=["rung","n_rows","final"])
+    else:
+        rows_out = run_grid_parallel(axes, evaluate, load_panels(a.store), workers=a.workers, progress=not a.no_progress)
+
+    res = pd.DataFrame(rows_out).sort_values(
+        by=rank_by,
+        ascending=[False,False,False], na_position="last"
+    )
+    res.to_csv(OUT, index=False)
+    print("Saved grid ->", OUT)
+    print(res.head(12).to_string(index=False))
+
+if __name__ == "__main__":
+    main()
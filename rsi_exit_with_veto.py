@@ -1,8 +1,11 @@
 ﻿# rsi_exit_apply_y75_d5_m3.py
-import re
+import argparse
 import numpy as np
 import pandas as pd
 
+from modules.exit_kernels import NO_HIT, at, forward_cols, peak_retrace_day, rsi_cross_day, tp_hit_day
+from modules.window_store import store_panels
+
 # --- inputs/outputs: adjust if you keep files elsewhere ---
 IN  = r"C:\Users\milla\OneDrive\Documents\GitHub\m18-model2\data\Processed\breakout_trades_labeled_v2.csv"
 OUT = r"C:\Users\milla\OneDrive\Documents\GitHub\m18-model2\data\Processed\rsi_exit_applied_y75_d5_m3.csv"
@@ -12,27 +15,20 @@ Y = 75      # threshold
 DELTA = 5   # retrace from peak
 M = 3       # consecutive bars above Y before we start watching retrace
 
+ap = argparse.ArgumentParser()
+ap.add_argument("--store", default=None,
+                help="window store stem (build_window_store.py --wide --src IN) to read the forward panels from")
+STORE = ap.parse_args().store
+
 # --- read data ---
 df = pd.read_csv(IN)
 
-def cols(prefix: str):
-    ks = []
-    for c in df.columns:
-        if re.fullmatch(rf"{prefix}_d-?\d+", c):
-            k = int(c.split("d")[-1])
-            if k >= 0:
-                ks.append((k, c))
-    ks.sort()
-    return [c for _, c in ks]
-
 # indicator panels (d0..dN, only forward bars)
-RSI   = df[cols("rsi")].to_numpy(float)
-MACD  = df[cols("macd")].to_numpy(float)
-MSIG  = df[cols("macd_signal")].to_numpy(float)  # not used here, but handy
-ADX   = df[cols("adx")].to_numpy(float)          # not used here, but handy
-BBW   = df[cols("bbw")].to_numpy(float)          # not used here, but handy
-HIGH  = df[cols("high")].to_numpy(float)
-CLOSE = df[cols("close")].to_numpy(float)
+PANELS = ("rsi", "macd", "macd_signal", "adx", "bbw", "high", "close")
+fwd = (store_panels(STORE, PANELS, df) if STORE
+       else {n: df[forward_cols(df, n)].to_numpy(float) for n in PANELS})
+RSI, MACD, HIGH, CLOSE = fwd["rsi"], fwd["macd"], fwd["high"], fwd["close"]
+MSIG, ADX, BBW = fwd["macd_signal"], fwd["adx"], fwd["bbw"]  # not used here, but handy
 
 # start/level/hold
 start = (df["start_price"] if "start_price" in df
@@ -51,70 +47,31 @@ tp    = np.array([tp_by.get(int(x), 0.90) for x in lvl])
 T   = min(RSI.shape[1], HIGH.shape[1], CLOSE.shape[1]) - 1
 cap = np.minimum(hold, T)
 
-# --- helpers ---
-def find_tp(i: int):
-    """First bar where HIGH >= start*(1+tp[level]) up to cap."""
-    th   = start[i] * (1.0 + tp[i])
-    upto = int(cap[i])
-    for t in range(upto + 1):
-        if np.isfinite(HIGH[i, t]) and HIGH[i, t] >= th:
-            return t
-    return None
-
-def rsi_cross_idx(i: int):
-    """First bar where we have M consecutive bars with RSI >= Y."""
-    r = RSI[i]; upto = int(cap[i])
-    for t in range(upto + 1):
-        seg = r[t:t+M]
-        if len(seg) == M and np.all(np.isfinite(seg)) and np.all(seg >= Y):
-            return t
-    return None
-
-def rsi_exit_idx(i: int, t_cross: int | None):
-    """From first cross, track running peak; exit when peak - rsi >= DELTA."""
-    if t_cross is None:
-        return None
-    r = RSI[i]; upto = int(cap[i])
-    peak = -np.inf
-    for t in range(t_cross, upto + 1):
-        x = r[t]
-        if np.isfinite(x) and x > peak:
-            peak = x
-        if np.isfinite(peak) and (peak - x) >= DELTA:
-            return t
-    return None
-
 # --- simulate exits ---
-exit_day, exit_type, exit_ret = [], [], []
-
-for i in range(len(df)):
-    t_timed = int(cap[i])
-
-    # RSI path
-    t_cross = rsi_cross_idx(i)
-    t_rsi   = rsi_exit_idx(i, t_cross)
-
-    # default = timed exit
-    t_ex, ety = t_timed, "timed"
-
-    # take RSI exit if it happens before timed
-    if t_rsi is not None and t_rsi < t_ex:
-        t_ex, ety = t_rsi, "rsi"
-
-    # TP pre-emption: if TP hits earlier than current choice, take TP
-    t_tp = find_tp(i)
-    if t_tp is not None and t_tp <= t_ex:
-        t_ex, ety = t_tp, "tp"
-
-    # realized return
-    if np.isfinite(CLOSE[i, t_ex]):
-        ret = CLOSE[i, t_ex] / start[i] - 1.0
-    else:
-        ret = tp[i] if ety == "tp" else np.nan
-
-    exit_day.append(t_ex)
-    exit_type.append(ety)
-    exit_ret.append(ret)
+# RSI path: first M-bar cross, then running peak from the cross; exit when peak - rsi >= DELTA
+t_cross = rsi_cross_day(RSI, Y, M, cap)
+t_rsi   = peak_retrace_day(RSI, DELTA, start_idx=t_cross, cap_idx=cap)
+# TP: first bar where HIGH >= start*(1+tp[level]) up to cap
+t_tp    = tp_hit_day(HIGH, start, tp, cap, mode="threshold")
+
+# default = timed exit
+t_ex = cap.astype(int)
+exit_type = np.full(len(df), "timed", dtype=object)
+
+# take RSI exit if it happens before timed
+use_rsi = (t_rsi != NO_HIT) & (t_rsi < t_ex)
+t_ex[use_rsi] = t_rsi[use_rsi]
+exit_type[use_rsi] = "rsi"
+
+# TP pre-emption: if TP hits earlier than current choice, take TP
+use_tp = (t_tp != NO_HIT) & (t_tp <= t_ex)
+t_ex[use_tp] = t_tp[use_tp]
+exit_type[use_tp] = "tp"
+
+# realized return
+c = at(CLOSE, t_ex)
+exit_day = t_ex
+exit_ret = np.where(np.isfinite(c), c / start - 1.0, np.where(exit_type == "tp", tp, np.nan))
 
 out = df.assign(exit_day=exit_day, exit_type=exit_type, exit_ret=exit_ret)
 print(f"Applied RSI exit Y={Y}, Δ={DELTA}, M={M}")
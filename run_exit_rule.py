@@ -0,0 +1,42 @@
+import argparse, re
+from pathlib import Path
+import pandas as pd, numpy as np
+
+from modules.exit_eval import equity_metrics_rows
+from modules.exit_rules import compile_rule, load_rule, panels_from_frame, panels_from_paths
+from modules.trade_paths import open_trade_paths
+
+def main():
+    ap = argparse.ArgumentParser(description="Evaluate a declarative exit rule (JSON/YAML) over all trades at once.")
+    ap.add_argument("--rule", required=True, help="rule spec, e.g. configs/exit_rules/*.yaml or exit_out/exit_rule.json")
+    src = ap.add_mutually_exclusive_group(required=True)
+    src.add_argument("--trades", help="wide trades CSV with forward rsi_d*/high_d*/close_d*/... columns")
+    src.add_argument("--bars", help="trade_bars.csv (or its .paths/ store) for path-based rules")
+    ap.add_argument("--out", default=None, help="per-trade exits CSV (default exit_out/exits_rule_<name>.csv)")
+    a = ap.parse_args()
+
+    doc = load_rule(a.rule)
+    evaluate = compile_rule(doc)
+    if a.trades:
+        df = pd.read_csv(a.trades)
+        res = evaluate(panels_from_frame(df))
+        out = df.assign(**res.to_frame())
+    else:
+        paths = open_trade_paths(a.bars)
+        res = evaluate(panels_from_paths(paths))
+        out = pd.DataFrame({"trade_id": paths.trade_id, **res.to_frame(),
+                            "exit_date": paths.gather("date", res.day)})
+
+    name = re.sub(r"[^0-9A-Za-z]+", "_", str(doc.get("name") or Path(a.rule).stem)).strip("_").lower()
+    out_path = Path(a.out) if a.out else Path("exit_out")/f"exits_rule_{name}.csv"
+    out_path.parent.mkdir(parents=True, exist_ok=True)
+    out.to_csv(out_path, index=False)
+
+    print(f"Rule: {doc.get('name', a.rule)}")
+    print("\nExit mix (%):"); print(out["exit_type"].value_counts(normalize=True).mul(100).round(1).to_string())
+    rets = np.where(np.isfinite(res.ret), res.ret, 0.0)
+    print("\nMetrics:"); print(equity_metrics_rows(rets[None, :]).round(4).to_string(index=False))
+    print("\nWrote ->", out_path)
+
+if __name__ == "__main__":
+    main()
@@ -1,10 +1,14 @@
 ﻿import argparse
 import json
+import sys
 from pathlib import Path
 from datetime import datetime
 import numpy as np
 import pandas as pd
 
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+from modules.halving import successive_halving
+
 def load_breakouts(csv_path: Path) -> pd.DataFrame:
     df = pd.read_csv(csv_path)
     # Parse dates & coerce numerics
@@ -107,6 +111,10 @@ def main():
     ap.add_argument("--year-weighting", choices=["equal","trades"], default="equal")
     ap.add_argument("--min-trades-year", type=int, default=1)
     ap.add_argument("--outdir", default="out/optim")
+    ap.add_argument("--halving", action="store_true",
+                    help="successive halving: score all trials on level x year stratified samples, keep the top 1/eta")
+    ap.add_argument("--eta", type=float, default=3.0)
+    ap.add_argument("--min-rows", type=int, default=200, help="halving: smallest sample")
     args = ap.parse_args()
 
     df = load_breakouts(Path(args.input))
@@ -116,35 +124,62 @@ def main():
     root = Path(args.outdir) / stamp
     root.mkdir(parents=True, exist_ok=True)
 
-    rows = []
-    best = None
-
+    # sample weights that sum to 1, plus thresholds (same draws with or without halving)
+    trials = []
     for i in range(1, args.n_trials+1):
-        # sample weights that sum to 1
         w = rng.dirichlet(np.ones(4))
-        min_total = rng.uniform(*args.min_total_range)
-        min_mod   = rng.uniform(*args.min_mod_range)
+        trials.append((i, w, rng.uniform(*args.min_total_range), rng.uniform(*args.min_mod_range)))
 
-        res = eval_config(
-            df, w, min_total=min_total, min_mod=min_mod,
-            year_weighting=args.year_weighting, min_trades_year=args.min_trades_year
-        )
-        row = {
+    def trial_row(trial, res, **extra):
+        i, w, min_total, min_mod = trial
+        return {
             "trial": i,
             "w_trd": w[0], "w_vty": w[1], "w_vol": w[2], "w_mom": w[3],
             "min_total": min_total, "min_mod": min_mod,
+            **extra,
             "metric": res["metric"],
             "years_used": res["years_used"],
             "trades": res["trades"],
             "mean_return_all": res["mean_return_all"]
         }
-        rows.append(row)
 
-        if best is None or res["metric"] > best["metric"]:
-            best = {**row, "per_year": res["per_year"]}
+    def run(data, trial):
+        _, w, min_total, min_mod = trial
+        return eval_config(
+            data, w, min_total=min_total, min_mod=min_mod,
+            year_weighting=args.year_weighting, min_trades_year=args.min_trades_year
+        )
 
-        if i % 50 == 0:
-            print(f"Trial {i}/{args.n_trials}  best_metric={best['metric']:.6f}  trades={best['trades']}")
+    rows = []
+    best = None
+
+    if args.halving:
+        strata = df[[c for c in ["market_level_at_entry","year"] if c in df.columns]]
+        def on_sample(idx):
+            sub = df.iloc[idx]
+            return lambda trial: run(sub, trial)
+
+        hist = successive_halving(
+            trials, on_sample, strata,
+            key=lambda res: res["metric"], eta=args.eta, min_rows=args.min_rows, seed=args.seed
+        )
+        for h in hist:
+            row = trial_row(trials[h["candidate"]], h["result"], rung=h["rung"], n=h["n_rows"])
+            rows.append(row)
+            if h["final"] and (best is None or row["metric"] > best["metric"]):
+                best = {**row, "per_year": h["result"]["per_year"]}
+    else:
+        for trial in trials:
+            res = run(df, trial)
+            row = trial_row(trial, res)
+            rows.append(row)
+
+            if best is None or res["metric"] > best["metric"]:
+                best = {**row, "per_year": res["per_year"]}
+
+            i = trial[0]
+            if i % 50 == 0:
+                print(f"Trial {i}/{args.n_trials}  best_metric={best['metric']:.6f}  trades={best['trades']}")
 
     results = pd.DataFrame(rows).sort_values("metric", ascending=False)
     results_path = root / "results.csv"
@@ -1,66 +1,177 @@
 ﻿import argparse
+import os
+import numpy as np
 import pandas as pd
+import pyarrow as pa
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
 from pathlib import Path
 
+KEYS = ["symbol", "entry_date"]
+EXCLUDE = set(KEYS + ["index", "bar_offset",
+                      "exit_time", "exit_price", "exit_reason",
+                      "exit_label", "success_bin"])
+FALLBACK = ["score_trd", "score_vty", "score_vol", "score_mom",
+            "score_total", "score_norm", "market_level"]
+
 def parse_args():
     p = argparse.ArgumentParser()
     p.add_argument("--src", required=True)
     p.add_argument("--offsets", nargs="+", type=int, required=True)
     p.add_argument("--outdir", required=True)
+    p.add_argument("--features", nargs="*", default=None,
+                   help="feature columns to pivot (default: numeric columns in the Parquet schema)")
+    p.add_argument("--batch-rows", type=int, default=1_000_000,
+                   help="rows per scanned batch; memory is bounded by this plus one symbol")
     return p.parse_args()
 
-def main():
-    a = parse_args()
-    outdir = Path(a.outdir); outdir.mkdir(parents=True, exist_ok=True)
+def pick_features(schema: pa.Schema, requested) -> list[str]:
+    """Feature columns from the Parquet schema (no full read, no per-column coercion)."""
+    if requested:
+        missing = [c for c in requested if c not in schema.names]
+        if missing:
+            raise SystemExit(f"Requested feature columns missing: {missing}")
+        return list(requested)
+    feats = [f.name for f in schema
+             if f.name not in EXCLUDE and (pa.types.is_integer(f.type) or pa.types.is_floating(f.type)
+                                           or pa.types.is_boolean(f.type))]
+    if not feats:
+        # Fallback if nothing detected
+        feats = [c for c in FALLBACK if c in schema.names]
+        if not feats:
+            raise SystemExit("No feature columns found after filtering.")
+    return feats
+
+def offset_filter(schema: pa.Schema, offsets):
+    """Push the bar_offset selection into the scan when the column is numeric."""
+    typ = schema.field("bar_offset").type
+    if pa.types.is_integer(typ) or pa.types.is_floating(typ):
+        return ds.field("bar_offset").isin(pa.array(offsets).cast(typ))
+    return None
+
+class NotSymbolContiguous(Exception):
+    """A symbol reappeared after its rows were already pivoted."""
 
-    df = pd.read_parquet(a.src)
+def symbol_chunks(dset, columns, flt, batch_rows):
+    """
+    Yield frames holding whole symbols. The windows file is normally written
+    symbol-contiguous, so rows of the last symbol in a batch are carried into
+    the next one; a symbol reappearing after it was emitted raises
+    NotSymbolContiguous (main then pivots a symbol-sorted copy instead).
+    """
+    carry = None
+    emitted = set()
+    for rb in dset.to_batches(columns=columns, filter=flt, batch_size=batch_rows):
+        if rb.num_rows == 0:
+            continue
+        df = rb.to_pandas()
+        if carry is not None:
+            df = pd.concat([carry, df], ignore_index=True)
+        tail = df["symbol"].eq(df["symbol"].iloc[-1])
+        carry = df[tail]
+        ready = df[~tail]
+        if len(ready):
+            syms = set(ready["symbol"].unique())
+            if syms & emitted:
+                raise NotSymbolContiguous()
+            emitted |= syms
+            yield ready
+    if carry is not None and len(carry):
+        if carry["symbol"].iloc[0] in emitted:
+            raise NotSymbolContiguous()
+        yield carry
 
+def sort_by_symbol(dset, columns, flt, dst, row_group_size=100_000):
+    """
+    Projected, offset-filtered copy of the source sorted by symbol (same idea as
+    trade_bars_builder.sort_parquet_by_symbol), so symbol_chunks can stream it.
+    """
+    t = dset.to_table(columns=columns, filter=flt)
+    pq.write_table(t.sort_by([("symbol", "ascending")]), dst, row_group_size=row_group_size)
+    return dst
+
+def pivot_chunk(df: pd.DataFrame, feats, offsets) -> pd.DataFrame:
     # Clean offsets and drop the NaT-like row
     df["bar_offset"] = pd.to_numeric(df["bar_offset"], errors="coerce")
-    df = df.dropna(subset=["bar_offset"]).copy()
+    df = df.dropna(subset=["bar_offset"])
+    df = df[df["bar_offset"].isin(offsets)].copy()
     df["bar_offset"] = df["bar_offset"].astype("int64")
-
-    keys = ["symbol", "entry_date"]
-    for k in keys:
-        if k not in df.columns:
-            raise SystemExit(f"Required key column missing: {k}")
-
-    # Limit to requested offsets
-    df = df[df["bar_offset"].isin(set(a.offsets))].copy()
+    for c in feats:
+        if not pd.api.types.is_numeric_dtype(df[c]):
+            df[c] = pd.to_numeric(df[c], errors="coerce")
 
     # De-dup
-    df = (df.sort_values(keys + ["bar_offset"])
-            .drop_duplicates(subset=keys + ["bar_offset"]))
-
-    # Candidate features = numeric columns excluding non-features
-    exclude = set(keys + ["index", "bar_offset",
-                          "exit_time", "exit_price", "exit_reason",
-                          "exit_label", "success_bin"])
-    # Try to coerce numerics broadly
-    candidates = [c for c in df.columns if c not in exclude]
-    df[candidates] = df[candidates].apply(pd.to_numeric, errors="ignore")
-    numeric_cols = df.select_dtypes(include="number").columns.tolist()
-    feats = [c for c in numeric_cols if c not in exclude]
-
-    # Fallback if nothing detected
-    if not feats:
-        fallback = ["score_trd","score_vty","score_vol","score_mom",
-                    "score_total","score_norm","market_level"]
-        feats = [c for c in fallback if c in df.columns]
-        if not feats:
-            raise SystemExit("No feature columns found after filtering.")
+    df = (df.sort_values(KEYS + ["bar_offset"])
+            .drop_duplicates(subset=KEYS + ["bar_offset"]))
 
-    # Pivot wide per offset
-    wide = (df.set_index(keys + ["bar_offset"])[feats]
-              .unstack("bar_offset"))
+    # Pivot wide per offset; reindex so every chunk has the same columns
+    wide = (df.set_index(KEYS + ["bar_offset"])[feats]
+              .unstack("bar_offset")
+              .reindex(columns=pd.MultiIndex.from_product([feats, offsets])))
     wide.columns = [f"{feat}@t{int(off)}" for feat, off in wide.columns]
-    wide = wide.reset_index()
+    return wide.reset_index()
+
+def write_wide(dset, columns, flt, feats, offsets, batch_rows, out):
+    """Pivot symbol chunks into out; returns (rows, schema, first 50 rows)."""
+    writer = None
+    schema = None
+    rows = 0
+    sample = None
+    try:
+        for chunk in symbol_chunks(dset, columns, flt, batch_rows):
+            wide = pivot_chunk(chunk, feats, offsets)
+            if wide.empty:
+                continue
+            if writer is None:
+                tbl = pa.Table.from_pandas(wide, preserve_index=False)
+                # every feature column as float64 so later chunks always conform
+                schema = pa.schema([f if f.name in KEYS else pa.field(f.name, pa.float64()) for f in tbl.schema])
+                writer = pq.ParquetWriter(out, schema)
+                sample = wide.head(50)
+            writer.write_table(pa.Table.from_pandas(wide.astype({c: np.float64 for c in wide.columns if c not in KEYS}),
+                                                    schema=schema, preserve_index=False))
+            rows += len(wide)
+    finally:
+        if writer is not None:
+            writer.close()
+    if writer is None:
+        raise SystemExit("No rows matched the requested offsets.")
+    return rows, schema, sample
+
+def main():
+    a = parse_args()
+    outdir = Path(a.outdir); outdir.mkdir(parents=True, exist_ok=True)
+
+    dset = ds.dataset(a.src, format="parquet")
+    for k in KEYS + ["bar_offset"]:
+        if k not in dset.schema.names:
+            raise SystemExit(f"Required key column missing: {k}")
+
+    offsets = sorted(set(a.offsets))
+    feats = pick_features(dset.schema, a.features)
+    flt = offset_filter(dset.schema, offsets)
+    columns = KEYS + ["bar_offset"] + feats
 
     p_parq = outdir / "breakout_windows_features.parquet"
     p_csv  = outdir / "breakout_windows_features_sample.csv"
-    wide.to_parquet(p_parq, index=False)
-    wide.head(50).to_csv(p_csv, index=False)
-    print(f"✅ Built {p_parq} with shape {tuple(wide.shape)}")
+    # written under a temporary name and renamed only once complete, so a failed
+    # run never leaves a truncated features file for analyse_confluence.py
+    part = outdir / (p_parq.name + ".partial")
+    sorted_src = outdir / ".windows_by_symbol.parquet"
+    try:
+        try:
+            rows, schema, sample = write_wide(dset, columns, flt, feats, offsets, a.batch_rows, part)
+        except NotSymbolContiguous:
+            print("Source is not symbol-contiguous; pivoting a symbol-sorted copy.")
+            sort_by_symbol(dset, columns, flt, sorted_src)
+            rows, schema, sample = write_wide(ds.dataset(sorted_src, format="parquet"), columns, None,
+                                              feats, offsets, a.batch_rows, part)
+        os.replace(part, p_parq)
+    finally:
+        for f in (part, sorted_src):
+            f.unlink(missing_ok=True)
+    sample.to_csv(p_csv, index=False)
+    print(f"✅ Built {p_parq} with shape {(rows, len(schema))}")
     print(f"📝 Sample: {p_csv}")
 
 if __name__ == "__main__":
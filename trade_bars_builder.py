@@ -1,6 +1,13 @@
 ﻿import argparse
+from functools import lru_cache
 from pathlib import Path
 import pandas as pd, numpy as np, yaml
+import pyarrow.dataset as ds, pyarrow.parquet as papq
+
+from modules.windows import load_symbol_bars
+
+OHLCV_COLS = ("open","high","low","close","volume")
+DATE_ALIASES = ("date","time","timestamp","datetime")
 
 def load_cfg(p): 
     with open(p, "r", encoding="utf-8") as f:
@@ -24,10 +31,35 @@ def add_ind(df, atr_n=14, don_n=20, bb_n=20):
     df["bb_mid"] = df["close"].rolling(bb_n, min_periods=1).mean() if "close" in df.columns else np.nan
     return df
 
+@lru_cache(maxsize=4)
+def parquet_source(pq):
+    """(dataset, symbol column, projected columns) for a multi-symbol OHLCV Parquet."""
+    dset = ds.dataset(pq, format="parquet")
+    by_lower = {str(n).strip().lower(): n for n in dset.schema.names}
+    if "symbol" not in by_lower:
+        raise ValueError(f"{pq}: no 'symbol' column")
+    date_col = next((by_lower[a] for a in DATE_ALIASES if a in by_lower), None)
+    if date_col is None:
+        raise ValueError(f"{pq}: no date/time column")
+    cols = [by_lower["symbol"], date_col] + [by_lower[c] for c in OHLCV_COLS if c in by_lower]
+    return dset, by_lower["symbol"], cols
+
+def sort_parquet_by_symbol(src, dst, row_group_size=100_000):
+    """
+    Rewrite a multi-symbol OHLCV Parquet sorted by (symbol, date) with row-group
+    statistics, so `symbol == sym` scans touch only that symbol's row groups.
+    """
+    dset, sym_col, cols = parquet_source(str(src))
+    t = dset.to_table(columns=cols)
+    t = t.sort_by([(sym_col, "ascending"), (cols[1], "ascending")])
+    papq.write_table(t, dst, row_group_size=row_group_size, write_statistics=True)
+    return dst
+
 def load_ohlcv(sym, folder, pq):
     if pq and Path(pq).exists():
-        d = pd.read_parquet(pq)
-        d = d[d["symbol"]==sym].copy()
+        dset, sym_col, cols = parquet_source(str(pq))
+        # only this symbol's rows and the OHLCV columns are read (row groups skipped via stats)
+        d = dset.to_table(columns=cols, filter=ds.field(sym_col) == sym).to_pandas()
         # normalize colnames
         d.columns = [str(c).strip().lower() for c in d.columns]
         # date
@@ -42,27 +74,18 @@ def load_ohlcv(sym, folder, pq):
         d = d.sort_values("date").dropna(subset=["open","high","low","close"]).reset_index(drop=True)
         return d
 
-    f = Path(folder)/f"{sym}.csv"
-    if not f.exists():
-        for alt in (sym.replace("/","-"), sym.replace(":","-"), sym.replace("_","-")):
-            g = Path(folder)/f"{alt}.csv"
-            if g.exists(): f = g; break
-    d = pd.read_csv(f)
-    d.columns = [str(c).strip().lower() for c in d.columns]
-    if "date" not in d.columns:
-        for alt in ("time","timestamp","datetime"):
-            if alt in d.columns: d = d.rename(columns={alt:"date"}); break
-    # map common case-sensitive names if any slipped through
-    ren = {}
-    for c in ["Open","High","Low","Close","Volume"]:
-        if c in d.columns: ren[c] = c.lower()
-    if ren: d = d.rename(columns=ren)
-    d["date"] = pd.to_datetime(d["date"], errors="coerce")
-    for c in ("open","high","low","close","volume"):
-        if c in d.columns:
-            d[c] = pd.to_numeric(d[c], errors="coerce")
-    d = d.sort_values("date").dropna(subset=["open","high","low","close"]).reset_index(drop=True)
-    return d
+    # CSVs come from the shared per-symbol cache (modules.windows), parsed once per process
+    d = load_symbol_bars(sym, folder)
+    if d is None:
+        return None
+    return d.dropna(subset=["open","high","low","close"]).reset_index(drop=True)
+
+def enriched_ohlcv(sym, folder, pq, atr_n=14, don_n=20, bb_n=20):
+    """OHLCV + indicators for one symbol (trades are grouped by symbol, so each is built once)."""
+    o = load_ohlcv(sym, folder, pq)
+    if o is None or o.empty:
+        return None
+    return add_ind(o, atr_n, don_n, bb_n)
 
 def snap_idx(dates, ts):
     i = dates.searchsorted(ts, side="left")
@@ -71,9 +94,22 @@ def snap_idx(dates, ts):
 def main():
     ap = argparse.ArgumentParser()
     ap.add_argument("--config", required=True)
+    ap.add_argument("--sort-parquet", action="store_true",
+                    help="rewrite paths.ohlcv_parquet as <name>_by_symbol.parquet (symbol-sorted, row-group stats) and use it; "
+                         "an existing copy newer than the source is reused")
     a = ap.parse_args()
     cfg = load_cfg(a.config)
 
+    pq = cfg["paths"].get("ohlcv_parquet")
+    if a.sort_parquet and pq and Path(pq).exists():
+        dst = Path(pq).with_name(Path(pq).stem + "_by_symbol.parquet")
+        if dst.exists() and dst.stat().st_mtime_ns >= Path(pq).stat().st_mtime_ns:
+            print(f"Using {dst} (newer than {pq})")
+        else:
+            sort_parquet_by_symbol(pq, dst)
+            print(f"Rewrote {pq} -> {dst} (sorted by symbol)")
+        cfg["paths"]["ohlcv_parquet"] = str(dst)
+
     trades = pd.read_csv(cfg["paths"]["trades_csv"], parse_dates=["date"]).sort_values("date").reset_index(drop=True)
     if "trade_id" not in trades.columns: trades["trade_id"] = np.arange(len(trades))
     has_exit = "exit_time" in trades.columns
@@ -81,45 +117,48 @@ def main():
     if not (has_exit or has_dur): 
         raise ValueError("Trades need 'duration' or 'exit_time'")
 
-    rows = []
-    for _, tr in trades.iterrows():
-        sym = str(tr["symbol"])
-        entry = pd.to_datetime(tr.get("entry_time", tr["date"]), errors="coerce")
-        if pd.isna(entry): 
-            continue
+    ind = cfg.get("indicators") or {}
+    params = (int(ind.get("atr_window", 14)), int(ind.get("donchian_window", 20)), int(ind.get("bb_window", 20)))
+    keep = ["trade_id","symbol","bar_index","date","open","high","low","close","volume",
+            "ret_from_entry","atr","donchian_high","donchian_low","bb_mid"]
 
-        o = load_ohlcv(sym, cfg["paths"]["ohlcv_folder"], cfg["paths"]["ohlcv_parquet"])
-        if o is None or o.empty: 
+    rows = {}
+    # one load + indicator pass per symbol; windows are restored to trade order at the end
+    for sym, g in trades.groupby(trades["symbol"].astype(str), sort=False):
+        o = enriched_ohlcv(sym, cfg["paths"]["ohlcv_folder"], cfg["paths"]["ohlcv_parquet"], *params)
+        if o is None:
             continue
-        o = add_ind(o, 14, 20, 20)
-
-        si = snap_idx(o["date"].values, np.datetime64(entry))
-        if si is None: 
-            continue
-
-        if has_exit and not pd.isna(tr.get("exit_time", pd.NaT)):
-            end = pd.to_datetime(tr["exit_time"], errors="coerce")
-            w = o.loc[(o["date"]>=entry) & (o["date"]<=end)].copy().reset_index(drop=True)
-        else:
-            dur = int(tr["duration"])
-            w = o.iloc[si:si+dur].copy().reset_index(drop=True)
-
-        if w.empty or pd.isna(w.iloc[0].get("close", np.nan)):
-            continue
-
-        entry_close = float(w.iloc[0]["close"])
-        w["ret_from_entry"] = w["close"]/entry_close - 1.0
-        w["trade_id"] = tr["trade_id"]; w["symbol"] = sym; w["bar_index"] = np.arange(len(w))
-
-        keep = ["trade_id","symbol","bar_index","date","open","high","low","close","volume",
-                "ret_from_entry","atr","donchian_high","donchian_low","bb_mid"]
-        for c in keep:
-            if c not in w.columns: w[c] = np.nan
-        rows.append(w[keep])
+        dates = o["date"].values
+        for i, tr in g.iterrows():
+            entry = pd.to_datetime(tr.get("entry_time", tr["date"]), errors="coerce")
+            if pd.isna(entry):
+                continue
+
+            si = snap_idx(dates, np.datetime64(entry))
+            if si is None:
+                continue
+
+            if has_exit and not pd.isna(tr.get("exit_time", pd.NaT)):
+                end = pd.to_datetime(tr["exit_time"], errors="coerce")
+                ei = si if pd.isna(end) else int(dates.searchsorted(np.datetime64(end), side="right"))
+            else:
+                ei = si + int(tr["duration"])
+            w = o.iloc[si:max(ei, si)].copy().reset_index(drop=True)
+
+            if w.empty or pd.isna(w.iloc[0].get("close", np.nan)):
+                continue
+
+            entry_close = float(w.iloc[0]["close"])
+            w["ret_from_entry"] = w["close"]/entry_close - 1.0
+            w["trade_id"] = tr["trade_id"]; w["symbol"] = sym; w["bar_index"] = np.arange(len(w))
+
+            for c in keep:
+                if c not in w.columns: w[c] = np.nan
+            rows[i] = w[keep]
 
     if not rows:
         raise RuntimeError("No trade windows built; check timestamps/symbol names/OHLCV folder.")
-    out = pd.concat(rows, ignore_index=True)
+    out = pd.concat([rows[i] for i in sorted(rows)], ignore_index=True)
     out.to_csv(cfg["paths"]["out_csv"], index=False)
     print(f"Wrote {len(out)} rows to {cfg['paths']['out_csv']} across {out['trade_id'].nunique()} trades.")
 